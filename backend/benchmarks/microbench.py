@@ -0,0 +1,185 @@
+"""
+Microbenchmarks for the per-message inner loops of the pipeline:
+
+- detect:         fault_detection_agent.detect_and_prepare_fault
+- temporal:       temporal_rules.TemporalFilter.update on the detected fault bits
+- fault_ingest:   consume_faults parsing, device split and severity (sensors.ingest)
+- sensor_ingest:  consume_sensors parsing, sensor_id and row id generation (sensors.ingest)
+- wire_json:      encoding and decoding a reading as JSON (hotel_common.wire)
+- wire_binary:    the same with the binary struct layout
+
+Each case runs over --messages synthetic messages and reports ns/message,
+peak bytes allocated per message and blocks retained per message. With
+--baseline, the run fails (exit 1) if any case got slower or allocates more
+than --threshold percent over the baseline.
+
+    python benchmarks/microbench.py --messages 1000000 --save baseline.json
+    python benchmarks/microbench.py --messages 1000000 --baseline baseline.json --threshold 10
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [BACKEND_DIR, os.path.join(BACKEND_DIR, 'fault_detection_agent'), os.path.join(BACKEND_DIR, 'django_backend')]
+
+from fault_detection_agent import detect_and_prepare_fault  # noqa: E402
+from hotel_common import wire  # noqa: E402
+from hotel_common.simulation import READING_GENERATORS, SENSOR_TYPES  # noqa: E402
+from temporal_rules import TemporalFilter, parse_rules  # noqa: E402
+from sensors.ingest import calculate_severity, generate_unique_id, parse_fault_message, parse_sensor_message  # noqa: E402
+
+# Distinct synthetic messages per case; the run cycles through them
+POOL_SIZE = 10000
+# Messages traced for allocation figures (tracemalloc is too slow for the full run)
+ALLOCATION_SAMPLE = 2000
+COMPARED = ('ns_per_message', 'alloc_bytes_per_message')
+
+
+def synthetic_readings(rng, faulty_ratio=1 / 12):
+    readings = []
+    for _ in range(POOL_SIZE):
+        sensor_type = rng.choice(SENSOR_TYPES)
+        routing_key = f"floor{rng.randint(1, 50)}.room{rng.randint(1, 200)}.{sensor_type}"
+        data = READING_GENERATORS[sensor_type](1700000000 + rng.randint(0, 10**6), rng.random() < faulty_ratio, rng)
+        readings.append((data, routing_key))
+    return readings
+
+
+def synthetic_faults(rng):
+    return [
+        ({'timestamp': 1700000000 + rng.randint(0, 10**6), 'fault_flags': rng.randint(1, 511)},
+         f"floor{rng.randint(1, 50)}.room{rng.randint(1, 200)}.fault")
+        for _ in range(POOL_SIZE)
+    ]
+
+
+def detect(message):
+    data, routing_key = message
+    detect_and_prepare_fault(data, routing_key)
+
+
+temporal_filter = TemporalFilter(rules=parse_rules('default:n=3,m=5,clear=3'), repeat_interval=300)
+
+
+def temporal(message):
+    data, routing_key = message
+    _, fault_payload, _ = detect_and_prepare_fault(data, routing_key)
+    temporal_filter.update(routing_key, fault_payload['fault_flags'] if fault_payload else 0, data['timestamp'])
+
+
+def fault_ingest(message):
+    data, routing_key = message
+    _, _, _, device_faults = parse_fault_message(data, routing_key)
+    for _, flags in device_faults:
+        calculate_severity(flags)
+        generate_unique_id(data['timestamp'])
+
+
+def sensor_ingest(message):
+    data, routing_key = message
+    parse_sensor_message(data, routing_key)
+    generate_unique_id(data['timestamp'])
+
+
+def wire_json(message):
+    data, routing_key = message
+    sensor_type = routing_key.rsplit('.', 1)[-1]
+    wire.decode(sensor_type, wire.encode(sensor_type, data, wire.JSON), wire.JSON)
+
+
+def wire_binary(message):
+    data, routing_key = message
+    sensor_type = routing_key.rsplit('.', 1)[-1]
+    wire.decode(sensor_type, wire.encode(sensor_type, data, wire.BINARY), wire.BINARY)
+
+
+CASES = {
+    'detect': (detect, synthetic_readings),
+    'temporal': (temporal, synthetic_readings),
+    'fault_ingest': (fault_ingest, synthetic_faults),
+    'sensor_ingest': (sensor_ingest, synthetic_readings),
+    'wire_json': (wire_json, synthetic_readings),
+    'wire_binary': (wire_binary, synthetic_readings),
+}
+
+
+def measure(fn, pool, messages, repeat):
+    # Best of `repeat` runs over `messages` messages, with the GC paused as in a steady state
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter_ns()
+        for i in range(messages):
+            fn(pool[i % POOL_SIZE])
+        elapsed = time.perf_counter_ns() - start
+        gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+
+    sample = pool[:ALLOCATION_SAMPLE]
+    tracemalloc.start()
+    peak_total = 0
+    blocks_before = sys.getallocatedblocks()
+    for message in sample:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        fn(message)
+        peak_total += tracemalloc.get_traced_memory()[1] - current
+    retained_blocks = sys.getallocatedblocks() - blocks_before
+    tracemalloc.stop()
+
+    return {
+        'messages': messages,
+        'ns_per_message': round(best / messages, 1),
+        'alloc_bytes_per_message': round(peak_total / len(sample), 1),
+        'retained_blocks_per_message': round(retained_blocks / len(sample), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for detection and consumer message handling')
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--cases', default=','.join(CASES), help='Comma-separated subset of ' + ', '.join(CASES))
+    parser.add_argument('--save', help='Write results as JSON')
+    parser.add_argument('--baseline', help='Fail if a case regressed against this JSON file')
+    parser.add_argument('--threshold', type=float, default=10, help='Allowed regression in percent')
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.cases.split(','):
+        fn, make_pool = CASES[name]
+        pool = make_pool(random.Random(args.seed))
+        results[name] = measure(fn, pool, args.messages, args.repeat)
+        r = results[name]
+        print(f"{name:14} {r['ns_per_message']:>10.1f} ns/msg {r['alloc_bytes_per_message']:>10.1f} B/msg "
+              f"{r['retained_blocks_per_message']:>8.3f} retained blocks/msg", flush=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = []
+        for name, result in results.items():
+            for key in COMPARED:
+                old = baseline.get(name, {}).get(key)
+                if old and (result[key] - old) / old * 100 > args.threshold:
+                    regressions.append(f"{name}.{key}: {old} -> {result[key]}")
+        if regressions:
+            print(f"Regressions over {args.threshold}%:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print(f"No regressions over {args.threshold}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+"""
+End-to-end pipeline benchmark.
+
+Publishes synthetic readings (the load generator's distributions) through
+fault_detection_agent and the Django consumers (consume_all), while the API
+is polled, against a local RabbitMQ and TimescaleDB (docker-compose.bench.yml)
+and a fake Supabase endpoint served by this script. Writes a JSON report with
+throughput, end-to-end fault latency percentiles, DB write amplification and
+API latency, which --compare diffs against an earlier run.
+
+    docker-compose -f benchmarks/docker-compose.bench.yml up -d
+    python benchmarks/pipeline_benchmark.py --floors 10 --rooms 50 --duration 60 --output run.json
+    python benchmarks/pipeline_benchmark.py --compare baseline.json run.json --threshold 10
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [BACKEND_DIR, os.path.join(BACKEND_DIR, 'fault_detection_agent'), os.path.join(BACKEND_DIR, 'load_generator')]
+
+import psycopg  # noqa: E402
+
+from anomaly import AnomalyDetector  # noqa: E402
+from fault_detection_agent import evaluate_reading  # noqa: E402
+from hotel_common.aio_consumer import queue_arguments  # noqa: E402
+from hotel_common.connection import connect  # noqa: E402
+from hotel_common.fault_rules import rule_book  # noqa: E402
+from hotel_common.publisher import BatchPublisher  # noqa: E402
+from hotel_common.sharding import room_headers  # noqa: E402
+from hotel_common.simulation import FaultySlotClock, READING_GENERATORS  # noqa: E402
+from load_generator import build_streams, parse_rates  # noqa: E402
+from temporal_rules import TemporalFilter  # noqa: E402
+from thresholds import ThresholdTable  # noqa: E402
+
+QUEUES = ['test_queue', 'sensor_queue', 'fault_queue']
+API_ENDPOINTS = [
+    '/api/faults/recent/?skip_sync=true',
+    '/api/faults/?limit=100',
+    '/api/sensor-readings/?limit=100',
+    '/api/faults/trends/?range=1h',
+]
+
+# (metric path, higher is better) - what --compare checks for regressions
+COMPARED_METRICS = [
+    ('throughput.published_per_s', True),
+    ('throughput.processed_per_s', True),
+    ('fault_latency_ms.p50', False),
+    ('fault_latency_ms.p99', False),
+    ('db.tuple_writes_per_message', False),
+    ('db.wal_bytes_per_message', False),
+    ('supabase.requests_per_message', False),
+    ('api_latency_ms.p50', False),
+    ('api_latency_ms.p99', False),
+]
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def rank(p):
+        return round(values[min(len(values) - 1, int(p / 100.0 * len(values)))], 2)
+    return {'count': len(values), 'p50': rank(50), 'p90': rank(90), 'p99': rank(99), 'max': round(values[-1], 2)}
+
+
+class FakeSupabase:
+    """
+    Stand-in for the Supabase REST API. Accepts every upsert, and matches each
+    synced fault with the oldest pending faulty reading of its room and device.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.sensor_rows = 0
+        self.last_sensor_row_at = None
+        self.pending_faults = defaultdict(deque)
+        self.fault_latencies_ms = []
+        self.unmatched_faults = 0
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                rows = json.loads(body or b'[]')
+                rows = rows if isinstance(rows, list) else [rows]
+                fake.record(self.path.rstrip('/').split('/')[-1].split('?')[0], rows)
+                self.send_response(201)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps(rows).encode())
+
+            do_PATCH = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def expect_fault(self, floor, room, device_type, published_at):
+        with self._lock:
+            self.pending_faults[(floor, room, device_type)].append(published_at)
+
+    def record(self, table, rows):
+        now = time.monotonic()
+        with self._lock:
+            self.requests += 1
+            if table == 'sensors_data':
+                self.sensor_rows += len(rows)
+                self.last_sensor_row_at = now
+            elif table == 'equipment_faults':
+                for row in rows:
+                    pending = self.pending_faults.get((row['floor'], row['room'], row['device_type']))
+                    if pending:
+                        self.fault_latencies_ms.append((now - pending.popleft()) * 1000)
+                    else:
+                        self.unmatched_faults += 1
+
+
+class ApiSampler(threading.Thread):
+    def __init__(self, base_url, interval):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.interval = interval
+        self.latencies_ms = defaultdict(list)
+        self.errors = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for endpoint in API_ENDPOINTS:
+                start = time.monotonic()
+                try:
+                    urllib.request.urlopen(self.base_url + endpoint, timeout=10).read()
+                    self.latencies_ms[endpoint].append((time.monotonic() - start) * 1000)
+                except Exception:
+                    self.errors += 1
+
+
+def database_settings():
+    return {
+        'dbname': os.getenv('DATABASE_NAME', 'hotel_bench'),
+        'user': os.getenv('DATABASE_USER', 'hotel_user'),
+        'password': os.getenv('DATABASE_PASSWORD', 'hotel_pass'),
+        'host': os.getenv('DATABASE_HOST', 'localhost'),
+        'port': os.getenv('DATABASE_PORT', '5432'),
+    }
+
+
+def prepare_database(reset):
+    with psycopg.connect(**database_settings(), autocommit=True) as conn:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')) as f:
+            conn.execute(f.read())
+        if reset:
+            conn.execute("TRUNCATE sensors_sensorreading, equipment_faults, fault_incidents")
+
+
+def database_snapshot():
+    # Statistics are flushed asynchronously; give the last transactions a moment
+    time.sleep(1.5)
+    with psycopg.connect(**database_settings(), autocommit=True) as conn:
+        tuple_writes = conn.execute(
+            "SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0) FROM pg_stat_user_tables"
+        ).fetchone()[0]
+        wal_lsn = conn.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')").fetchone()[0]
+        readings = conn.execute("SELECT COUNT(*) FROM sensors_sensorreading").fetchone()[0]
+        faults = conn.execute("SELECT COUNT(*) FROM equipment_faults").fetchone()[0]
+    return {'tuple_writes': int(tuple_writes), 'wal_bytes': int(wal_lsn), 'readings': readings, 'faults': faults}
+
+
+async def prepare_queues(purge):
+    connection = await connect()
+    channel = await connection.channel()
+    for name in QUEUES:
+        queue = await channel.declare_queue(name, durable=True, arguments=queue_arguments(name))
+        if purge:
+            await queue.purge()
+    await connection.close()
+
+
+async def wait_for_consumers(timeout):
+    connection = await connect()
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            channel = await connection.channel()
+            consumers = []
+            for name in QUEUES:
+                queue = await channel.declare_queue(name, passive=True)
+                consumers.append(queue.declaration_result.consumer_count)
+            await channel.close()
+            if all(consumers):
+                return True
+            await asyncio.sleep(0.5)
+        return False
+    finally:
+        await connection.close()
+
+
+def spawn(args, env, workdir, name):
+    log = open(os.path.join(workdir, f"{name}.log"), 'w')
+    return subprocess.Popen(args, env=env, stdout=log, stderr=subprocess.STDOUT, cwd=BACKEND_DIR)
+
+
+def publish_load(args, fake):
+    """Publishes readings at the target rates for args.duration seconds; returns (published, faulty_expected)."""
+    rng = random.Random(args.seed)
+    streams = build_streams(args.floors, args.rooms, parse_rates(args.rates), 0, 1)
+    clocks = [FaultySlotClock(max(1, round(60 / interval))) for _, _, interval in streams]
+    schedule = [(rng.uniform(0, interval), index) for index, (_, _, interval) in enumerate(streams)]
+    heapq.heapify(schedule)
+    # The detector's own pipeline, so suppressed repeats, reminders and anomalies are expected alike
+    rules = rule_book().current
+    temporal_filter = TemporalFilter(faults=rules)
+    anomaly_detector = AnomalyDetector()
+    threshold_table = ThresholdTable()
+
+    publisher = BatchPublisher('hotel_sensors', quiet=True).start()
+    start_wall = time.time()
+    start = time.monotonic()
+    published = expected_faults = 0
+    while schedule and schedule[0][0] < args.duration:
+        due, index = schedule[0]
+        elapsed = time.monotonic() - start
+        if due > elapsed:
+            time.sleep(min(due - elapsed, 0.05))
+            continue
+        heapq.heapreplace(schedule, (due + streams[index][2], index))
+        routing_key, sensor_type, _ = streams[index]
+        clock = clocks[index]
+        if int(due // 60) != clock.minute:
+            clock.start_minute(int(due // 60), rng)
+        data = READING_GENERATORS[sensor_type](int(start_wall + due), clock.next_is_faulty(), rng)
+
+        # Faults the detector should raise for this reading, matched when they reach Supabase
+        _, _, fault_flags, _, _ = evaluate_reading(routing_key, sensor_type, data, rules, temporal_filter,
+                                                   anomaly_detector, threshold_table)
+        if fault_flags:
+            floor, room, _ = routing_key.split('.')
+            fake.expect_fault(int(floor[5:]), int(room[4:]), sensor_type, time.monotonic())
+            expected_faults += 1
+        publisher.publish(routing_key, json.dumps(data).encode(), headers=room_headers(routing_key))
+        published += 1
+    publisher.close()
+    return published, expected_faults, time.monotonic() - start
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='pipeline_bench_')
+    prepare_database(args.reset)
+    asyncio.run(prepare_queues(purge=True))
+    fake = FakeSupabase()
+
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': BACKEND_DIR,
+        'RABBITMQ_HOST': os.getenv('RABBITMQ_HOST', 'localhost'),
+        'RABBITMQ_PORT': os.getenv('RABBITMQ_PORT', '5672'),
+        'SUPABASE_URL': fake.url,
+        'SUPABASE_KEY': 'bench.bench.bench',
+        'DJANGO_DEBUG': 'False',
+        'CSV_PATH': os.path.join(workdir, 'faults.csv'),
+        'PUBLISH_QUIET': '1',
+    })
+    database = database_settings()
+    env.update({
+        'DATABASE_NAME': database['dbname'],
+        'DATABASE_USER': database['user'],
+        'DATABASE_PASSWORD': database['password'],
+        'DATABASE_HOST': database['host'],
+        'DATABASE_PORT': database['port'],
+    })
+    os.environ.update({key: env[key] for key in ('RABBITMQ_HOST', 'RABBITMQ_PORT')})
+
+    manage = os.path.join(BACKEND_DIR, 'django_backend', 'manage.py')
+    processes = [
+        spawn([sys.executable, os.path.join(BACKEND_DIR, 'fault_detection_agent', 'fault_detection_agent.py')], env, workdir, 'detector'),
+        spawn([sys.executable, manage, 'consume_all', '--max-in-flight', str(args.max_in_flight)], env, workdir, 'consumers'),
+        spawn([sys.executable, manage, 'runserver', f"127.0.0.1:{args.api_port}", '--noreload'], env, workdir, 'api'),
+    ]
+    sampler = ApiSampler(f"http://127.0.0.1:{args.api_port}", args.api_interval)
+    try:
+        if not asyncio.run(wait_for_consumers(60)):
+            raise SystemExit(f"Consumers did not start, see logs in {workdir}")
+        before = database_snapshot()
+        sampler.start()
+
+        print(f"Publishing for {args.duration}s...", flush=True)
+        published, expected_faults, publish_seconds = publish_load(args, fake)
+        publish_done = time.monotonic()
+
+        # Drain: wait until every reading reached Supabase or progress stalls
+        last_count, last_progress = -1, time.monotonic()
+        while fake.sensor_rows < published and time.monotonic() - last_progress < args.drain_timeout:
+            if fake.sensor_rows != last_count:
+                last_count, last_progress = fake.sensor_rows, time.monotonic()
+            time.sleep(0.5)
+        sampler.stopped.set()
+        after = database_snapshot()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=30)
+
+    processed = fake.sensor_rows
+    pipeline_seconds = (fake.last_sensor_row_at or publish_done) - (publish_done - publish_seconds)
+    tuple_writes = after['tuple_writes'] - before['tuple_writes']
+    wal_bytes = after['wal_bytes'] - before['wal_bytes']
+    all_api_latencies = [value for values in sampler.latencies_ms.values() for value in values]
+    return {
+        'run': {
+            'started_at': int(time.time() - publish_seconds),
+            'git_revision': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                                           capture_output=True, text=True).stdout.strip(),
+            'floors': args.floors, 'rooms': args.rooms, 'rates': args.rates, 'duration_s': args.duration,
+            'max_in_flight': args.max_in_flight, 'seed': args.seed, 'logs': workdir,
+        },
+        'throughput': {
+            'published': published,
+            'processed': processed,
+            'lost': published - processed,
+            'published_per_s': round(published / publish_seconds, 2),
+            'processed_per_s': round(processed / pipeline_seconds, 2) if pipeline_seconds > 0 else 0,
+        },
+        'fault_latency_ms': dict(percentiles(fake.fault_latencies_ms), expected=expected_faults,
+                                 unmatched=fake.unmatched_faults),
+        'db': {
+            'tuple_writes': tuple_writes,
+            'wal_bytes': wal_bytes,
+            'rows_inserted': (after['readings'] - before['readings']) + (after['faults'] - before['faults']),
+            'tuple_writes_per_message': round(tuple_writes / processed, 3) if processed else None,
+            'wal_bytes_per_message': round(wal_bytes / processed, 1) if processed else None,
+        },
+        'supabase': {
+            'requests': fake.requests,
+            'requests_per_message': round(fake.requests / processed, 3) if processed else None,
+        },
+        'api_latency_ms': dict(percentiles(all_api_latencies), errors=sampler.errors,
+                               endpoints={endpoint: percentiles(values) for endpoint, values in sampler.latencies_ms.items()}),
+    }
+
+
+def metric(results, path):
+    for key in path.split('.'):
+        results = (results or {}).get(key)
+    return results
+
+
+def compare(baseline_path, current_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+
+    regressions = 0
+    print(f"{'metric':34} {'baseline':>12} {'current':>12} {'change':>9}")
+    for path, higher_is_better in COMPARED_METRICS:
+        old, new = metric(baseline, path), metric(current, path)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        worse = -change if higher_is_better else change
+        flag = ' REGRESSION' if worse > threshold else ''
+        regressions += bool(flag)
+        print(f"{path:34} {old:>12} {new:>12} {change:>+8.1f}%{flag}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end throughput and latency benchmark of the sensor pipeline')
+    parser.add_argument('--floors', type=int, default=5)
+    parser.add_argument('--rooms', type=int, default=20, help='Rooms per floor')
+    parser.add_argument('--rates', default='iaq=1,power=1,presence=1', help='Messages per second per sensor')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to publish for')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--max-in-flight', type=int, default=32)
+    parser.add_argument('--drain-timeout', type=float, default=30, help='Give up draining after this many seconds without progress')
+    parser.add_argument('--api-port', type=int, default=8765)
+    parser.add_argument('--api-interval', type=float, default=1.0, help='Seconds between API polling rounds')
+    parser.add_argument('--no-reset', dest='reset', action='store_false', help='Keep existing rows in the benchmark database')
+    parser.add_argument('--workdir', help='Where process logs and the detector CSV go (default: a temp dir)')
+    parser.add_argument('--output', help='Write the JSON report here as well as to stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help='Compare two reports instead of running')
+    parser.add_argument('--threshold', type=float, default=10, help='Percent change counted as a regression by --compare')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(args.compare[0], args.compare[1], args.threshold))
+
+    results = run(args)
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == "__main__":
+    main()
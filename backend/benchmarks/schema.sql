@@ -0,0 +1,80 @@
+-- TimescaleDB schema matching the unmanaged models in sensors/models.py,
+-- used to provision a throwaway database for the pipeline benchmark.
+CREATE EXTENSION IF NOT EXISTS timescaledb;
+
+CREATE TABLE IF NOT EXISTS sensors_sensorreading (
+    id BIGINT NOT NULL,
+    time TIMESTAMPTZ NOT NULL,
+    sensor_id BIGINT NOT NULL,
+    temperature DOUBLE PRECISION,
+    humidity DOUBLE PRECISION,
+    co2 DOUBLE PRECISION,
+    power DOUBLE PRECISION,
+    presence INTEGER,
+    sensor_type TEXT NOT NULL,
+    floor INTEGER NOT NULL,
+    room INTEGER NOT NULL,
+    CONSTRAINT sensors_sensorreading_time_sensor_id_unique UNIQUE (time, sensor_id)
+);
+SELECT create_hypertable('sensors_sensorreading', 'time', if_not_exists => TRUE);
+
+CREATE TABLE IF NOT EXISTS equipment_faults (
+    id BIGINT NOT NULL,
+    time TIMESTAMPTZ NOT NULL,
+    floor SMALLINT NOT NULL,
+    room SMALLINT NOT NULL,
+    device_type TEXT NOT NULL,
+    fault_flags INTEGER NOT NULL,
+    severity SMALLINT NOT NULL CONSTRAINT equipment_faults_severity_check CHECK (severity BETWEEN 1 AND 3),
+    resolved BOOLEAN NOT NULL DEFAULT FALSE,
+    incident_id BIGINT,
+    CONSTRAINT equipment_faults_time_id_unique UNIQUE (time, id)
+);
+SELECT create_hypertable('equipment_faults', 'time', if_not_exists => TRUE);
+CREATE INDEX IF NOT EXISTS idx_faults_search ON equipment_faults (floor, room, time);
+CREATE INDEX IF NOT EXISTS idx_unresolved_faults ON equipment_faults (severity) WHERE resolved = FALSE;
+-- Faults of a fault storm (sensors migration 0005)
+CREATE INDEX IF NOT EXISTS idx_faults_incident ON equipment_faults (incident_id) WHERE incident_id IS NOT NULL;
+
+-- Set fault bits of fault_flags, indexed for per-fault queries (sensors migration 0004)
+CREATE OR REPLACE FUNCTION fault_bits(flags integer) RETURNS smallint[]
+LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE AS $$
+DECLARE
+    bits smallint[] := '{}';
+    bit smallint := 0;
+BEGIN
+    WHILE flags <> 0 AND bit < 31 LOOP
+        IF flags & 1 = 1 THEN
+            bits := bits || bit;
+        END IF;
+        flags := flags >> 1;
+        bit := bit + 1;
+    END LOOP;
+    RETURN bits;
+END
+$$;
+CREATE INDEX IF NOT EXISTS idx_faults_bits ON equipment_faults USING gin (fault_bits(fault_flags));
+
+-- Tables of the managed models (sensors migrations 0002 and 0003)
+CREATE TABLE IF NOT EXISTS fault_threshold_overrides (
+    id BIGSERIAL PRIMARY KEY,
+    floor SMALLINT,
+    room SMALLINT,
+    fault TEXT NOT NULL,
+    threshold DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS fault_incidents (
+    id BIGSERIAL PRIMARY KEY,
+    floor SMALLINT NOT NULL,
+    device_type TEXT NOT NULL,
+    fault_flags INTEGER NOT NULL,
+    severity SMALLINT NOT NULL,
+    started_at TIMESTAMPTZ NOT NULL,
+    last_seen TIMESTAMPTZ NOT NULL,
+    rooms SMALLINT[] NOT NULL,
+    fault_count INTEGER NOT NULL,
+    active BOOLEAN NOT NULL DEFAULT TRUE,
+    resolved BOOLEAN NOT NULL DEFAULT FALSE
+);
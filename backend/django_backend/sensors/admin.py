@@ -1 +1,17 @@
 from django.contrib import admin
+
+from .models import Incident, ThresholdOverride
+
+
+@admin.register(ThresholdOverride)
+class ThresholdOverrideAdmin(admin.ModelAdmin):
+    list_display = ('fault', 'floor', 'room', 'threshold', 'updated_at')
+    list_filter = ('fault', 'floor')
+    ordering = ('fault', 'floor', 'room')
+
+
+@admin.register(Incident)
+class IncidentAdmin(admin.ModelAdmin):
+    list_display = ('started_at', 'floor', 'device_type', 'fault_flags', 'severity', 'fault_count', 'active', 'resolved')
+    list_filter = ('floor', 'device_type', 'active', 'resolved')
+    ordering = ('-started_at',)
@@ -5,4 +5,6 @@ class SensorsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sensors'
 
-    
+    def ready(self):
+        from hotel_common import log
+        log.configure()
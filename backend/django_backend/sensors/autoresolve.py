@@ -0,0 +1,77 @@
+# Automatic resolution of faults whose sensor reads healthy again, for consume_sensors.
+# Kept free of ORM and broker imports, like ingest.py.
+import os
+import threading
+
+
+class HealthTracker:
+    """
+    Counts healthy readings per (floor, room, device type) with unresolved faults.
+
+    After AUTO_RESOLVE_READINGS healthy readings in a row (default 10, 0 disables)
+    the key is ready: its faults raised before the first of those readings can be
+    resolved. A faulty reading starts the count again. Keys are added by track()
+    from the unresolved faults in the database and dropped once take() hands
+    them out, so only rooms with open faults cost anything per reading.
+    """
+
+    def __init__(self, readings=None):
+        self.readings = int(os.getenv('AUTO_RESOLVE_READINGS', '10')) if readings is None else readings
+        self.open = {}  # key -> [healthy readings in a row, timestamp of the first of them]
+        self.ready = {}  # key -> timestamp of the first healthy reading
+        self.overrides = {}
+        self._rules = None
+        self._evaluators = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.readings > 0
+
+    def track(self, keys):
+        with self.lock:
+            for key in keys:
+                self.open.setdefault(key, [0, None])
+
+    def set_overrides(self, overrides):
+        """{(floor, room): {fault name: threshold}} from fault_threshold_overrides."""
+        if overrides != self.overrides:
+            self.overrides = overrides
+            self._evaluators = {}
+
+    def is_healthy(self, rules, floor, room, sensor_type, reading):
+        if rules is not self._rules:
+            self._rules = rules
+            self._evaluators = {}
+        scope = (floor, room, sensor_type)
+        evaluators = self._evaluators.get(scope)
+        if evaluators is None:
+            thresholds = rules.resolve_thresholds(self.overrides, floor, room, sensor_type) if self.overrides else None
+            evaluators = self._evaluators[scope] = (
+                rules.compile(sensor_type, thresholds) if thresholds else rules.evaluators.get(sensor_type, ()))
+        return not rules.evaluate(sensor_type, reading, evaluators)[0]
+
+    def observe(self, rules, floor, room, sensor_type, reading):
+        state = self.open.get((floor, room, sensor_type))
+        if state is None:
+            return
+        healthy = self.is_healthy(rules, floor, room, sensor_type, reading)
+        with self.lock:
+            if healthy:
+                if state[0] == 0:
+                    state[1] = reading['timestamp']
+                state[0] += 1
+                if state[0] >= self.readings:
+                    self.ready[(floor, room, sensor_type)] = state[1]
+            else:
+                state[0] = 0
+                state[1] = None
+                self.ready.pop((floor, room, sensor_type), None)
+
+    def take(self):
+        """{key: timestamp of the first healthy reading} for the keys ready to resolve."""
+        with self.lock:
+            ready, self.ready = self.ready, {}
+            for key in ready:
+                self.open.pop(key, None)
+            return ready
@@ -0,0 +1,111 @@
+# Correlation of fault storms into incidents for consume_faults.
+# Kept free of ORM and broker imports, like ingest.py.
+import os
+import threading
+
+
+class FaultGroup:
+    """Faults of one floor, device type and fault bit, each within window seconds of the last."""
+
+    __slots__ = ('floor', 'device_type', 'mask', 'started', 'last_seen', 'rooms', 'fault_count',
+                 'incident_id', 'active', 'dirty')
+
+    def __init__(self, floor, device_type, mask, timestamp):
+        self.floor = floor
+        self.device_type = device_type
+        self.mask = mask
+        self.started = timestamp
+        self.last_seen = timestamp
+        self.rooms = set()
+        self.fault_count = 0
+        self.incident_id = None
+        self.active = True
+        self.dirty = False
+
+    def snapshot(self):
+        return {
+            'incident_id': self.incident_id,
+            'floor': self.floor,
+            'device_type': self.device_type,
+            'fault_flags': self.mask,
+            'started': self.started,
+            'last_seen': self.last_seen,
+            'rooms': sorted(self.rooms),
+            'fault_count': self.fault_count,
+            'active': self.active,
+        }
+
+
+class IncidentCorrelator:
+    """
+    Incremental windowed grouping of faults (INCIDENT_WINDOW seconds, default 60).
+
+    A group becomes an incident once faults from INCIDENT_MIN_ROOMS rooms (default 3,
+    0 disables) joined it. Every fault keeps its own row; the writer links the rows to
+    the incident they belong to. Faults reach add() from the handler threads; flush()
+    hands the incidents that changed to the writer in one batch.
+    """
+
+    def __init__(self, window=None, min_rooms=None):
+        self.window = window or float(os.getenv('INCIDENT_WINDOW', '60'))
+        self.min_rooms = int(os.getenv('INCIDENT_MIN_ROOMS', '3')) if min_rooms is None else min_rooms
+        self.groups = {}  # (floor, device type, fault mask) -> FaultGroup
+        self.ended = []  # incidents closed since the last flush
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.min_rooms > 0
+
+    def add(self, timestamp, floor, room, device_type, flags):
+        """Counts a stored fault once; returns the bits of flags that belong to an incident."""
+        covered = 0
+        with self.lock:
+            bits = flags
+            while bits:
+                mask = bits & -bits
+                bits ^= mask
+                key = (floor, device_type, mask)
+                group = self.groups.get(key)
+                if group is None or timestamp - group.last_seen > self.window:
+                    if group is not None:
+                        self._end(group)
+                    group = self.groups[key] = FaultGroup(floor, device_type, mask, timestamp)
+                group.rooms.add(room)
+                group.fault_count += 1
+                group.last_seen = max(group.last_seen, timestamp)
+                if len(group.rooms) >= self.min_rooms:
+                    group.dirty = True
+                    covered |= mask
+        return covered
+
+    def _end(self, group):
+        # Groups that never reached min_rooms stay single faults
+        if len(group.rooms) >= self.min_rooms:
+            group.active = False
+            group.dirty = True
+            self.ended.append(group)
+
+    def flush(self, now):
+        """
+        Ends the groups idle for longer than the window and returns
+        [(group, snapshot), ...] for every incident that changed since the last flush.
+        """
+        with self.lock:
+            for key, group in list(self.groups.items()):
+                if now - group.last_seen > self.window:
+                    del self.groups[key]
+                    self._end(group)
+            changed = [group for group in self.groups.values() if group.dirty] + self.ended
+            self.ended = []
+            for group in changed:
+                group.dirty = False
+            return [(group, group.snapshot()) for group in changed]
+
+    def retry(self, changes):
+        """Marks incidents whose flush failed as changed again."""
+        with self.lock:
+            for group, _ in changes:
+                group.dirty = True
+                if not group.active and group not in self.ended:
+                    self.ended.append(group)
@@ -0,0 +1,98 @@
+# Message parsing for consume_sensors / consume_faults.
+# Kept free of ORM and broker imports so benchmarks/microbench.py can time it.
+from datetime import datetime
+import hashlib
+import random
+
+import pytz
+
+from hotel_common.fault_rules import rule_book
+
+BANGKOK = pytz.timezone('Asia/Bangkok')
+
+VALID_SENSOR_TYPES = {'iaq', 'power', 'presence'}
+
+# A message failing with one of these will never parse; anything else is worth a redelivery
+MALFORMED_ERRORS = (ValueError, KeyError, TypeError)
+
+
+def split_fault_flags(fault_flags, rules=None):
+    """Split fault_flags into (device_type, flags) pairs for every device with a fault."""
+    # Fault bits, device types and severities live in hotel_common/fault_rules.json
+    return (rules or rule_book().current).split(fault_flags)
+
+
+def calculate_severity(flags, rules=None):
+    return (rules or rule_book().current).severity(flags)
+
+
+def generate_unique_id(timestamp):
+    """Generate a unique ID within 32-bit integer range"""
+    # Use last 7 digits of timestamp (max 9999999) plus a random 3-digit number
+    timestamp_part = int(timestamp) % 10000000  # Up to 7 digits
+    random_part = random.randint(0, 999)   # 3 digits
+    # Combine: timestamp_part * 1000 + random_part (max ~9,999,999,999)
+    # Ensure it fits in 32-bit signed int (max 2,147,483,647)
+    unique_id = (timestamp_part * 1000 + random_part) % 2147483647
+    return unique_id if unique_id > 0 else 1  # Ensure non-zero
+
+
+def sensor_id_for(floor, room, sensor_type):
+    sensor_id_str = f"{floor}:{room}:{sensor_type}"
+    return int(hashlib.sha256(sensor_id_str.encode()).hexdigest(), 16) % 10**10
+
+
+def parse_floor_room(routing_key):
+    """floor2.room3.<anything> -> (2, 3, '<anything>')"""
+    parts = routing_key.split('.')
+    if len(parts) != 3:
+        raise ValueError(f"Invalid routing key format: {routing_key}")
+
+    floor_str, room_str, suffix = parts
+    try:
+        floor = int(floor_str.replace('floor', ''))
+        room = int(room_str.replace('room', ''))
+    except ValueError:
+        raise ValueError(f"Could not parse floor/room from: {routing_key}")
+    return floor, room, suffix
+
+
+def parse_sensor_message(data, routing_key):
+    """Validate a hotel_sensors reading and return the SensorReading fields it maps to."""
+    if 'timestamp' not in data:
+        raise ValueError("Missing 'timestamp' field in message")
+    # Convert Unix timestamp to Asia/Bangkok timezone
+    thailand_dt = datetime.fromtimestamp(data['timestamp'], tz=BANGKOK)
+
+    floor, room, sensor_type = parse_floor_room(routing_key)
+    if sensor_type not in VALID_SENSOR_TYPES:
+        raise ValueError(f"Invalid sensor_type: {sensor_type}")
+
+    # Extract sensor-specific fields
+    presence = data.get('presence') if sensor_type == 'presence' else None
+    if presence is not None and presence not in {0, 1, 2, 3}:
+        raise ValueError(f"Invalid presence value: {presence}")
+
+    return {
+        'time': thailand_dt,
+        'sensor_id': sensor_id_for(floor, room, sensor_type),
+        'temperature': data.get('temperature') if sensor_type == 'iaq' else None,
+        'humidity': data.get('humidity') if sensor_type == 'iaq' else None,
+        'co2': data.get('co2') if sensor_type == 'iaq' else None,
+        'power': data.get('power_kw') if sensor_type == 'power' else None,
+        'presence': presence,
+        'sensor_type': sensor_type,
+        'floor': floor,
+        'room': room,
+    }
+
+
+def parse_fault_message(data, routing_key, rules=None):
+    """Validate a fault_notifications message; returns (fault_time, floor, room, [(device_type, flags), ...])."""
+    if 'timestamp' not in data or 'fault_flags' not in data:
+        raise ValueError("Missing 'timestamp' or 'fault_flags' field in message")
+    # Convert Unix timestamp to Asia/Bangkok
+    fault_time = datetime.fromtimestamp(data['timestamp'], tz=BANGKOK)
+    # Parse floor and room from routing key (e.g., floor2.room3.fault)
+    floor, room, _ = parse_floor_room(routing_key)
+    return fault_time, floor, room, split_fault_flags(data['fault_flags'], rules)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from sensors.management.commands import consume_faults, consume_sensors
+from hotel_common import profiling
+from hotel_common.aio_consumer import AsyncConsumerRuntime
+from hotel_common.metrics import start_metrics_server
+
+
+class Command(BaseCommand):
+    help = 'Consumes sensor and fault messages from RabbitMQ in a single process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-in-flight', type=int, default=None, help='Maximum number of messages processed concurrently')
+        parser.add_argument('--metrics-port', type=int, default=None, help='Port for /metrics (default METRICS_PORT or 9102, 0 disables)')
+
+    def handle(self, *args, **options):
+        self.stdout.write("Starting RabbitMQ sensor and fault consumer...")
+
+        runtime = AsyncConsumerRuntime(max_in_flight=options['max_in_flight'])
+        consume_sensors.Command().register(runtime)
+        consume_faults.Command().register(runtime)
+        start_metrics_server(9102, options['metrics_port'])
+        profiling.install('consume_all')
+
+        self.stdout.write("Consumer started, listening for messages...")
+        runtime.run_forever()
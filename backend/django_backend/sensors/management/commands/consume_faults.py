@@ -1,167 +1,169 @@
-import json
-import pika
-from django.core.management.base import BaseCommand
-from sensors.models import EquipmentFault
+import asyncio
+import logging
 from datetime import datetime
-import pytz
-import random
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, DataError, close_old_connections
+from sensors.models import EquipmentFault, Incident
 from sensors.supabase_service import SupabaseService
+from sensors.sync import SyncQueue
+from sensors.incidents import IncidentCorrelator
+from sensors.resolve import link_incident_faults, settle_incidents
+from sensors.ingest import BANGKOK, MALFORMED_ERRORS, parse_fault_message, calculate_severity, generate_unique_id
+from hotel_common import profiling
+from hotel_common import wire
+from hotel_common.aio_consumer import AsyncConsumerRuntime
+from hotel_common.fault_rules import rule_book
+from hotel_common.log import get_logger
+from hotel_common.metrics import DB_WRITE_SECONDS, FAULTS_CORRELATED, start_metrics_server
+import time
 import os
 import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hotel_project.settings')
 django.setup()
-# Fault bit definitions
-FAULT_SENSOR_NOT_WORKING = 1      # Bit 0 (IAQ: all zeros)
-FAULT_CALIBRATION_ERROR = 2       # Bit 1 (IAQ: partial zeros)
-FAULT_TEMP_HIGH = 4               # Bit 2
-FAULT_HUM_HIGH = 8                # Bit 3
-FAULT_CO2_LOW = 16                # Bit 4
-FAULT_CO2_HIGH = 32               # Bit 5
-FAULT_POWER_NOT_WORKING = 64      # Bit 6 (Power: 0.0 kW)
-FAULT_POWER_SPIKE = 128           # Bit 7 (Power: >45.0 kW)
-FAULT_PRESENCE_NOT_READING = 256  # Bit 8 (Presence: 3)
-
-# Device type bit ranges
-IAQ_FAULTS = (FAULT_SENSOR_NOT_WORKING | FAULT_CALIBRATION_ERROR | FAULT_TEMP_HIGH |
-              FAULT_HUM_HIGH | FAULT_CO2_LOW | FAULT_CO2_HIGH)  # Bits 0-5
-POWER_FAULTS = (FAULT_POWER_NOT_WORKING | FAULT_POWER_SPIKE)    # Bits 6-7
-PRESENCE_FAULTS = FAULT_PRESENCE_NOT_READING                    # Bit 8
 
-class Command(BaseCommand):
-    help = 'Consumes fault messages from RabbitMQ and stores them in TimescaleDB'
+DEVICE_LABELS = {'iaq': 'IAQ', 'power': 'Power', 'presence': 'Presence'}
 
-    def handle(self, *args, **options):
-        self.stdout.write("Starting RabbitMQ fault consumer...")
-        
-        credentials = pika.PlainCredentials('guest', 'guest')
-        rabbitmq_connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host='rabbitmq', credentials=credentials)
-        )
-        channel = rabbitmq_connection.channel()
+log = get_logger('consume_faults')
 
-        channel.exchange_declare(exchange='fault_notifications', exchange_type='topic')
-        channel.queue_declare(queue='fault_queue', durable=True)
-        channel.queue_bind(queue='fault_queue', exchange='fault_notifications', routing_key='*.room*.fault')
+INCIDENT_UPDATE_FIELDS = ['last_seen', 'rooms', 'fault_count', 'active']
 
-        self.stdout.write("Connected to RabbitMQ, waiting for fault messages...")
+class Command(BaseCommand):
+    help = 'Consumes fault messages from RabbitMQ and stores them in TimescaleDB'
 
-        def callback(ch, method, properties, body):
-            self.stdout.write(f"Received message: {body}")
-            try:
-                data = json.loads(body)
-                self.stdout.write(f"Parsed data: {data}")
-                
-                if 'timestamp' not in data or 'fault_flags' not in data:
-                    raise ValueError("Missing 'timestamp' or 'fault_flags' field in message")
-                
-                # Convert Unix timestamp to Asia/Bangkok
-                fault_time = datetime.fromtimestamp(data['timestamp'], tz=pytz.timezone('Asia/Bangkok'))
+    def add_arguments(self, parser):
+        parser.add_argument('--max-in-flight', type=int, default=None, help='Maximum number of messages processed concurrently')
+        parser.add_argument('--metrics-port', type=int, default=None, help='Port for /metrics (default METRICS_PORT or 9103, 0 disables)')
 
-                # Parse floor and room from routing key (e.g., floor2.room3.fault)
-                routing_key = method.routing_key
-                floor_str, room_str, _ = routing_key.split('.')
-                floor = int(floor_str.replace('floor', ''))
-                room = int(room_str.replace('room', ''))
+    def register(self, runtime):
+        runtime.add_handler('fault_queue', self.process_message, 'fault_notifications', '*.room*.fault')
+        # Faults and incidents reach Supabase in batches, retried apart from the message acks
+        self.sync = SyncQueue(SupabaseService().upsert)
+        runtime.add_periodic(float(os.getenv('SUPABASE_SYNC_INTERVAL', '2')), self.sync_supabase_async)
+        # Pick up edits to fault_rules.json without a restart
+        runtime.add_periodic(float(os.getenv('FAULT_RULES_RELOAD_INTERVAL', '5')), rule_book().reload_async)
+        # Storms of the same fault on a floor become one incident, written in batches
+        self.incidents = IncidentCorrelator()
+        if self.incidents.enabled:
+            runtime.add_periodic(float(os.getenv('INCIDENT_FLUSH_INTERVAL', '2')), self.flush_incidents_async)
 
-                # Split fault_flags into device-specific faults
-                fault_flags = data['fault_flags']
-                iaq_flags = fault_flags & IAQ_FAULTS
-                power_flags = fault_flags & POWER_FAULTS
-                presence_flags = fault_flags & PRESENCE_FAULTS
+    def process_message(self, delivery):
+        body = delivery.body
+        log.sampled('fault_received', "Received message: %s", body, level=logging.DEBUG)
+        try:
+            # One fault or an envelope of many
+            faults = wire.decode_all('fault', body, delivery.content_type, delivery.routing_key)
+        except Exception as e:
+            log.error("Error processing message: %s", e)
+            return
+        # Split and grade the message with one version of the rules
+        rules = rule_book().current
+        for routing_key, data in faults:
+            self.process_fault(data, routing_key, rules)
 
-                # Define severity based on fault_flags
-                def calculate_severity(flags):
-                    severity_map = {
-                        FAULT_SENSOR_NOT_WORKING: 2,  # Bit 0
-                        FAULT_CALIBRATION_ERROR: 2,   # Bit 1
-                        FAULT_TEMP_HIGH: 2,           # Bit 2
-                        FAULT_HUM_HIGH: 2,            # Bit 3
-                        FAULT_CO2_LOW: 1,             # Bit 4
-                        FAULT_CO2_HIGH: 2,            # Bit 5
-                        FAULT_POWER_NOT_WORKING: 3,   # Bit 6
-                        FAULT_POWER_SPIKE: 3,         # Bit 7
-                        FAULT_PRESENCE_NOT_READING: 2 # Bit 8
+    def process_fault(self, data, routing_key, rules):
+        try:
+            fault_time, floor, room, device_faults = parse_fault_message(data, routing_key, rules)
+        except MALFORMED_ERRORS as e:
+            log.error("Dropping malformed fault from %s: %s", routing_key, e)
+            return
+        # Database errors propagate, so the runtime has the message redelivered
+        try:
+            # Insert one fault per device type using ORM
+            for device_type, flags in device_faults:
+                started = time.perf_counter()
+                fault_obj, created = EquipmentFault.objects.get_or_create(
+                    time=fault_time,
+                    floor=floor,
+                    room=room,
+                    device_type=device_type,
+                    defaults={
+                        'id': generate_unique_id(data['timestamp']),
+                        'fault_flags': flags,
+                        'severity': calculate_severity(flags, rules),
+                        'resolved': False
                     }
-                    max_severity = 0
-                    for fault, severity in severity_map.items():
-                        if flags & fault:
-                            max_severity = max(max_severity, severity)
-                    return max_severity or 1  # Default to 1 if no flags
+                )
+                DB_WRITE_SECONDS.labels('equipment_faults').observe(time.perf_counter() - started)
+                log.fault("Inserted %s fault", DEVICE_LABELS[device_type],
+                          time=fault_time, floor=floor, room=room, fault_flags=flags, id=fault_obj.id, created=created)
+                correlated = 0
+                if created and self.incidents.enabled:
+                    # Counted once, not again when a redelivery finds the row
+                    correlated = self.incidents.add(data['timestamp'], floor, room, device_type, flags)
+                    if correlated:
+                        FAULTS_CORRELATED.labels(device_type).inc()
+                        log.sampled('fault_correlated', "%s fault is part of an incident", DEVICE_LABELS[device_type],
+                                    floor=floor, room=room, fault_flags=correlated)
+                if not correlated:
+                    # Faults of an incident go to Supabase with it, linked, from flush_incidents()
+                    self.sync.add('equipment_faults', [SupabaseService.fault_data(fault_obj)])
+        except DataError as e:
+            # Values the table cannot hold will not fit on a redelivery either
+            log.error("Dropping fault from %s: %s", routing_key, e)
+        except DatabaseError:
+            # Reconnect on the next try if the connection went down with the database
+            close_old_connections()
+            raise
 
-                # Generate a unique ID within 32-bit integer range
-                def generate_unique_id(timestamp):
-                    # Use last 7 digits of timestamp (max 9999999) plus a random 3-digit number
-                    timestamp_part = timestamp % 10000000  # Up to 7 digits
-                    random_part = random.randint(0, 999)   # 3 digits
-                    # Combine: timestamp_part * 1000 + random_part (max ~9,999,999,999)
-                    # Ensure it fits in 32-bit signed int (max 2,147,483,647)
-                    unique_id = (timestamp_part * 1000 + random_part) % 2147483647
-                    return unique_id if unique_id > 0 else 1  # Ensure non-zero
+    async def sync_supabase_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.sync.flush)
 
-                # Insert faults using ORM
-                if iaq_flags:
-                    severity = calculate_severity(iaq_flags)
-                    fault_obj, created = EquipmentFault.objects.get_or_create(
-                        time=fault_time,
-                        floor=floor,
-                        room=room,
-                        device_type='iaq',
-                        defaults={
-                            'id': generate_unique_id(data['timestamp']),
-                            'fault_flags': iaq_flags,
-                            'severity': severity,
-                            'resolved': False
-                        }
-                    )
-                    self.stdout.write(f"Inserted IAQ fault: time={fault_time}, floor={floor}, room={room}, fault_flags={iaq_flags}")
-                    print(f"About to sync fault {fault_obj.id} to Supabase")
-                    supabase = SupabaseService()
-                    supabase.sync_fault(fault_obj)
-                    print(f"Supabase sync result: {fault_obj.id}")
+    async def flush_incidents_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.flush_incidents)
 
-                if power_flags:
-                    severity = calculate_severity(power_flags)
-                    fault_obj, created = EquipmentFault.objects.get_or_create(
-                        time=fault_time,
-                        floor=floor,
-                        room=room,
-                        device_type='power',
-                        defaults={
-                            'id': generate_unique_id(data['timestamp']),
-                            'fault_flags': power_flags,
-                            'severity': severity,
-                            'resolved': False
-                        }
-                    )
-                    self.stdout.write(f"Inserted Power fault: time={fault_time}, floor={floor}, room={room}, fault_flags={power_flags}")
-                    print(f"About to sync fault {fault_obj.id} to Supabase")
-                    supabase = SupabaseService()
-                    supabase.sync_fault(fault_obj)
-                    print(f"Supabase sync result: {fault_obj.id}")
+    def flush_incidents(self):
+        """
+        Creates and updates the incidents that changed with one query each, links their
+        new faults and settles their resolved flag, then queues them and the newly linked
+        faults for Supabase.
+        """
+        changes = self.incidents.flush(time.time())
+        if not changes:
+            return
+        rules = rule_book().current
+        created, updated = [], []
+        for group, snapshot in changes:
+            incident = Incident(
+                id=snapshot['incident_id'],
+                floor=snapshot['floor'],
+                device_type=snapshot['device_type'],
+                fault_flags=snapshot['fault_flags'],
+                severity=calculate_severity(snapshot['fault_flags'], rules),
+                started_at=datetime.fromtimestamp(snapshot['started'], tz=BANGKOK),
+                last_seen=datetime.fromtimestamp(snapshot['last_seen'], tz=BANGKOK),
+                rooms=snapshot['rooms'],
+                fault_count=snapshot['fault_count'],
+                active=snapshot['active'],
+            )
+            (updated if incident.id else created).append((group, incident))
+        started = time.perf_counter()
+        try:
+            Incident.objects.bulk_create([incident for _, incident in created])
+            Incident.objects.bulk_update([incident for _, incident in updated], INCIDENT_UPDATE_FIELDS)
+            for group, incident in created:
+                group.incident_id = incident.id
+            ids = [incident.id for _, incident in created + updated]
+            linked = link_incident_faults(ids)
+            settle_incidents(ids=ids)
+            # As stored, resolved flag included
+            incidents = list(Incident.objects.filter(id__in=ids))
+        except Exception as e:
+            log.error("Error writing %d incidents: %s", len(changes), e)
+            self.incidents.retry(changes)
+            return
+        DB_WRITE_SECONDS.labels('fault_incidents').observe(time.perf_counter() - started)
+        log.info("Wrote incidents", created=len(created), updated=len(updated), linked=len(linked))
+        self.sync.add('fault_incidents', [SupabaseService.incident_data(incident) for incident in incidents])
+        self.sync.add('equipment_faults', [SupabaseService.fault_data(fault) for fault in linked])
+
+    def handle(self, *args, **options):
+        self.stdout.write("Starting RabbitMQ fault consumer...")
 
-                if presence_flags:
-                    severity = calculate_severity(presence_flags)
-                    fault_obj, created = EquipmentFault.objects.get_or_create(
-                        time=fault_time,
-                        floor=floor,
-                        room=room,
-                        device_type='presence',
-                        defaults={
-                            'id': generate_unique_id(data['timestamp']),
-                            'fault_flags': presence_flags,
-                            'severity': severity,
-                            'resolved': False
-                        }
-                    )
-                    self.stdout.write(f"Inserted Presence fault: time={fault_time}, floor={floor}, room={room}, fault_flags={presence_flags}")
-                    print(f"About to sync fault {fault_obj.id} to Supabase")
-                    supabase = SupabaseService()
-                    supabase.sync_fault(fault_obj)
-                    print(f"Supabase sync result: {fault_obj.id}")
-            except Exception as e:
-                self.stderr.write(f"Error processing message: {str(e)}")
+        runtime = AsyncConsumerRuntime(max_in_flight=options['max_in_flight'])
+        self.register(runtime)
+        start_metrics_server(9103, options['metrics_port'])
+        profiling.install('consume_faults')
 
-        channel.basic_consume(queue='fault_queue', on_message_callback=callback, auto_ack=True)
         self.stdout.write("Fault consumer started, listening for messages...")
-        channel.start_consuming()
\ No newline at end of file
+        runtime.run_forever()
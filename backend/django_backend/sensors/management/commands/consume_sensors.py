@@ -1,155 +1,178 @@
-
-import json
-import pika
 from django.core.management.base import BaseCommand
-from datetime import datetime
-import pytz
-import hashlib
-import time
-import random
+import asyncio
 import logging
-from django.db import IntegrityError, transaction
-from django.db.models import F
-from sensors.models import SensorReading
+import os
+from datetime import timedelta
+from django.db import DatabaseError, DataError, close_old_connections
+from django.db.models import Count, Max
+from sensors.models import SensorReading, ThresholdOverride
 from sensors.supabase_service import SupabaseService
+from sensors.sync import SyncQueue
+from sensors.autoresolve import HealthTracker
+from sensors.resolve import resolve_healthy, settle_incidents, unresolved_keys
+from sensors.ingest import MALFORMED_ERRORS, parse_sensor_message, generate_unique_id
+from hotel_common import profiling
+from hotel_common import wire
+from hotel_common.aio_consumer import AsyncConsumerRuntime
+from hotel_common.fault_rules import rule_book
+from hotel_common.log import get_logger
+from hotel_common.metrics import DB_WRITE_SECONDS, start_metrics_server
+import time
+
+log = get_logger('consume_sensors')
 
-logger = logging.getLogger(__name__)
+# Faults arrive out of order across rooms, so look back a little past the newest one seen
+UNRESOLVED_OVERLAP = timedelta(minutes=5)
 
 class Command(BaseCommand):
     help = 'Consumes sensor messages from RabbitMQ and stores them in TimescaleDB and Supabase'
 
-    def connect_rabbitmq(self):
-        while True:
+    def add_arguments(self, parser):
+        parser.add_argument('--max-in-flight', type=int, default=None, help='Maximum number of messages processed concurrently')
+        parser.add_argument('--metrics-port', type=int, default=None, help='Port for /metrics (default METRICS_PORT or 9102, 0 disables)')
+
+    def register(self, runtime):
+        runtime.add_handler('sensor_queue', self.process_message, 'hotel_sensors', '*.*.*')
+        # Readings reach Supabase in batches, retried apart from the message acks
+        self.sync = SyncQueue(SupabaseService().upsert)
+        runtime.add_periodic(float(os.getenv('SUPABASE_SYNC_INTERVAL', '2')), self.sync_supabase_async)
+        # Faults of sensors that read healthy again are resolved in batches
+        self.health = HealthTracker()
+        self.newest_fault = None
+        self.full_refresh_at = 0
+        self.overrides_version = None
+        if self.health.enabled:
+            runtime.add_periodic(float(os.getenv('AUTO_RESOLVE_INTERVAL', '5')), self.auto_resolve_async)
+            runtime.add_periodic(float(os.getenv('THRESHOLD_REFRESH_INTERVAL', '60')), self.refresh_overrides_async)
+            runtime.add_periodic(float(os.getenv('FAULT_RULES_RELOAD_INTERVAL', '5')), rule_book().reload_async)
+
+    def process_message(self, delivery):
+        body = delivery.body
+        log.sampled('reading_received', "Received message: %s", body, level=logging.DEBUG)
+        try:
+            # JSON or binary by content_type, one reading or an envelope of many
+            readings = wire.decode_all(delivery.routing_key.rsplit('.', 1)[-1], body,
+                                       delivery.content_type, delivery.routing_key)
+        except Exception as e:
+            log.error("Error processing message: %s", e)
+            return
+        for routing_key, data in readings:
+            self.process_reading(data, routing_key)
+
+    def process_reading(self, data, routing_key):
+        try:
+            fields = parse_sensor_message(data, routing_key)
+        except MALFORMED_ERRORS as e:
+            log.error("Dropping malformed reading from %s: %s", routing_key, e)
+            return
+        thailand_dt = fields['time']
+        sensor_id = fields['sensor_id']
+        sensor_type = fields['sensor_type']
+        floor = fields['floor']
+        room = fields['room']
+
+        # Database errors propagate, so the runtime has the message redelivered
+        started = time.perf_counter()
+        try:
+            # Try to find existing record with these keys
             try:
-                credentials = pika.PlainCredentials('guest', 'guest')
-                connection = pika.BlockingConnection(
-                    pika.ConnectionParameters(host='rabbitmq', credentials=credentials)
+                sensor_obj = SensorReading.objects.get(
+                    time=thailand_dt,
+                    sensor_id=sensor_id
                 )
-                return connection
-            except Exception as e:
-                self.stderr.write(f"RabbitMQ connection failed: {e}, retrying in 5s...")
-                time.sleep(5)
+
+                # Update specific fields based on sensor type
+                if sensor_type == 'iaq':
+                    sensor_obj.temperature = fields['temperature']
+                    sensor_obj.humidity = fields['humidity']
+                    sensor_obj.co2 = fields['co2']
+                elif sensor_type == 'power':
+                    sensor_obj.power = fields['power']
+                elif sensor_type == 'presence':
+                    sensor_obj.presence = fields['presence']
+
+                sensor_obj.save()
+                log.sampled('reading_updated', "Updated sensor reading", time=thailand_dt, floor=floor, room=room,
+                            sensor_type=sensor_type, sensor_id=sensor_id)
+
+            except SensorReading.DoesNotExist:
+                # Create new record with explicitly generated ID
+                sensor_obj = SensorReading.objects.create(id=generate_unique_id(data['timestamp']), **fields)
+                log.sampled('reading_inserted', "Inserted new sensor reading", time=thailand_dt, floor=floor, room=room,
+                            sensor_type=sensor_type, sensor_id=sensor_id)
+        except DataError as e:
+            # Values the table cannot hold will not fit on a redelivery either
+            log.error("Dropping reading from %s: %s", routing_key, e)
+            return
+        except DatabaseError:
+            # Reconnect on the next try if the connection went down with the database
+            close_old_connections()
+            raise
+
+        DB_WRITE_SECONDS.labels('sensors_data').observe(time.perf_counter() - started)
+        if self.health.enabled:
+            self.health.observe(rule_book().current, floor, room, sensor_type, data)
+
+        # Stored, so the message can be acked; Supabase catches up on the next sync
+        self.sync.add('sensors_data', [SupabaseService.sensor_data(sensor_obj)])
+
+    async def sync_supabase_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.sync.flush)
+
+    async def auto_resolve_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.auto_resolve)
+
+    async def refresh_overrides_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.refresh_overrides)
+
+    def refresh_overrides(self):
+        """Reloads the threshold overrides, like the detector's OverrideLoader only when the table changed."""
+        version = ThresholdOverride.objects.aggregate(count=Count('id'), newest=Max('updated_at'))
+        if version == self.overrides_version:
+            return
+        self.health.set_overrides(ThresholdOverride.by_scope())
+        self.overrides_version = version
+
+    def auto_resolve(self):
+        """Picks up newly unresolved faults, then resolves the ready ones with one UPDATE."""
+        if self.overrides_version is None:
+            self.refresh_overrides()
+        if time.monotonic() >= self.full_refresh_at:
+            # Now and then all of them, for faults that arrived late or outlived a resolution
+            self.newest_fault = None
+            self.full_refresh_at = time.monotonic() + float(os.getenv('AUTO_RESOLVE_REFRESH', '300'))
+        newer_than = self.newest_fault - UNRESOLVED_OVERLAP if self.newest_fault else None
+        keys = unresolved_keys(newer_than)
+        if keys:
+            self.health.track(keys)
+            newest = max(keys.values())
+            self.newest_fault = max(newest, self.newest_fault) if self.newest_fault else newest
+
+        cutoffs = self.health.take()
+        if not cutoffs:
+            return
+        started = time.perf_counter()
+        try:
+            faults = resolve_healthy(cutoffs)
+            incidents = settle_incidents(faults=faults) if faults else []
+        except Exception as e:
+            log.error("Error auto-resolving faults of %d sensors: %s", len(cutoffs), e)
+            # Tracked again from the database on the next run
+            self.full_refresh_at = 0
+            return
+        DB_WRITE_SECONDS.labels('equipment_faults').observe(time.perf_counter() - started)
+        log.info("Auto-resolved faults of sensors reading healthy again", sensors=len(cutoffs), faults=len(faults))
+        self.sync.add('equipment_faults', [SupabaseService.fault_data(fault) for fault in faults])
+        self.sync.add('fault_incidents', [SupabaseService.incident_data(incident) for incident in incidents])
 
     def handle(self, *args, **options):
         self.stdout.write("Starting RabbitMQ sensor consumer...")
-        
-        rabbitmq_connection = self.connect_rabbitmq()
-        channel = rabbitmq_connection.channel()
 
-        channel.exchange_declare(exchange='hotel_sensors', exchange_type='topic')
-        channel.queue_declare(queue='sensor_queue', durable=True)
-        channel.queue_bind(queue='sensor_queue', exchange='hotel_sensors', routing_key='*.*.*')
+        runtime = AsyncConsumerRuntime(max_in_flight=options['max_in_flight'])
+        self.register(runtime)
+        start_metrics_server(9102, options['metrics_port'])
+        profiling.install('consume_sensors')
 
-        self.stdout.write("Connected to RabbitMQ, waiting for sensor messages...")
-
-        def callback(ch, method, properties, body):
-            self.stdout.write(f"Received message: {body}")
-            try:
-                data = json.loads(body)
-                self.stdout.write(f"Parsed data: {data}")
-                
-                if 'timestamp' not in data:
-                    raise ValueError("Missing 'timestamp' field in message")
-                timestamp = data['timestamp']
-                # Convert Unix timestamp to Asia/Bangkok timezone
-                thailand_dt = datetime.fromtimestamp(timestamp, tz=pytz.timezone('Asia/Bangkok'))
-
-                # Parse floor, room, and sensor_type from routing key
-                routing_key = method.routing_key
-                parts = routing_key.split('.')
-                if len(parts) != 3:
-                    raise ValueError(f"Invalid routing key format: {routing_key}")
-                
-                floor_str, room_str, sensor_type = parts
-                try:
-                    floor = int(floor_str.replace('floor', ''))
-                    room = int(room_str.replace('room', ''))
-                except ValueError:
-                    raise ValueError(f"Could not parse floor/room from: {routing_key}")
-                
-                valid_sensor_types = {'iaq', 'power', 'presence'}
-                if sensor_type not in valid_sensor_types:
-                    raise ValueError(f"Invalid sensor_type: {sensor_type}")
-
-                # Generate sensor_id
-                sensor_id_str = f"{floor}:{room}:{sensor_type}"
-                sensor_id = int(hashlib.sha256(sensor_id_str.encode()).hexdigest(), 16) % 10**10
-
-                # Extract sensor-specific fields
-                temperature = data.get('temperature') if sensor_type == 'iaq' else None
-                humidity = data.get('humidity') if sensor_type == 'iaq' else None
-                co2 = data.get('co2') if sensor_type == 'iaq' else None
-                power = data.get('power_kw') if sensor_type == 'power' else None
-                presence = data.get('presence') if sensor_type == 'presence' else None
-
-                if presence is not None and presence not in {0, 1, 2, 3}:
-                    raise ValueError(f"Invalid presence value: {presence}")
-
-                # Generate a unique ID within 32-bit integer range
-                def generate_unique_id(timestamp):
-                    # Use last 7 digits of timestamp (max 9999999) plus a random 3-digit number
-                    timestamp_part = int(timestamp) % 10000000  # Up to 7 digits
-                    random_part = random.randint(0, 999)   # 3 digits
-                    # Combine: timestamp_part * 1000 + random_part (max ~9,999,999,999)
-                    # Ensure it fits in 32-bit signed int (max 2,147,483,647)
-                    unique_id = (timestamp_part * 1000 + random_part) % 2147483647
-                    return unique_id if unique_id > 0 else 1  # Ensure non-zero
-
-                # Try to find existing record with these keys
-                try:
-                    sensor_obj = SensorReading.objects.get(
-                        time=thailand_dt,
-                        sensor_id=sensor_id
-                    )
-                    
-                    # Update specific fields based on sensor type
-                    if sensor_type == 'iaq':
-                        sensor_obj.temperature = temperature
-                        sensor_obj.humidity = humidity
-                        sensor_obj.co2 = co2
-                    elif sensor_type == 'power':
-                        sensor_obj.power = power
-                    elif sensor_type == 'presence':
-                        sensor_obj.presence = presence
-                    
-                    sensor_obj.save()
-                    self.stdout.write(f"Updated sensor reading: time={thailand_dt}, floor={floor}, room={room}, sensor_type={sensor_type}, sensor_id={sensor_id}")
-                
-                except SensorReading.DoesNotExist:
-                    # Create new record with explicitly generated ID
-                    unique_id = generate_unique_id(timestamp)
-                    sensor_obj = SensorReading.objects.create(
-                        id=unique_id,
-                        time=thailand_dt,
-                        sensor_id=sensor_id,
-                        temperature=temperature,
-                        humidity=humidity,
-                        co2=co2,
-                        power=power,
-                        presence=presence,
-                        sensor_type=sensor_type,
-                        floor=floor,
-                        room=room
-                    )
-                    self.stdout.write(f"Inserted new sensor reading: time={thailand_dt}, floor={floor}, room={room}, sensor_type={sensor_type}, sensor_id={sensor_id}")
-
-                # Sync to Supabase
-                if sensor_obj:
-                    print(f"About to sync sensor reading {sensor_obj.id} to Supabase")
-                    supabase = SupabaseService()
-                    supabase.sync_sensor_data(sensor_obj)
-                    print(f"Supabase sync result for floor={floor}, room={room}, sensor_type={sensor_type}: {sensor_obj.id}")
-
-            except Exception as e:
-                self.stderr.write(f"Error processing message: {str(e)}")
-
-        channel.basic_consume(queue='sensor_queue', on_message_callback=callback, auto_ack=True)
         self.stdout.write("Sensor consumer started, listening for messages...")
-        try:
-            channel.start_consuming()
-        except KeyboardInterrupt:
-            self.stdout.write("Shutting down sensor consumer...")
-            rabbitmq_connection.close()
-        except Exception as e:
-            self.stderr.write(f"Unexpected error in consumer: {e}")
-            rabbitmq_connection.close()
\ No newline at end of file
+        runtime.run_forever()
+        self.stdout.write("Shutting down sensor consumer...")
@@ -0,0 +1,289 @@
+import os
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, connections, transaction
+from django.utils.dateparse import parse_date, parse_datetime
+
+from sensors.ingest import BANGKOK
+from sensors.models import ThresholdOverride
+from hotel_common.fault_rules import RuleBook, rule_book
+from hotel_common.log import get_logger
+
+log = get_logger('redetect_faults')
+
+SHADOW_TABLE = 'equipment_faults_recomputed'
+TARGETS = ('shadow', 'equipment_faults')
+
+# Reading field in fault_rules.json -> sensors_sensorreading column
+COLUMNS = {'power_kw': 'power'}
+FAULT_COLUMNS = ('id', 'time', 'floor', 'room', 'device_type', 'fault_flags', 'severity', 'resolved')
+
+# Set in every worker by _init_worker: rules, overrides, options
+_worker = {}
+
+
+def fault_id(fault_time, floor, room, device_type):
+    """Stable id within 32-bit range, so re-runs over the same readings write the same ids."""
+    key = f"{fault_time.timestamp()}:{floor}:{room}:{device_type}".encode()
+    return zlib.crc32(key) & 0x7fffffff or 1
+
+
+def rule_fields(rules, sensor_type):
+    return sorted({field for spec in rules.rule_specs[sensor_type] for field in spec[1]})
+
+
+def evaluate(rules, sensor_type, floors, rooms, columns, overrides, scopes):
+    """Fault flags of one batch; rooms with the same effective thresholds are evaluated together."""
+    if not overrides:
+        return rules.evaluate_batch(sensor_type, columns)
+    groups = defaultdict(list)
+    for index, scope in enumerate(zip(floors, rooms)):
+        thresholds = scopes.get(scope)
+        if thresholds is None:
+            resolved = rules.resolve_thresholds(overrides, scope[0], scope[1], sensor_type)
+            thresholds = scopes[scope] = tuple(sorted(resolved.items()))
+        groups[thresholds].append(index)
+    if len(groups) == 1:
+        return rules.evaluate_batch(sensor_type, columns, dict(next(iter(groups))))
+    flags = [0] * len(floors)
+    for thresholds, indexes in groups.items():
+        subset = {field: [values[i] for i in indexes] for field, values in columns.items()}
+        for index, value in zip(indexes, rules.evaluate_batch(sensor_type, subset, dict(thresholds))):
+            flags[index] = value
+    return flags
+
+
+def scan(rules, sensor_type, start, end, batch_size, overrides):
+    """
+    Reads one sensor type's readings in [start, end) through a server-side cursor,
+    batch_size rows at a time; yields (time, floor, room, flags) for the faulty ones.
+    """
+    fields = rule_fields(rules, sensor_type)
+    columns = [COLUMNS.get(field, field) for field in fields]
+    not_null = ' AND '.join(f"{column} IS NOT NULL" for column in columns)
+    query = (f"SELECT time, floor, room, {', '.join(columns)} FROM sensors_sensorreading "
+             f"WHERE time >= %s AND time < %s AND sensor_type = %s AND {not_null}")
+    scopes = {}
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(query, [start, end, sensor_type])
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            times, floors, rooms, *values = zip(*rows)
+            flags = evaluate(rules, sensor_type, floors, rooms, dict(zip(fields, values)), overrides, scopes)
+            yield len(rows), [(times[i], floors[i], rooms[i], value) for i, value in enumerate(flags) if value]
+
+
+def stage_faults(cursor, rows):
+    """COPYs one batch of faults into the transaction's staging table."""
+    with cursor.cursor.copy(f"COPY redetected ({', '.join(FAULT_COLUMNS)}) FROM STDIN") as copy:
+        for row in rows:
+            copy.write_row(row)
+
+
+def merge_faults(cursor, table, start, end, replace_mask, tolerance):
+    """
+    Merges the staged faults of one time range into table. Live faults carry the
+    timestamp of the reading they were raised for, truncated to the second, so each
+    staged fault is matched with the nearest fault of its room and device type
+    within tolerance seconds; matched rows get the new flags and keep their
+    resolved state, the others are inserted.
+    With replace_mask, unresolved rows in the range that only carry those bits and
+    were not matched are deleted first; rows within tolerance of the range's ends
+    may belong to a neighbouring range and are left alone.
+    """
+    column_list = ', '.join(FAULT_COLUMNS)
+    cursor.execute(
+        "CREATE TEMP TABLE matched ON COMMIT DROP AS "
+        "SELECT r.*, m.time AS live_time, m.id AS live_id FROM redetected r LEFT JOIN LATERAL ("
+        f"  SELECT f.time, f.id FROM {table} f WHERE f.floor = r.floor AND f.room = r.room "
+        "  AND f.device_type = r.device_type "
+        "  AND f.time BETWEEN r.time - %(tolerance)s AND r.time + %(tolerance)s "
+        "  ORDER BY abs(extract(epoch FROM f.time - r.time)) LIMIT 1"
+        ") m ON true",
+        {'tolerance': tolerance})
+    cursor.execute(
+        f"UPDATE {table} f SET fault_flags = m.fault_flags, severity = m.severity FROM matched m "
+        "WHERE f.time = m.live_time AND f.id = m.live_id")
+    updated = cursor.rowcount
+    deleted = 0
+    if replace_mask:
+        cursor.execute(
+            f"DELETE FROM {table} f WHERE f.time >= %s AND f.time < %s AND NOT f.resolved "
+            "AND (f.fault_flags & ~%s) = 0 "
+            "AND NOT EXISTS (SELECT 1 FROM matched m WHERE m.live_time = f.time AND m.live_id = f.id)",
+            [start + tolerance, end - tolerance, replace_mask])
+        deleted = cursor.rowcount
+    cursor.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM matched WHERE live_id IS NULL")
+    return updated + cursor.rowcount, deleted
+
+
+def redetect_range(start, end):
+    """Re-detects one time range in one transaction; returns (start, readings, faults, written, deleted)."""
+    rules, overrides, options = _worker['rules'], _worker['overrides'], _worker['options']
+    readings = faults = written = deleted = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        if not options['dry_run']:
+            # Faults go to the server batch by batch, so a chunk never has to fit in memory
+            cursor.execute(f"CREATE TEMP TABLE redetected (LIKE {options['table']} INCLUDING DEFAULTS) ON COMMIT DROP")
+        for sensor_type in rules.rule_specs:
+            for count, batch in scan(rules, sensor_type, start, end, options['batch_size'], overrides):
+                readings += count
+                rows = [(fault_id(fault_time, floor, room, device_type), fault_time, floor, room,
+                         device_type, device_flags, rules.severity(device_flags), False)
+                        for fault_time, floor, room, flags in batch
+                        for device_type, device_flags in rules.split(flags)]
+                faults += len(rows)
+                if rows and not options['dry_run']:
+                    stage_faults(cursor, rows)
+        if not options['dry_run']:
+            replace_mask = 0
+            if options['replace']:
+                for specs in rules.rule_specs.values():
+                    for spec in specs:
+                        replace_mask |= spec[0].mask
+            written, deleted = merge_faults(cursor, options['table'], start, end, replace_mask,
+                                            timedelta(seconds=options['match_seconds']))
+    return start, readings, faults, written, deleted
+
+
+def _init_worker(options, overrides):
+    _worker['rules'] = RuleBook(options['rules']).current if options['rules'] else rule_book().current
+    _worker['overrides'] = overrides
+    _worker['options'] = options
+
+
+def _redetect_worker(bounds):
+    return redetect_range(*bounds)
+
+
+class Command(BaseCommand):
+    help = ('Re-runs the fault rules of hotel_common/fault_rules.json over the readings in sensors_sensorreading, '
+            'chunk by chunk, and merges the faults into a shadow table for comparison or into equipment_faults')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='First reading time (ISO date or datetime, Asia/Bangkok if no offset; default the oldest reading)')
+        parser.add_argument('--end', help='Re-detect readings before this time (default after the newest reading)')
+        parser.add_argument('--target', choices=TARGETS, default='shadow',
+                            help=f'Write to {SHADOW_TABLE} (default) or straight into equipment_faults')
+        parser.add_argument('--replace', action='store_true',
+                            help='Also delete unresolved threshold faults in the range the current rules no longer raise')
+        parser.add_argument('--match-seconds', type=float, default=1,
+                            help='How far apart a fault and the reading it was raised for may be stamped (default 1; '
+                                 'faults stored before they carried the reading time need about 60)')
+        parser.add_argument('--rules', help='fault_rules.json to evaluate (default FAULT_RULES_PATH)')
+        parser.add_argument('--no-overrides', action='store_true', help='Ignore fault_threshold_overrides')
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='Time chunks re-detected in parallel')
+        parser.add_argument('--chunk-hours', type=float, default=24,
+                            help='Time range per job when sensors_sensorreading is not a hypertable')
+        parser.add_argument('--batch-size', type=int, default=50000, help='Rows fetched from the server-side cursor at a time')
+        parser.add_argument('--dry-run', action='store_true', help='Evaluate and count, but write nothing')
+
+    def parse_time(self, value, name):
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            if day is None:
+                raise CommandError(f"--{name} must be an ISO date or datetime, got '{value}'")
+            parsed = datetime.combine(day, datetime.min.time())
+        return parsed if parsed.tzinfo else BANGKOK.localize(parsed)
+
+    def time_range(self, options):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT min(time), max(time) FROM sensors_sensorreading")
+            oldest, newest = cursor.fetchone()
+        start = self.parse_time(options['start'], 'start') if options['start'] else oldest
+        end = self.parse_time(options['end'], 'end') if options['end'] else newest and newest + timedelta(microseconds=1)
+        return start, end
+
+    def chunks(self, start, end, chunk_hours):
+        """The TimescaleDB chunks of sensors_sensorreading within [start, end), so each job scans whole chunks."""
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT range_start, range_end FROM timescaledb_information.chunks "
+                    "WHERE hypertable_name = 'sensors_sensorreading' AND range_end > %s AND range_start < %s "
+                    "ORDER BY range_start", [start, end])
+                bounds = [(max(lo, start), min(hi, end)) for lo, hi in cursor.fetchall()]
+        except DatabaseError as e:
+            log.warning("Could not list hypertable chunks, splitting by --chunk-hours: %s", e)
+            bounds = []
+        if bounds:
+            return bounds
+        step = timedelta(hours=chunk_hours)
+        bounds = []
+        while start < end:
+            bounds.append((start, min(start + step, end)))
+            start += step
+        return bounds
+
+    def prepare_target(self, table):
+        """Faults are matched by room, device type and time; equipment_faults has idx_faults_search for that."""
+        if table != SHADOW_TABLE:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {SHADOW_TABLE} "
+                           "(LIKE equipment_faults INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {SHADOW_TABLE}_search "
+                           f"ON {SHADOW_TABLE} (floor, room, device_type, time)")
+
+    def compare(self, start, end):
+        """Faults per device type in the shadow table next to equipment_faults for the same range."""
+        counts = defaultdict(lambda: [0, 0])
+        with connection.cursor() as cursor:
+            for index, table in enumerate(('equipment_faults', SHADOW_TABLE)):
+                cursor.execute(f"SELECT device_type, count(*) FROM {table} WHERE time >= %s AND time < %s "
+                               "GROUP BY device_type", [start, end])
+                for device_type, count in cursor.fetchall():
+                    counts[device_type][index] = count
+        for device_type, (live, recomputed) in sorted(counts.items()):
+            self.stdout.write(f"  {device_type:<10} equipment_faults {live:>10}  {SHADOW_TABLE} {recomputed:>10}")
+
+    def handle(self, *args, **options):
+        start, end = self.time_range(options)
+        if start is None or end is None or start >= end:
+            self.stdout.write("No readings to re-detect")
+            return
+        options['table'] = SHADOW_TABLE if options['target'] == 'shadow' else 'equipment_faults'
+        if not options['dry_run']:
+            self.prepare_target(options['table'])
+        overrides = {} if options['no_overrides'] else ThresholdOverride.by_scope()
+        bounds = self.chunks(start, end, options['chunk_hours'])
+        worker_options = {key: options[key]
+                          for key in ('rules', 'table', 'replace', 'match_seconds', 'batch_size', 'dry_run')}
+        self.stdout.write(f"Re-detecting {start} to {end} in {len(bounds)} chunks into {options['table']}"
+                          f"{' (dry run)' if options['dry_run'] else ''}...")
+
+        started = time.perf_counter()
+        totals = [0, 0, 0, 0]
+        processes = max(1, min(options['processes'], len(bounds)))
+        if processes > 1:
+            # Every worker opens its own connection; the parent's must not be shared across the fork
+            connections.close_all()
+            with Pool(processes, _init_worker, (worker_options, overrides)) as pool:
+                results = pool.imap_unordered(_redetect_worker, bounds)
+                self.collect(results, totals)
+        else:
+            _init_worker(worker_options, overrides)
+            self.collect((redetect_range(*chunk) for chunk in bounds), totals)
+
+        readings, faults, written, deleted = totals
+        elapsed = time.perf_counter() - started
+        log.info("Re-detected %d readings in %.1fs (%.0f readings/s)", readings, elapsed,
+                 readings / elapsed if elapsed else 0, faults=faults, written=written, deleted=deleted)
+        if options['target'] == 'shadow' and not options['dry_run']:
+            self.compare(start, end)
+        self.stdout.write(self.style.SUCCESS(
+            f"{readings} readings, {faults} faults, {written} written, {deleted} deleted"))
+
+    def collect(self, results, totals):
+        for chunk_start, readings, faults, written, deleted in results:
+            for index, value in enumerate((readings, faults, written, deleted)):
+                totals[index] += value
+            self.stdout.write(f"  chunk from {chunk_start}: {readings} readings, {faults} faults")
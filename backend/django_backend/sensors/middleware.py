@@ -0,0 +1,18 @@
+import time
+
+from hotel_common.metrics import API_REQUEST_SECONDS
+
+
+class RequestMetricsMiddleware:
+    """Records the latency of every request, labelled by URL name, method and status code."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        view = match.url_name if match and match.url_name else 'unmatched'
+        API_REQUEST_SECONDS.labels(view, request.method, response.status_code).observe(time.perf_counter() - started)
+        return response
@@ -0,0 +1,56 @@
+# Generated by Django 5.0.14 on 2026-10-18 23:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sensors', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EquipmentFault',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('time', models.DateTimeField()),
+                ('floor', models.SmallIntegerField()),
+                ('room', models.SmallIntegerField()),
+                ('device_type', models.TextField()),
+                ('fault_flags', models.IntegerField()),
+                ('severity', models.SmallIntegerField()),
+                ('resolved', models.BooleanField(default=False)),
+            ],
+            options={
+                'db_table': 'equipment_faults',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ThresholdOverride',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('floor', models.SmallIntegerField(blank=True, null=True)),
+                ('room', models.SmallIntegerField(blank=True, null=True)),
+                ('fault', models.TextField()),
+                ('threshold', models.FloatField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'fault_threshold_overrides',
+            },
+        ),
+        migrations.AlterModelOptions(
+            name='sensorreading',
+            options={'managed': False},
+        ),
+        migrations.AddConstraint(
+            model_name='thresholdoverride',
+            constraint=models.UniqueConstraint(fields=('floor', 'room', 'fault'), name='fault_threshold_overrides_scope_unique', nulls_distinct=False),
+        ),
+        migrations.AddConstraint(
+            model_name='thresholdoverride',
+            constraint=models.CheckConstraint(check=models.Q(('room__isnull', True), ('floor__isnull', False), _connector='OR'), name='fault_threshold_overrides_room_needs_floor'),
+        ),
+    ]
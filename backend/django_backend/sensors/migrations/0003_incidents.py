@@ -0,0 +1,38 @@
+# Generated by Django 5.0.14 on 2026-10-18 23:27
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sensors', '0002_threshold_overrides'),
+    ]
+
+    operations = [
+        migrations.AlterModelTable(
+            name='sensorreading',
+            table='sensors_sensorreading',
+        ),
+        migrations.CreateModel(
+            name='Incident',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('floor', models.SmallIntegerField()),
+                ('device_type', models.TextField()),
+                ('fault_flags', models.IntegerField()),
+                ('severity', models.SmallIntegerField()),
+                ('started_at', models.DateTimeField()),
+                ('last_seen', models.DateTimeField()),
+                ('rooms', django.contrib.postgres.fields.ArrayField(base_field=models.SmallIntegerField(), size=None)),
+                ('fault_count', models.IntegerField()),
+                ('active', models.BooleanField(default=True)),
+                ('resolved', models.BooleanField(default=False)),
+            ],
+            options={
+                'db_table': 'fault_incidents',
+                'indexes': [models.Index(fields=['floor', 'started_at'], name='fault_incidents_floor_idx'), models.Index(condition=models.Q(('resolved', False)), fields=['started_at'], name='fault_incidents_open_idx')],
+            },
+        ),
+    ]
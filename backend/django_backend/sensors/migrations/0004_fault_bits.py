@@ -0,0 +1,46 @@
+from django.db import migrations
+
+# equipment_faults is created outside Django (see benchmarks/schema.sql), so the
+# index is only added where the table exists.
+FORWARD = """
+CREATE OR REPLACE FUNCTION fault_bits(flags integer) RETURNS smallint[]
+LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE AS $$
+DECLARE
+    bits smallint[] := '{}';
+    bit smallint := 0;
+BEGIN
+    WHILE flags <> 0 AND bit < 31 LOOP
+        IF flags & 1 = 1 THEN
+            bits := bits || bit;
+        END IF;
+        flags := flags >> 1;
+        bit := bit + 1;
+    END LOOP;
+    RETURN bits;
+END
+$$;
+
+DO $$
+BEGIN
+    IF to_regclass('equipment_faults') IS NOT NULL THEN
+        CREATE INDEX IF NOT EXISTS idx_faults_bits ON equipment_faults USING gin (fault_bits(fault_flags));
+    END IF;
+END
+$$;
+"""
+
+REVERSE = """
+DROP INDEX IF EXISTS idx_faults_bits;
+DROP FUNCTION IF EXISTS fault_bits(integer);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sensors', '0003_incidents'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD, REVERSE),
+    ]
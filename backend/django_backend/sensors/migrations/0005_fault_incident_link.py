@@ -0,0 +1,37 @@
+from django.db import migrations
+
+# equipment_faults is created outside Django (see benchmarks/schema.sql), so the
+# column is only added where the table exists.
+FORWARD = """
+DO $$
+BEGIN
+    IF to_regclass('equipment_faults') IS NOT NULL THEN
+        ALTER TABLE equipment_faults ADD COLUMN IF NOT EXISTS incident_id BIGINT;
+        CREATE INDEX IF NOT EXISTS idx_faults_incident ON equipment_faults (incident_id)
+            WHERE incident_id IS NOT NULL;
+    END IF;
+END
+$$;
+"""
+
+REVERSE = """
+DROP INDEX IF EXISTS idx_faults_incident;
+DO $$
+BEGIN
+    IF to_regclass('equipment_faults') IS NOT NULL THEN
+        ALTER TABLE equipment_faults DROP COLUMN IF EXISTS incident_id;
+    END IF;
+END
+$$;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sensors', '0004_fault_bits'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARD, REVERSE),
+    ]
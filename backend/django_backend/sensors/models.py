@@ -1,3 +1,5 @@
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 from django.db.models import Q
 
@@ -32,6 +34,22 @@ class SensorReading(models.Model):
         return f"SensorReading object (id={self.id}, {self.time}, {self.sensor_id})"
 
 
+class FaultBits(models.Func):
+    """
+    fault_bits(fault_flags): the numbers of the set bits as smallint[], from the SQL
+    function of migration 0004. The GIN index idx_faults_bits covers this expression,
+    so containment and overlap filters on it do not scan the table.
+    """
+    function = 'fault_bits'
+    output_field = ArrayField(models.SmallIntegerField())
+
+
+class EquipmentFaultQuerySet(models.QuerySet):
+    def with_any_fault_bit(self, bits):
+        """Faults with at least one of the given fault bits set."""
+        return self.alias(fault_bits=FaultBits('fault_flags')).filter(fault_bits__overlap=list(bits))
+
+
 class EquipmentFault(models.Model):
     id = models.BigIntegerField(primary_key=True)
     time = models.DateTimeField()
@@ -41,6 +59,9 @@ class EquipmentFault(models.Model):
     fault_flags = models.IntegerField()
     severity = models.SmallIntegerField()
     resolved = models.BooleanField(default=False)
+    incident_id = models.BigIntegerField(null=True)  # The Incident of a fault storm, see migration 0005
+
+    objects = EquipmentFaultQuerySet.as_manager()
 
     class Meta:
         managed = False
@@ -59,7 +80,82 @@ class EquipmentFault(models.Model):
             models.Index(fields=['time'], name='equipment_faults_time_idx'),
             models.Index(fields=['floor', 'room', 'time'], name='idx_faults_search'),
             models.Index(fields=['severity'], condition=Q(resolved=False), name='idx_unresolved_faults'),
+            GinIndex(FaultBits('fault_flags'), name='idx_faults_bits'),
+            models.Index(fields=['incident_id'], condition=Q(incident_id__isnull=False), name='idx_faults_incident'),
+        ]
+
+    def __str__(self):
+        return f"EquipmentFault object (id={self.id}, {self.time}, floor{self.floor}.room{self.room}, {self.device_type})"
+
+class ThresholdOverride(models.Model):
+    """
+    Replaces a threshold of hotel_common/fault_rules.json for one room, a whole floor
+    (room unset) or the whole building (floor and room unset). The fault detection agent
+    loads the table in the background; the most specific override wins.
+    """
+    floor = models.SmallIntegerField(null=True, blank=True)
+    room = models.SmallIntegerField(null=True, blank=True)
+    fault = models.TextField()  # Fault name in fault_rules.json, e.g. power_spike
+    threshold = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'fault_threshold_overrides'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['floor', 'room', 'fault'],
+                name='fault_threshold_overrides_scope_unique',
+                nulls_distinct=False,
+            ),
+            models.CheckConstraint(
+                check=Q(room__isnull=True) | Q(floor__isnull=False),
+                name='fault_threshold_overrides_room_needs_floor',
+            ),
+        ]
+
+    @classmethod
+    def by_scope(cls):
+        """All overrides as {(floor, room): {fault name: threshold}}, as FaultRules.resolve_thresholds takes them."""
+        overrides = {}
+        for floor, room, fault, threshold in cls.objects.values_list('floor', 'room', 'fault', 'threshold'):
+            overrides.setdefault((floor, room), {})[fault] = threshold
+        return overrides
+
+    def clean(self):
+        from django.core.exceptions import ValidationError
+        from hotel_common.fault_rules import rule_book
+        if self.fault not in rule_book().current.faults:
+            raise ValidationError({'fault': f"Unknown fault '{self.fault}'"})
+
+    def __str__(self):
+        scope = 'all floors' if self.floor is None else f"floor{self.floor}" + (f".room{self.room}" if self.room is not None else '')
+        return f"ThresholdOverride({scope}, {self.fault} {self.threshold})"
+
+
+class Incident(models.Model):
+    """
+    A fault storm: the same fault on one floor from several rooms within
+    INCIDENT_WINDOW seconds of each other. consume_faults still stores one
+    equipment_faults row per room and links the rows by incident_id; the incident is
+    resolved once none of its faults is unresolved (sensors/resolve.py).
+    """
+    floor = models.SmallIntegerField()
+    device_type = models.TextField()
+    fault_flags = models.IntegerField()  # The single fault bit the rooms share
+    severity = models.SmallIntegerField()
+    started_at = models.DateTimeField()
+    last_seen = models.DateTimeField()
+    rooms = ArrayField(models.SmallIntegerField())
+    fault_count = models.IntegerField()
+    active = models.BooleanField(default=True)  # Still within the window of its last fault
+    resolved = models.BooleanField(default=False)
+
+    class Meta:
+        db_table = 'fault_incidents'
+        indexes = [
+            models.Index(fields=['floor', 'started_at'], name='fault_incidents_floor_idx'),
+            models.Index(fields=['started_at'], condition=Q(resolved=False), name='fault_incidents_open_idx'),
         ]
 
     def __str__(self):
-        return f"EquipmentFault object (id={self.id}, {self.time}, floor{self.floor}.room{self.room}, {self.device_type})"
\ No newline at end of file
+        return f"Incident(floor{self.floor}, {self.device_type} {self.fault_flags}, {len(self.rooms)} rooms)"
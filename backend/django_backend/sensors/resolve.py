@@ -0,0 +1,127 @@
+# Set-based fault resolution shared by the bulk resolve API and auto-resolution,
+# and the upkeep of the incidents the faults belong to.
+from datetime import datetime
+
+from django.db import connection
+
+from .ingest import BANGKOK
+from .models import EquipmentFault, Incident
+
+FIELDS = ('id', 'time', 'floor', 'room', 'device_type', 'fault_flags', 'severity', 'incident_id')
+
+# The faults of an incident: its fault bit, on its floor and device type, from its
+# rooms, between its first and last fault
+INCIDENT_FAULTS = ("fault.floor = incident.floor AND fault.device_type = incident.device_type "
+                   "AND fault.room = ANY(incident.rooms) AND (fault.fault_flags & incident.fault_flags) <> 0 "
+                   "AND fault.time BETWEEN incident.started_at AND incident.last_seen")
+
+
+def resolve_faults(conditions, params, source=None):
+    """
+    Marks every unresolved fault matching all SQL conditions resolved with one
+    UPDATE ... RETURNING; returns the resolved rows as EquipmentFault objects
+    for the Supabase sync. source is an optional FROM item the conditions join
+    against; its parameters come first in params.
+    """
+    where = ' AND '.join(['resolved = FALSE', *conditions])
+    from_clause = f" FROM {source}" if source else ''
+    with connection.cursor() as cursor:
+        cursor.execute(f"UPDATE equipment_faults SET resolved = TRUE{from_clause} WHERE {where} "
+                       f"RETURNING {', '.join(FIELDS)}", params)
+        rows = cursor.fetchall()
+    return [EquipmentFault(**dict(zip(FIELDS, row)), resolved=True) for row in rows]
+
+
+def filter_conditions(ids=None, floor=None, room=None, device_type=None, start_time=None, end_time=None,
+                      fault_mask=None):
+    """SQL conditions and parameters for resolve_faults() from the bulk resolve filters."""
+    conditions, params = [], []
+    if ids:
+        conditions.append('id = ANY(%s)')
+        params.append(list(ids))
+    for column, value in (('floor', floor), ('room', room), ('device_type', device_type)):
+        if value is not None:
+            conditions.append(f'{column} = %s')
+            params.append(value)
+    if start_time is not None:
+        conditions.append('time >= %s')
+        params.append(start_time)
+    if end_time is not None:
+        conditions.append('time <= %s')
+        params.append(end_time)
+    if fault_mask:
+        # The expression idx_faults_bits indexes
+        conditions.append('fault_bits(fault_flags) && %s::smallint[]')
+        params.append([bit for bit in range(31) if fault_mask >> bit & 1])
+    return conditions, params
+
+
+def unresolved_keys(newer_than=None):
+    """
+    {(floor, room, device_type): newest fault time} of the unresolved faults,
+    only those raised after newer_than if given.
+    """
+    query = "SELECT floor, room, device_type, max(time) FROM equipment_faults WHERE resolved = FALSE"
+    params = []
+    if newer_than is not None:
+        query += " AND time > %s"
+        params.append(newer_than)
+    with connection.cursor() as cursor:
+        cursor.execute(query + " GROUP BY floor, room, device_type", params)
+        return {(floor, room, device_type): newest for floor, room, device_type, newest in cursor.fetchall()}
+
+
+def resolve_healthy(cutoffs):
+    """
+    Resolves, per (floor, room, device_type), the faults raised before its Unix
+    timestamp in cutoffs, all in one UPDATE joined against the unnested keys.
+    """
+    keys = list(cutoffs)
+    source = ("unnest(%s::smallint[], %s::smallint[], %s::text[], %s::timestamptz[]) "
+              "AS healthy(healthy_floor, healthy_room, healthy_device_type, healthy_since)")
+    params = [[key[0] for key in keys], [key[1] for key in keys], [key[2] for key in keys],
+              [datetime.fromtimestamp(cutoffs[key], tz=BANGKOK) for key in keys]]
+    conditions = ['floor = healthy_floor', 'room = healthy_room', 'device_type = healthy_device_type',
+                  'time < healthy_since']
+    return resolve_faults(conditions, params, source)
+
+
+def link_incident_faults(ids):
+    """
+    Sets incident_id on the faults of the given incidents that are not linked yet;
+    a fault with bits in two incidents stays linked to the first. Returns the linked
+    rows as EquipmentFault objects for the Supabase sync.
+    """
+    columns = ', '.join(f'fault.{field}' for field in FIELDS + ('resolved',))
+    with connection.cursor() as cursor:
+        cursor.execute("UPDATE equipment_faults AS fault SET incident_id = incident.id "
+                       "FROM fault_incidents AS incident "
+                       f"WHERE incident.id = ANY(%s) AND fault.incident_id IS NULL AND {INCIDENT_FAULTS} "
+                       f"RETURNING {columns}",
+                       [list(ids)])
+        rows = cursor.fetchall()
+    return [EquipmentFault(**dict(zip(FIELDS + ('resolved',), row))) for row in rows]
+
+
+def settle_incidents(ids=None, faults=None):
+    """
+    Marks incidents resolved once none of their faults is unresolved, and unresolved
+    again when a new one joins. Checks the given incidents, or those on the floors and
+    device types of the given resolved faults; returns the incidents that changed.
+    """
+    if ids is not None:
+        condition, params = 'incident.id = ANY(%s)', [list(ids)]
+    else:
+        keys = sorted({(fault.floor, fault.device_type) for fault in faults})
+        condition = ("NOT incident.resolved AND (incident.floor, incident.device_type) IN "
+                     "(SELECT * FROM unnest(%s::smallint[], %s::text[]))")
+        params = [[key[0] for key in keys], [key[1] for key in keys]]
+    with connection.cursor() as cursor:
+        cursor.execute("UPDATE fault_incidents SET resolved = settled.resolved "
+                       "FROM (SELECT incident.id, NOT EXISTS (SELECT 1 FROM equipment_faults AS fault "
+                       f"WHERE fault.resolved = FALSE AND {INCIDENT_FAULTS}) AS resolved "
+                       f"FROM fault_incidents AS incident WHERE {condition}) AS settled "
+                       "WHERE fault_incidents.id = settled.id AND fault_incidents.resolved <> settled.resolved "
+                       "RETURNING fault_incidents.id", params)
+        changed = [row[0] for row in cursor.fetchall()]
+    return list(Incident.objects.filter(id__in=changed)) if changed else []
@@ -1,5 +1,6 @@
 from .models import EquipmentFault
 from rest_framework import serializers
+from hotel_common.fault_rules import rule_book
 
 class SensorReadingSerializer(serializers.Serializer):
     time = serializers.DateTimeField(format='%Y-%m-%dT%H:%M:%S%z')
@@ -22,5 +23,47 @@ class EquipmentFaultSerializer(serializers.Serializer):
     fault_flags = serializers.IntegerField()
     severity = serializers.IntegerField(min_value=1, max_value=3)  # SMALLINT, 1=red, 2=yellow, 3=normal
     resolved = serializers.BooleanField()
+    incident_id = serializers.IntegerField(allow_null=True, read_only=True)
 
-     
\ No newline at end of file
+class IncidentSerializer(serializers.Serializer):
+    id = serializers.IntegerField(read_only=True)
+    floor = serializers.IntegerField()
+    device_type = serializers.CharField()
+    fault_flags = serializers.IntegerField()
+    severity = serializers.IntegerField(min_value=1, max_value=3)
+    started_at = serializers.DateTimeField(format='%Y-%m-%dT%H:%M:%S%z')
+    last_seen = serializers.DateTimeField(format='%Y-%m-%dT%H:%M:%S%z')
+    rooms = serializers.ListField(child=serializers.IntegerField())
+    fault_count = serializers.IntegerField()
+    active = serializers.BooleanField()
+    resolved = serializers.BooleanField()
+
+class BulkResolveSerializer(serializers.Serializer):
+    """Faults to resolve: a list of ids and/or filters, at least one of them."""
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False, max_length=10000)
+    floor = serializers.IntegerField(required=False)
+    room = serializers.IntegerField(required=False)
+    device_type = serializers.CharField(required=False)
+    start_time = serializers.DateTimeField(required=False)
+    end_time = serializers.DateTimeField(required=False)
+    fault = serializers.CharField(required=False)  # Fault name in fault_rules.json, e.g. power_not_working
+    fault_bit = serializers.IntegerField(required=False, min_value=0, max_value=30)
+
+    def validate(self, data):
+        if not data:
+            raise serializers.ValidationError("Give ids or at least one filter")
+        if data.get('room') is not None and data.get('floor') is None:
+            raise serializers.ValidationError({'room': "A room needs a floor"})
+        if data.get('start_time') and data.get('end_time') and data['start_time'] > data['end_time']:
+            raise serializers.ValidationError({'end_time': "Must not be before start_time"})
+        fault_mask = 0
+        if 'fault' in data:
+            fault = rule_book().current.faults.get(data.pop('fault'))
+            if fault is None:
+                raise serializers.ValidationError({'fault': "Unknown fault"})
+            fault_mask |= fault.mask
+        if 'fault_bit' in data:
+            fault_mask |= 1 << data.pop('fault_bit')
+        if fault_mask:
+            data['fault_mask'] = fault_mask
+        return data
@@ -1,9 +1,11 @@
 from supabase import create_client
 from django.conf import settings
-import logging
 import os
+import time
+from hotel_common.log import get_logger
+from hotel_common.metrics import SUPABASE_SYNC_FAILURES, SUPABASE_SYNC_SECONDS
 
-logger = logging.getLogger(__name__)
+log = get_logger(__name__)
 
 class SupabaseService:
     def __init__(self):
@@ -11,36 +13,118 @@ class SupabaseService:
         self.supabase_key = os.environ.get('SUPABASE_KEY')
         
         if not self.supabase_url or not self.supabase_key:
-            print("WARNING: Supabase URL or Key not found in environment variables")
+            log.warning("Supabase URL or Key not found in environment variables")
             
         self.supabase = create_client(self.supabase_url, self.supabase_key)
 
-    
+    @staticmethod
+    def fault_data(fault):
+        data = {
+            'id': str(fault.id),
+            'time': fault.time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'floor': fault.floor,
+            'room': fault.room,
+            'device_type': fault.device_type,
+            'fault_flags': fault.fault_flags,
+            'severity': fault.severity,
+            'resolved': fault.resolved
+        }
+        if fault.incident_id:
+            data['incident_id'] = str(fault.incident_id)
+        return data
+
+    @staticmethod
+    def sensor_data(sensor_obj):
+        return {
+            'id': str(sensor_obj.id),
+            'time': sensor_obj.time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'sensor_id': sensor_obj.sensor_id,
+            'temperature': sensor_obj.temperature,
+            'humidity': sensor_obj.humidity,
+            'co2': sensor_obj.co2,
+            'power': sensor_obj.power,
+            'presence': sensor_obj.presence,
+            'sensor_type': sensor_obj.sensor_type,
+            'floor': sensor_obj.floor,
+            'room': sensor_obj.room
+        }
+
+    @staticmethod
+    def incident_data(incident):
+        return {
+            'id': str(incident.id),
+            'floor': incident.floor,
+            'device_type': incident.device_type,
+            'fault_flags': incident.fault_flags,
+            'severity': incident.severity,
+            'started_at': incident.started_at.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'last_seen': incident.last_seen.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'rooms': incident.rooms,
+            'fault_count': incident.fault_count,
+            'active': incident.active,
+            'resolved': incident.resolved
+        }
+
+    def upsert(self, table, rows):
+        """
+        Upserts rows to a Supabase table, one request per set of columns so a row
+        leaves the columns it does not carry as they are; raises when one fails.
+        """
+        by_columns = {}
+        for row in rows:
+            by_columns.setdefault(frozenset(row), []).append(row)
+        for group in by_columns.values():
+            started = time.perf_counter()
+            try:
+                self.supabase.table(table).upsert(group).execute()
+            except Exception:
+                SUPABASE_SYNC_FAILURES.labels(table).inc()
+                raise
+            SUPABASE_SYNC_SECONDS.labels(table).observe(time.perf_counter() - started)
+
+    def sync_faults(self, faults, batch_size=None):
+        """
+        Upserts many faults to Supabase, batch_size rows (default SUPABASE_BATCH_SIZE or 1000)
+        per request. Returns the number of faults synced.
+        """
+        batch_size = batch_size or int(os.getenv('SUPABASE_BATCH_SIZE', '1000'))
+        synced = 0
+        for offset in range(0, len(faults), batch_size):
+            batch = faults[offset:offset + batch_size]
+            try:
+                self.upsert('equipment_faults', [self.fault_data(fault) for fault in batch])
+                synced += len(batch)
+            except Exception as e:
+                log.error("Error syncing %d faults to Supabase: %s", len(batch), e)
+        return synced
+
     def sync_fault(self, fault):
         """
         Syncs a fault from TimescaleDB to Supabase
         """
+        started = time.perf_counter()
         try:
-            print(f"Attempting to sync fault {fault.id} to Supabase...")
-            time_with_tz = fault.time.strftime('%Y-%m-%dT%H:%M:%S%z')
-            fault_data = {
-                'id': str(fault.id),
-                'time': time_with_tz,
-                'floor': fault.floor,
-                'room': fault.room,
-                'device_type': fault.device_type,
-                'fault_flags': fault.fault_flags,
-                'severity': fault.severity,
-                'resolved': fault.resolved
-            }
-            
-            result = self.supabase.table('equipment_faults').upsert(fault_data).execute()
-            logger.info(f"Synced fault {fault.id} to Supabase")
-            print(f"Successfully synced fault {fault.id} to Supabase")
+            result = self.supabase.table('equipment_faults').upsert(self.fault_data(fault)).execute()
+            SUPABASE_SYNC_SECONDS.labels('equipment_faults').observe(time.perf_counter() - started)
+            log.sampled('fault_synced', "Synced fault %s to Supabase", fault.id)
             return result
         except Exception as e:
-            logger.error(f"Error syncing fault {fault.id} to Supabase: {str(e)}")
-            print(f"ERROR syncing fault {fault.id} to Supabase: {str(e)}")
+            SUPABASE_SYNC_FAILURES.labels('equipment_faults').inc()
+            log.error("Error syncing fault %s to Supabase: %s", fault.id, e)
+            return None
+
+    def sync_incidents(self, incidents):
+        """
+        Upserts a batch of incidents to Supabase in one request.
+        """
+        if not incidents:
+            return None
+        try:
+            self.upsert('fault_incidents', [self.incident_data(incident) for incident in incidents])
+            log.sampled('incidents_synced', "Synced %d incidents to Supabase", len(incidents))
+            return len(incidents)
+        except Exception as e:
+            log.error("Error syncing %d incidents to Supabase: %s", len(incidents), e)
             return None
 
     def sync_sensor_data(self, sensor_obj):
@@ -48,27 +132,13 @@ class SupabaseService:
         Syncs a sensor reading to Supabase.
         Using the same approach as sync_fault that works correctly.
         """
+        started = time.perf_counter()
         try:
-            print(f"Attempting to sync sensor reading {sensor_obj.sensor_id} at {sensor_obj.time} to Supabase...")
-            time_with_tz = sensor_obj.time.strftime('%Y-%m-%dT%H:%M:%S%z')
-            sensor_data = {
-                'id': str(sensor_obj.id),  
-                'time': time_with_tz,
-                'sensor_id': sensor_obj.sensor_id,
-                'temperature': sensor_obj.temperature,
-                'humidity': sensor_obj.humidity,
-                'co2': sensor_obj.co2,
-                'power': sensor_obj.power,
-                'presence': sensor_obj.presence,
-                'sensor_type': sensor_obj.sensor_type,
-                'floor': sensor_obj.floor,
-                'room': sensor_obj.room
-            }
-            result = self.supabase.table('sensors_data').upsert(sensor_data).execute()
-            logger.info(f"Synced sensor reading {sensor_obj.sensor_id} at {sensor_obj.time} to Supabase")
-            print(f"Successfully synced sensor reading {sensor_obj.sensor_id} at {sensor_obj.time} to Supabase")
+            result = self.supabase.table('sensors_data').upsert(self.sensor_data(sensor_obj)).execute()
+            SUPABASE_SYNC_SECONDS.labels('sensors_data').observe(time.perf_counter() - started)
+            log.sampled('reading_synced', "Synced sensor reading %s at %s to Supabase", sensor_obj.sensor_id, sensor_obj.time)
             return result
         except Exception as e:
-            logger.error(f"Error syncing sensor reading {sensor_obj.sensor_id} at {sensor_obj.time} to Supabase: {e}")
-            print(f"ERROR syncing sensor reading {sensor_obj.sensor_id} at {sensor_obj.time} to Supabase: {str(e)}")
-            return None
\ No newline at end of file
+            SUPABASE_SYNC_FAILURES.labels('sensors_data').inc()
+            log.error("Error syncing sensor reading %s at %s to Supabase: %s", sensor_obj.sensor_id, sensor_obj.time, e)
+            return None
@@ -0,0 +1,88 @@
+# Supabase mirroring for the consumers, off the path of the AMQP ack.
+# Kept free of ORM and broker imports, like ingest.py.
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from hotel_common.log import get_logger
+from hotel_common.metrics import SUPABASE_SYNC_DROPPED, SUPABASE_SYNC_PENDING
+
+log = get_logger('supabase_sync')
+
+
+class SyncQueue:
+    """
+    Rows already stored in TimescaleDB that still have to reach Supabase, per table.
+
+    The consumers ack a message once its database write has committed and add()
+    its rows here; flush() upserts them in batches of SUPABASE_BATCH_SIZE (default
+    1000) every SUPABASE_SYNC_INTERVAL seconds (default 2). A failed batch stays
+    queued, ahead of newer rows, for the next flush, so a Supabase outage delays
+    the mirror instead of stopping ingestion. A row added again before it was sent
+    goes out once, in its latest state. Beyond SUPABASE_SYNC_MAX_PENDING rows per
+    table (default 100000) the oldest are dropped and counted; the
+    sync_*_to_supabase commands backfill them, as they do rows still queued when
+    the consumer stops.
+    """
+
+    def __init__(self, upsert, batch_size=None, max_pending=None):
+        self.upsert = upsert  # upsert(table, rows), raises when the request fails
+        self.batch_size = batch_size or int(os.getenv('SUPABASE_BATCH_SIZE', '1000'))
+        self.max_pending = max_pending or int(os.getenv('SUPABASE_SYNC_MAX_PENDING', '100000'))
+        self.pending = {}  # table -> OrderedDict(row id -> row)
+        self.lock = threading.Lock()
+
+    def add(self, table, rows):
+        with self.lock:
+            queue = self.pending.setdefault(table, OrderedDict())
+            for row in rows:
+                queue.pop(row['id'], None)
+                queue[row['id']] = row
+            self._trim(table, queue)
+
+    def _trim(self, table, queue):
+        dropped = 0
+        while len(queue) > self.max_pending:
+            queue.popitem(last=False)
+            dropped += 1
+        if dropped:
+            SUPABASE_SYNC_DROPPED.labels(table).inc(dropped)
+            log.sampled('supabase_sync_dropped', "Supabase sync queue of %s is full, dropped %d rows",
+                        table, dropped, level=logging.WARNING)
+        SUPABASE_SYNC_PENDING.labels(table).set(len(queue))
+
+    def flush(self):
+        """Upserts everything queued; returns the number of rows synced."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        synced = 0
+        for table, queue in pending.items():
+            rows = list(queue.values())
+            for offset in range(0, len(rows), self.batch_size):
+                batch = rows[offset:offset + self.batch_size]
+                try:
+                    self.upsert(table, batch)
+                except Exception as e:
+                    log.error("Error syncing %d %s rows to Supabase, retrying on the next flush: %s",
+                              len(rows) - offset, table, e)
+                    self._requeue(table, rows[offset:])
+                    break
+                synced += len(batch)
+        with self.lock:
+            for table in pending:
+                SUPABASE_SYNC_PENDING.labels(table).set(len(self.pending.get(table, ())))
+        return synced
+
+    def _requeue(self, table, rows):
+        with self.lock:
+            newer = self.pending.get(table, OrderedDict())
+            # Rows added since the flush began are newer than the failed copies
+            queue = OrderedDict((row['id'], row) for row in rows if row['id'] not in newer)
+            queue.update(newer)
+            self.pending[table] = queue
+            self._trim(table, queue)
+
+    def pending_rows(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.pending.values())
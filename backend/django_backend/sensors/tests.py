@@ -1,3 +1,302 @@
-from django.test import TestCase
+from datetime import datetime, timezone
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+from rest_framework.test import APIRequestFactory
+
+from hotel_common.fault_rules import RuleBook
+from sensors.autoresolve import HealthTracker
+from sensors.incidents import IncidentCorrelator
+from sensors.models import EquipmentFault
+from sensors.resolve import filter_conditions
+from sensors.serializers import BulkResolveSerializer
+from sensors.views import FaultTrendsView, parse_fault_bits
+from sensors.supabase_service import SupabaseService
+from sensors.sync import SyncQueue
+
+RULES = RuleBook().current
+KEY = (1, 2, 'power')
+
+
+def power(timestamp, power_kw):
+    return {'timestamp': timestamp, 'power_kw': power_kw}
+
+
+class HealthTrackerTests(SimpleTestCase):
+    def observe(self, tracker, *readings):
+        for reading in readings:
+            tracker.observe(RULES, *KEY, reading)
+
+    def test_ready_after_healthy_readings_in_a_row(self):
+        tracker = HealthTracker(readings=3)
+        tracker.track([KEY])
+        self.observe(tracker, power(100, 10), power(105, 10))
+        self.assertEqual(tracker.take(), {})
+        self.observe(tracker, power(110, 10))
+        # Faults raised before the first healthy reading, on the readings' own clock
+        self.assertEqual(tracker.take(), {KEY: 100})
+        self.assertEqual(tracker.take(), {})
+
+    def test_faulty_reading_starts_again(self):
+        tracker = HealthTracker(readings=2)
+        tracker.track([KEY])
+        self.observe(tracker, power(100, 10), power(105, 50), power(110, 10))
+        self.assertEqual(tracker.take(), {})
+        self.observe(tracker, power(115, 10))
+        self.assertEqual(tracker.take(), {KEY: 110})
+
+    def test_untracked_keys_are_ignored(self):
+        tracker = HealthTracker(readings=1)
+        self.observe(tracker, power(100, 10))
+        self.assertEqual(tracker.take(), {})
+
+    def test_overrides_apply(self):
+        tracker = HealthTracker(readings=1)
+        tracker.track([KEY])
+        tracker.set_overrides({(1, 2): {'power_spike': 5}})
+        self.observe(tracker, power(100, 10))
+        self.assertEqual(tracker.take(), {})
+        tracker.set_overrides({})
+        self.observe(tracker, power(105, 10))
+        self.assertEqual(tracker.take(), {KEY: 105})
+
+
+class IncidentCorrelatorTests(SimpleTestCase):
+    def setUp(self):
+        self.spike = RULES.mask('power_spike')
+        self.silent = RULES.mask('power_silent')
+
+    def test_incident_from_min_rooms(self):
+        correlator = IncidentCorrelator(window=60, min_rooms=3)
+        self.assertEqual(correlator.add(100, 1, 1, 'power', self.spike), 0)
+        self.assertEqual(correlator.add(110, 1, 2, 'power', self.spike), 0)
+        self.assertEqual(correlator.flush(110), [])
+        self.assertEqual(correlator.add(120, 1, 3, 'power', self.spike | self.silent), self.spike)
+        [(group, snapshot)] = correlator.flush(120)
+        self.assertEqual(snapshot['rooms'], [1, 2, 3])
+        self.assertEqual((snapshot['started'], snapshot['last_seen']), (100, 120))
+        self.assertEqual(snapshot['fault_count'], 3)
+        self.assertTrue(snapshot['active'])
+        # Nothing changed since
+        self.assertEqual(correlator.flush(130), [])
+
+    def test_idle_incident_ends(self):
+        correlator = IncidentCorrelator(window=60, min_rooms=2)
+        correlator.add(100, 1, 1, 'power', self.spike)
+        correlator.add(100, 1, 2, 'power', self.spike)
+        [(group, _)] = correlator.flush(100)
+        group.incident_id = 7
+        [(_, snapshot)] = correlator.flush(200)
+        self.assertEqual(snapshot['incident_id'], 7)
+        self.assertFalse(snapshot['active'])
+        # A later fault starts a new group
+        self.assertEqual(correlator.add(300, 1, 1, 'power', self.spike), 0)
+
+    def test_other_floors_and_bits_are_separate(self):
+        correlator = IncidentCorrelator(window=60, min_rooms=2)
+        correlator.add(100, 1, 1, 'power', self.spike)
+        self.assertEqual(correlator.add(100, 2, 1, 'power', self.spike), 0)
+        self.assertEqual(correlator.add(100, 1, 2, 'power', self.silent), 0)
+
+    def test_retry_after_failed_flush(self):
+        correlator = IncidentCorrelator(window=60, min_rooms=2)
+        correlator.add(100, 1, 1, 'power', self.spike)
+        correlator.add(100, 1, 2, 'power', self.spike)
+        changes = correlator.flush(200)
+        correlator.retry(changes)
+        self.assertEqual([snapshot for _, snapshot in correlator.flush(200)], [snapshot for _, snapshot in changes])
+
+
+class FaultDataTests(SimpleTestCase):
+    def fault(self, incident_id=None):
+        return EquipmentFault(id=5, time=datetime(2026, 1, 1, tzinfo=timezone.utc), floor=1, room=2,
+                              device_type='power', fault_flags=1, severity=2, resolved=False,
+                              incident_id=incident_id)
+
+    def test_incident_id_only_when_linked(self):
+        self.assertNotIn('incident_id', SupabaseService.fault_data(self.fault()))
+        self.assertEqual(SupabaseService.fault_data(self.fault(7))['incident_id'], '7')
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.requests = []
+        self.failing = False
+
+    def upsert(self, table, rows):
+        if self.failing:
+            raise ConnectionError('supabase is down')
+        self.requests.append((table, [row['id'] for row in rows]))
+
+
+def rows(*ids, **fields):
+    return [dict(fields, id=str(i)) for i in ids]
+
+
+class SyncQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.supabase = FakeSupabase()
+        self.sync = SyncQueue(self.supabase.upsert, batch_size=2, max_pending=5)
+
+    def test_flush_in_batches_per_table(self):
+        self.sync.add('sensors_data', rows(1, 2, 3))
+        self.sync.add('equipment_faults', rows(4))
+        self.assertEqual(self.sync.flush(), 4)
+        self.assertEqual(self.supabase.requests, [
+            ('sensors_data', ['1', '2']), ('sensors_data', ['3']), ('equipment_faults', ['4'])])
+        self.assertEqual(self.sync.pending_rows(), 0)
+        self.assertEqual(self.sync.flush(), 0)
+
+    def test_latest_copy_of_a_row_is_sent_once(self):
+        self.sync.add('equipment_faults', rows(1, 2, resolved=False))
+        self.sync.add('equipment_faults', rows(1, resolved=True))
+        self.sync.flush()
+        self.assertEqual(self.supabase.requests, [('equipment_faults', ['2', '1'])])
+        self.assertEqual(self.sync.pending_rows(), 0)
+
+    def test_failed_rows_are_retried_before_newer_ones(self):
+        self.sync.add('sensors_data', rows(1, 2, 3))
+        self.supabase.failing = True
+        self.assertEqual(self.sync.flush(), 0)
+        self.assertEqual(self.sync.pending_rows(), 3)
+        self.sync.add('sensors_data', rows(4))
+        self.supabase.failing = False
+        self.assertEqual(self.sync.flush(), 4)
+        self.assertEqual(self.supabase.requests, [('sensors_data', ['1', '2']), ('sensors_data', ['3', '4'])])
+
+    def test_rows_added_during_a_failed_flush_win(self):
+        self.sync.add('equipment_faults', rows(1, 2, resolved=False))
+
+        def upsert(table, batch):
+            self.sync.add(table, rows(1, resolved=True))
+            raise ConnectionError('supabase is down')
+        self.sync.upsert = upsert
+        self.sync.flush()
+        self.assertEqual(list(self.sync.pending['equipment_faults']), ['2', '1'])
+        self.assertTrue(self.sync.pending['equipment_faults']['1']['resolved'])
+
+    def test_oldest_rows_dropped_beyond_max_pending(self):
+        self.sync.add('sensors_data', rows(*range(7)))
+        self.assertEqual(list(self.sync.pending['sensors_data']), ['2', '3', '4', '5', '6'])
+
+
+class BulkResolveSerializerTests(SimpleTestCase):
+    def validate(self, data):
+        serializer = BulkResolveSerializer(data=data)
+        valid = serializer.is_valid()
+        return valid, serializer.validated_data if valid else serializer.errors
+
+    def test_needs_ids_or_a_filter(self):
+        valid, errors = self.validate({})
+        self.assertFalse(valid)
+        self.assertIn('non_field_errors', errors)
+        self.assertFalse(self.validate({'ids': []})[0])
+
+    def test_room_needs_a_floor(self):
+        valid, errors = self.validate({'room': 2})
+        self.assertFalse(valid)
+        self.assertIn('room', errors)
+        self.assertTrue(self.validate({'floor': 1, 'room': 2})[0])
+
+    def test_bad_ranges(self):
+        self.assertFalse(self.validate({'fault_bit': 31})[0])
+        self.assertFalse(self.validate({'fault_bit': -1})[0])
+        self.assertFalse(self.validate({'ids': list(range(10001))})[0])
+        valid, errors = self.validate({'start_time': '2026-01-02T00:00:00Z', 'end_time': '2026-01-01T00:00:00Z'})
+        self.assertFalse(valid)
+        self.assertIn('end_time', errors)
+
+    def test_fault_and_bit_become_one_mask(self):
+        valid, data = self.validate({'fault': 'power_spike', 'fault_bit': 2})
+        self.assertTrue(valid)
+        self.assertEqual(data, {'fault_mask': RULES.mask('power_spike') | 1 << 2})
+
+    def test_unknown_fault(self):
+        valid, errors = self.validate({'fault': 'door_open'})
+        self.assertFalse(valid)
+        self.assertIn('fault', errors)
+
+
+class FilterConditionsTests(SimpleTestCase):
+    def test_no_filters(self):
+        self.assertEqual(filter_conditions(), ([], []))
+
+    def test_conditions_and_params_line_up(self):
+        start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        conditions, params = filter_conditions(ids=[3, 4], floor=1, room=2, device_type='power', start_time=start,
+                                               fault_mask=0b101)
+        self.assertEqual(conditions, ['id = ANY(%s)', 'floor = %s', 'room = %s', 'device_type = %s', 'time >= %s',
+                                      'fault_bits(fault_flags) && %s::smallint[]'])
+        self.assertEqual(params, [[3, 4], 1, 2, 'power', start, [0, 2]])
+
+    def test_floor_zero_is_a_filter(self):
+        self.assertEqual(filter_conditions(floor=0, end_time=5), (['floor = %s', 'time <= %s'], [0, 5]))
+
+
+class ParseFaultBitsTests(SimpleTestCase):
+    def test_names_and_bits(self):
+        self.assertEqual(parse_fault_bits('co2_high, 7,power_silent'), [5, 7, 12])
+
+    def test_unknown_names_and_bits(self):
+        for value in ('door_open', '31', '-1', 'co2_high,'):
+            with self.assertRaises(ValueError):
+                parse_fault_bits(value)
+
+
+class FakeCursor:
+    def __init__(self, columns, rows):
+        self.description = [(column,) for column in columns]
+        self.rows = rows
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params):
+        self.executed.append((' '.join(query.split()), params))
+
+    def fetchall(self):
+        return self.rows
+
+
+class FaultTrendsViewTests(SimpleTestCase):
+    def get(self, cursor, **params):
+        request = APIRequestFactory().get('/api/faults/trends/', params)
+        with mock.patch('sensors.views.connection') as connection:
+            connection.cursor.return_value = cursor
+            return FaultTrendsView.as_view()(request)
+
+    def test_fault_filter(self):
+        cursor = FakeCursor(['bucket', 'fault_count', 'urgent_count', 'warning_count'], [])
+        response = self.get(cursor, fault='co2_high,7')
+        self.assertEqual(response.status_code, 200)
+        [(query, params)] = cursor.executed
+        self.assertIn('AND fault_bits(fault_flags) && %s::smallint[]', query)
+        self.assertEqual(params, ['5 minutes', 1, 2, '1 hour', [5, 7]])
+
+    def test_by_fault_names_each_bit(self):
+        cursor = FakeCursor(['bucket', 'fault_bit', 'fault_count'], [(None, 5, 3), (None, 7, 1)])
+        response = self.get(cursor, fault='co2_high,7', by_fault='true', range='1d')
+        self.assertEqual(response.status_code, 200)
+        [(query, params)] = cursor.executed
+        self.assertIn('unnest(fault_bits(fault_flags)) AS bit', query)
+        self.assertIn('AND bit = ANY(%s::smallint[])', query)
+        # The index condition and the per-bit one each take the bits
+        self.assertEqual(params, ['1 hour', '1 day', [5, 7], [5, 7]])
+        self.assertEqual([row['fault'] for row in response.data], ['co2_high', 'power_spike'])
+
+    def test_by_fault_without_filter(self):
+        cursor = FakeCursor(['bucket', 'fault_bit', 'fault_count'], [])
+        self.get(cursor, by_fault='true')
+        [(query, params)] = cursor.executed
+        self.assertNotIn('%s::smallint[]', query)
+        self.assertEqual(params, ['5 minutes', '1 hour'])
+
+    def test_unknown_fault_is_rejected(self):
+        cursor = FakeCursor([], [])
+        response = self.get(cursor, fault='door_open')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(cursor.executed, [])
@@ -7,7 +7,11 @@ from sensors.views import (
     LatestRoomFaultView,
     FaultTrendsView,
     ResolveFaultView,
+    BulkResolveFaultView,
     EquipmentFaultListView,
+    IncidentListView,
+    ResolveIncidentView,
+    metrics,
 )
 
 urlpatterns = [
@@ -17,6 +21,10 @@ urlpatterns = [
     path('api/rooms/floor/<int:floor>/', RoomDropdownView.as_view(), name='room-dropdown'),
     path('api/faults/floor/<int:floor>/room/<int:room>/latest/', LatestRoomFaultView.as_view(), name='latest-room-fault'),
     path('api/faults/trends/', FaultTrendsView.as_view(), name='fault-trends'),
+    path('api/faults/resolve/', BulkResolveFaultView.as_view(), name='bulk-resolve-faults'),
     path('api/faults/resolve/<int:id>/', ResolveFaultView.as_view(), name='resolve-fault'),
     path('api/faults/', EquipmentFaultListView.as_view(), name='equipment-faults'),
+    path('api/incidents/', IncidentListView.as_view(), name='incidents'),
+    path('api/incidents/resolve/<int:id>/', ResolveIncidentView.as_view(), name='resolve-incident'),
+    path('metrics', metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -4,13 +4,17 @@ from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 from django.db.models import Count, Q
 from django.db import connection
-from .models import SensorReading, EquipmentFault
-from .serializers import SensorReadingSerializer, EquipmentFaultSerializer
+from .models import SensorReading, EquipmentFault, Incident
+from .serializers import SensorReadingSerializer, EquipmentFaultSerializer, IncidentSerializer, BulkResolveSerializer
+from .resolve import filter_conditions, resolve_faults, settle_incidents
+from hotel_common.fault_rules import rule_book
 from datetime import datetime, timedelta
 import pytz
 import json
 from django.core.serializers.json import DjangoJSONEncoder
 from .supabase_service import SupabaseService
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 class CustomJSONEncoder(DjangoJSONEncoder):
     def default(self, obj):
@@ -18,6 +22,20 @@ class CustomJSONEncoder(DjangoJSONEncoder):
             return obj.astimezone(pytz.timezone('Asia/Bangkok')).isoformat()
         return super().default(obj)
 
+def parse_fault_bits(value):
+    """?fault=co2_high,temp_high (names in fault_rules.json or bit numbers) -> [bit, ...]"""
+    faults = rule_book().current.faults
+    bits = []
+    for item in value.split(','):
+        item = item.strip()
+        if item.isdigit() and 0 <= int(item) <= 30:
+            bits.append(int(item))
+        elif item in faults:
+            bits.append(faults[item].bit)
+        else:
+            raise ValueError(f"Unknown fault '{item}'")
+    return bits
+
 class SensorReadingListView(APIView):
     def get(self, request):
         queryset = SensorReading.objects.all()
@@ -101,6 +119,12 @@ class FaultTrendsView(APIView):
         range_param = request.query_params.get('range', '1h')
         now = datetime.now(pytz.timezone('Asia/Bangkok'))
 
+        try:
+            fault_bits = parse_fault_bits(request.query_params['fault']) if request.query_params.get('fault') else None
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+        by_fault = request.query_params.get('by_fault') == 'true'
+
         if range_param == '1h':
             bucket = '5 minutes'
             time_delta = '1 hour'
@@ -113,23 +137,45 @@ class FaultTrendsView(APIView):
         else:
             return Response({"error": "Invalid range. Use '1h', '30m', or '1d'"}, status=400)
 
-        query = """
-            SELECT time_bucket(%s, time) AS bucket,
-                   COUNT(id) AS fault_count,
-                   COUNT(id) FILTER (WHERE severity = %s) AS urgent_count,
-                   COUNT(id) FILTER (WHERE severity = %s) AS warning_count
-            FROM equipment_faults
-            WHERE resolved = FALSE AND time >= NOW() - INTERVAL %s
-            GROUP BY bucket
-            ORDER BY bucket DESC
-        """
-        params = [bucket, 1, 2, time_delta]
+        # fault_bits(fault_flags) is what idx_faults_bits indexes
+        bit_filter = "AND fault_bits(fault_flags) && %s::smallint[]" if fault_bits else ""
+        if by_fault:
+            # One row per bucket and fault bit, a fault with several bits counting for each
+            query = f"""
+                SELECT time_bucket(%s, time) AS bucket,
+                       bit AS fault_bit,
+                       COUNT(id) AS fault_count
+                FROM equipment_faults, unnest(fault_bits(fault_flags)) AS bit
+                WHERE resolved = FALSE AND time >= NOW() - INTERVAL %s {bit_filter}
+                      {"AND bit = ANY(%s::smallint[])" if fault_bits else ""}
+                GROUP BY bucket, bit
+                ORDER BY bucket DESC, bit
+            """
+            params = [bucket, time_delta]
+        else:
+            query = f"""
+                SELECT time_bucket(%s, time) AS bucket,
+                       COUNT(id) AS fault_count,
+                       COUNT(id) FILTER (WHERE severity = %s) AS urgent_count,
+                       COUNT(id) FILTER (WHERE severity = %s) AS warning_count
+                FROM equipment_faults
+                WHERE resolved = FALSE AND time >= NOW() - INTERVAL %s {bit_filter}
+                GROUP BY bucket
+                ORDER BY bucket DESC
+            """
+            params = [bucket, 1, 2, time_delta]
+        if fault_bits:
+            params += [fault_bits, fault_bits] if by_fault else [fault_bits]
 
         try:
             with connection.cursor() as cursor:
                 cursor.execute(query, params)
                 columns = [col[0] for col in cursor.description]
                 results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            if by_fault:
+                names = {fault.bit: fault.name for fault in rule_book().current.faults.values()}
+                for result in results:
+                    result['fault'] = names.get(result['fault_bit'])
             return Response(json.loads(json.dumps(results, cls=CustomJSONEncoder)))
         except Exception as e:
             return Response({"error": f"Query failed: {str(e)}"}, status=500)
@@ -139,9 +185,43 @@ class ResolveFaultView(APIView):
         fault = get_object_or_404(EquipmentFault, id=id)
         fault.resolved = True
         fault.save()
+        incidents = settle_incidents(faults=[fault])
+        SupabaseService().sync_incidents(incidents)
         serializer = EquipmentFaultSerializer(fault)
         return Response({"status": "resolved", "fault": serializer.data})
 
+class BulkResolveFaultView(APIView):
+    def post(self, request):
+        serializer = BulkResolveSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        conditions, params = filter_conditions(**serializer.validated_data)
+        return resolved_response(resolve_faults(conditions, params))
+
+def resolved_response(faults, incident_ids=None):
+    """Settles the incidents the resolved faults belonged to and syncs both to Supabase."""
+    supabase = SupabaseService()
+    synced = supabase.sync_faults(faults) if faults else 0
+    incidents = settle_incidents(faults=faults) if faults else []
+    if incident_ids:
+        incidents += settle_incidents(ids=incident_ids)
+    supabase.sync_incidents(incidents)
+    return Response({"status": "resolved", "resolved": len(faults), "synced": synced,
+                     "ids": [fault.id for fault in faults],
+                     "incidents_resolved": [incident.id for incident in incidents if incident.resolved]})
+
+class ResolveIncidentView(APIView):
+    def post(self, request, id):
+        incident = get_object_or_404(Incident, id=id)
+        # The incident's faults, as sensors.resolve.INCIDENT_FAULTS matches them
+        conditions, params = filter_conditions(floor=incident.floor, device_type=incident.device_type,
+                                               start_time=incident.started_at, end_time=incident.last_seen,
+                                               fault_mask=incident.fault_flags)
+        conditions.append('room = ANY(%s)')
+        params.append(incident.rooms)
+        # Settled even when its faults were resolved already
+        return resolved_response(resolve_faults(conditions, params), [incident.id])
+
 class EquipmentFaultListView(APIView):
     def get(self, request):
         queryset = EquipmentFault.objects.all()
@@ -151,12 +231,16 @@ class EquipmentFaultListView(APIView):
         start_time = request.query_params.get('start_time')
         end_time = request.query_params.get('end_time')
         resolved = request.query_params.get('resolved')
+        fault = request.query_params.get('fault')
+        incident = request.query_params.get('incident')
         limit = int(request.query_params.get('limit', 100))
 
         if floor:
             queryset = queryset.filter(floor=floor)
         if room:
             queryset = queryset.filter(room=room)
+        if incident:
+            queryset = queryset.filter(incident_id=incident)
         if device_type:
             queryset = queryset.filter(device_type=device_type)
         if start_time:
@@ -165,7 +249,44 @@ class EquipmentFaultListView(APIView):
             queryset = queryset.filter(time__lte=end_time)
         if resolved is not None:
             queryset = queryset.filter(resolved=resolved.lower() == 'true')
+        if fault:
+            try:
+                queryset = queryset.with_any_fault_bit(parse_fault_bits(fault))
+            except ValueError as e:
+                return Response({"error": str(e)}, status=400)
 
         queryset = queryset.order_by('-time')[:limit]
         serializer = EquipmentFaultSerializer(queryset, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+
+class IncidentListView(APIView):
+    def get(self, request):
+        queryset = Incident.objects.all()
+        floor = request.query_params.get('floor')
+        device_type = request.query_params.get('device_type')
+        start_time = request.query_params.get('start_time')
+        end_time = request.query_params.get('end_time')
+        active = request.query_params.get('active')
+        resolved = request.query_params.get('resolved')
+        limit = int(request.query_params.get('limit', 100))
+
+        if floor:
+            queryset = queryset.filter(floor=floor)
+        if device_type:
+            queryset = queryset.filter(device_type=device_type)
+        if start_time:
+            queryset = queryset.filter(last_seen__gte=start_time)
+        if end_time:
+            queryset = queryset.filter(started_at__lte=end_time)
+        if active is not None:
+            queryset = queryset.filter(active=active.lower() == 'true')
+        if resolved is not None:
+            queryset = queryset.filter(resolved=resolved.lower() == 'true')
+
+        queryset = queryset.order_by('-started_at')[:limit]
+        serializer = IncidentSerializer(queryset, many=True)
+        return Response(serializer.data)
+
+def metrics(request):
+    # Prometheus scrape endpoint for the API process
+    return HttpResponse(generate_latest(), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,144 @@
+"""
+Streaming anomaly detection against each sensor's own baseline.
+
+Every numeric channel of a floor.room.sensor (temperature, humidity and co2
+for iaq, power_kw for power) keeps an exponentially weighted mean and
+variance. After ANOMALY_WARMUP readings, a reading more than ANOMALY_Z
+standard deviations from its mean raises the sensor's anomaly bit. The
+baseline adapts with weight ANOMALY_ALPHA per reading, with outliers clamped
+to the threshold; readings that already tripped a fixed threshold do not
+update it.
+
+State lives in flat arrays indexed by a per-channel slot (about 20 bytes
+per channel plus the key index), and is checkpointed to ANOMALY_CHECKPOINT
+every ANOMALY_CHECKPOINT_INTERVAL seconds so a restart keeps the baselines.
+"""
+import math
+import os
+import pickle
+import time
+from array import array
+
+from hotel_common.fault_rules import rule_book
+from hotel_common.log import get_logger
+
+log = get_logger('anomaly')
+
+# sensor type -> message fields; raises the <sensor type>_anomaly fault of fault_rules.json
+CHANNELS = {
+    'iaq': ('temperature', 'humidity', 'co2'),
+    'power': ('power_kw',),
+}
+
+CHECKPOINT_VERSION = 1
+
+
+class AnomalyDetector:
+    def __init__(self, alpha=None, z_threshold=None, warmup=None,
+                 checkpoint_path=None, checkpoint_interval=None):
+        self.alpha = alpha or float(os.getenv('ANOMALY_ALPHA', '0.05'))
+        self.z_threshold = z_threshold or float(os.getenv('ANOMALY_Z', '4'))
+        self.warmup = warmup or int(os.getenv('ANOMALY_WARMUP', '50'))
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval or float(os.getenv('ANOMALY_CHECKPOINT_INTERVAL', '60'))
+
+        # routing key -> first slot; a sensor's channels occupy consecutive slots
+        self.slots = {}
+        self.mean = array('d')
+        self.var = array('d')
+        self.count = array('I')
+        self._last_checkpoint = time.monotonic()
+
+    def _allocate(self, routing_key, channels):
+        slot = len(self.mean)
+        self.slots[routing_key] = slot
+        self.mean.extend([0.0] * channels)
+        self.var.extend([0.0] * channels)
+        self.count.extend([0] * channels)
+        return slot
+
+    def update(self, routing_key, message, fault_flags, rules=None):
+        """
+        Feed one reading; returns (anomaly flags, details). fault_flags are the
+        fixed-threshold faults of the same reading, which keep it out of the baseline.
+        """
+        sensor_type = routing_key.rsplit('.', 1)[-1]
+        fields = CHANNELS.get(sensor_type)
+        if fields is None or fault_flags:
+            return 0, None
+        slot = self.slots.get(routing_key)
+        if slot is None:
+            slot = self._allocate(routing_key, len(fields))
+
+        alpha = self.alpha
+        details = None
+        for i, field in enumerate(fields, slot):
+            value = message.get(field)
+            if value is None:
+                continue
+            seen = self.count[i]
+            if not seen:
+                # First reading seeds the mean instead of dragging it up from zero
+                self.mean[i] = value
+                self.count[i] = 1
+                continue
+            mean = self.mean[i]
+            diff = value - mean
+            if seen >= self.warmup:
+                # Floor the deviation so a perfectly steady sensor does not flag rounding noise
+                std = max(math.sqrt(self.var[i]), abs(mean) * 0.01, 1e-3)
+                z = diff / std
+                if abs(z) > self.z_threshold:
+                    details = details or []
+                    details.append(f"{field}={value} z={z:.1f} (baseline {mean:.1f})")
+                    # Clamp the outlier's pull so one spike does not widen the baseline,
+                    # while a lasting shift still moves it
+                    diff = math.copysign(self.z_threshold * std, diff)
+            else:
+                self.count[i] = seen + 1
+            increment = alpha * diff
+            self.mean[i] = mean + increment
+            self.var[i] = (1 - alpha) * (self.var[i] + diff * increment)
+        if not details:
+            return 0, None
+        return (rules or rule_book().current).mask(f'{sensor_type}_anomaly'), details
+
+    def maybe_checkpoint(self):
+        if self.checkpoint_path and time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self._last_checkpoint = time.monotonic()
+        if not self.checkpoint_path:
+            return
+        state = {
+            'version': CHECKPOINT_VERSION,
+            'slots': self.slots,
+            'mean': self.mean,
+            'var': self.var,
+            'count': self.count,
+        }
+        tmp_path = self.checkpoint_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.checkpoint_path)
+        except OSError as e:
+            log.error("Could not checkpoint anomaly baselines to %s: %s", self.checkpoint_path, e)
+
+    def restore(self):
+        """Load the last checkpoint, if any; returns self."""
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return self
+        try:
+            with open(self.checkpoint_path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            log.error("Ignoring unreadable anomaly checkpoint %s: %s", self.checkpoint_path, e)
+            return self
+        if state.get('version') != CHECKPOINT_VERSION:
+            log.warning("Ignoring anomaly checkpoint %s with version %s", self.checkpoint_path, state.get('version'))
+            return self
+        self.slots, self.mean, self.var, self.count = state['slots'], state['mean'], state['var'], state['count']
+        log.info("Restored anomaly baselines for %d sensors from %s", len(self.slots), self.checkpoint_path)
+        return self
@@ -1,138 +1,142 @@
-import pika
-import json
 import time
 import csv
+import logging
 import os
 
-def connect_to_rabbitmq():
-    rabbitmq_user = os.getenv('RABBITMQ_USER')
-    rabbitmq_pass = os.getenv('RABBITMQ_PASS')
-    rabbitmq_host = os.getenv('RABBITMQ_HOST')
-    rabbitmq_port = int(os.getenv('RABBITMQ_PORT'))
-    
-    credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
-    parameters = pika.ConnectionParameters(rabbitmq_host, rabbitmq_port, '/', credentials)
-    for attempt in range(5):
-        try:
-            return pika.BlockingConnection(parameters)
-        except pika.exceptions.AMQPConnectionError:
-            now = int(time.time())
-            print(f"{now} - Connection failed, retrying ({attempt + 1}/5)...", flush=True)
-            time.sleep(2)
-    raise Exception("Failed to connect to RabbitMQ after 5 attempts")
-
-# Fault bit definitions
-FAULT_SENSOR_NOT_WORKING = 1      # Bit 0 (IAQ: all zeros)
-FAULT_CALIBRATION_ERROR = 2       # Bit 1 (IAQ: partial zeros)
-FAULT_TEMP_HIGH = 4               # Bit 2
-FAULT_HUM_HIGH = 8                # Bit 3
-FAULT_CO2_LOW = 16                # Bit 4
-FAULT_CO2_HIGH = 32               # Bit 5
-FAULT_POWER_NOT_WORKING = 64      # Bit 6 (Power: 0.0 kW)
-FAULT_POWER_SPIKE = 128           # Bit 7 (Power: >45.0 kW)
-FAULT_PRESENCE_NOT_READING = 256  # Bit 8 (Presence: 3)
-
-def detect_and_prepare_fault(message, routing_key):
-    timestamp = int(time.time())
+from hotel_common import log as logs
+from hotel_common import profiling
+from hotel_common import wire
+from hotel_common.aio_consumer import AsyncConsumerRuntime
+from hotel_common.fault_rules import rule_book
+from hotel_common.metrics import DETECTION_SECONDS, FAULTS_SUPPRESSED, SILENT_SENSORS, start_metrics_server
+from hotel_common.sharding import shard_name, add_sharded_handler
+from anomaly import AnomalyDetector
+from silence import SilenceMonitor
+from temporal_rules import TemporalFilter
+from thresholds import OverrideLoader, ThresholdTable
+
+log = logs.get_logger('fault_detection_agent')
+
+# Faults go out as JSON or the compact binary layout (WIRE_FORMAT)
+CONTENT_TYPE = wire.publish_content_type()
+
+def reading_time(message):
+    return int(message.get('timestamp', time.time()))
+
+def detect_and_prepare_fault(message, routing_key, rules=None, evaluators=None):
+    """
+    Checks one reading against the fixed thresholds in fault_rules.json, or against
+    evaluators compiled with the room's own thresholds. The fault carries the
+    reading's timestamp, the clock auto-resolution compares healthy readings on.
+    """
+    timestamp = reading_time(message)
     floor, room, sensor_type = routing_key.split('.')  # e.g., floor1.room1.iaq|.power|.presence
-    
-    fault_flags = 0
-    fault_labels = []
-    fault_details = []
-    
-    if sensor_type == 'iaq':
-        temp = message['temperature']
-        hum = message['humidity']
-        co2 = message['co2']
-        
-        if temp == 0 and hum == 0 and co2 == 0:
-            fault_flags |= FAULT_SENSOR_NOT_WORKING
-            fault_labels.append("Sensor Not Working")
-            fault_details.append("all values 0")
-            fault_payload = {'timestamp': timestamp, 'fault_flags': fault_flags}
-            return f"{timestamp} - FAULT DETECTED at {floor}.{room}: {fault_labels[0]} ({fault_details[0]})", fault_payload, f"{floor}.{room}.fault"
-        
-        zeros = sum(1 for x in [temp, hum, co2] if x == 0)
-        non_zeros = sum(1 for x in [temp, hum, co2] if x != 0)
-        if zeros > 0 and non_zeros > 0:
-            fault_flags |= FAULT_CALIBRATION_ERROR
-            fault_labels.append("Calibration Error")
-            fault_details.append(f"temp={temp}, hum={hum}, co2={co2}")
-            fault_payload = {'timestamp': timestamp, 'fault_flags': fault_flags}
-            return f"{timestamp} - FAULT DETECTED at {floor}.{room}: {fault_labels[0]} ({fault_details[0]})", fault_payload, f"{floor}.{room}.fault"
-        
-        conditions = [
-            (temp > 35, FAULT_TEMP_HIGH, 'Temperature High', f'temp={temp}'),
-            (hum > 60, FAULT_HUM_HIGH, 'Humidity High', f'hum={hum}'),
-            (co2 < 200, FAULT_CO2_LOW, 'CO2 Low', f'co2={co2}'),
-            (co2 > 800, FAULT_CO2_HIGH, 'CO2 High', f'co2={co2}')
-        ]
-        
-        for condition, flag, label, detail in conditions:
-            if condition:
-                fault_flags |= flag
-                fault_labels.append(label)
-                fault_details.append(detail)
-    
-    elif sensor_type == 'power':
-        power_kw = message['power_kw']
-        
-        conditions = [
-            (power_kw == 0.0, FAULT_POWER_NOT_WORKING, 'Power Not Working', f'power_kw={power_kw}'),
-            (power_kw > 45.0, FAULT_POWER_SPIKE, 'Power Spike', f'power_kw={power_kw}')
-        ]
-        
-        for condition, flag, label, detail in conditions:
-            if condition:
-                fault_flags |= flag
-                fault_labels.append(label)
-                fault_details.append(detail)
-    
-    elif sensor_type == 'presence':
-        presence = message['presence']
-        
-        conditions = [
-            (presence == 3, FAULT_PRESENCE_NOT_READING, 'Presence Not Reading', f'presence={presence}')
-        ]
-        
-        for condition, flag, label, detail in conditions:
-            if condition:
-                fault_flags |= flag
-                fault_labels.append(label)
-                fault_details.append(detail)
-    
+    rules = rules or rule_book().current
+
+    fault_flags, hits = rules.evaluate(sensor_type, message, evaluators)
     if fault_flags:
         fault_payload = {'timestamp': timestamp, 'fault_flags': fault_flags}
-        return f"{timestamp} - FAULT DETECTED at {floor}.{room}: {', '.join(fault_labels)} ({', '.join(fault_details)})", fault_payload, f"{floor}.{room}.fault"
-    return f"{timestamp} - No fault detected at {floor}.{room}", None, None
+        labels = ', '.join(label for label, _ in hits)
+        details = ', '.join(detail for _, detail in hits)
+        return f"FAULT DETECTED at {floor}.{room}: {labels} ({details})", fault_payload, f"{floor}.{room}.fault"
+    return f"No fault detected at {floor}.{room}", None, None
 
-def callback(ch, method, properties, body, csv_writer, csv_file):
-    message = json.loads(body.decode())
-    routing_key = method.routing_key
-    log_message, fault_payload, fault_routing_key = detect_and_prepare_fault(message, routing_key)
-    
-    print(f"{log_message}\n\n", flush=True)
-    
-    # Write to CSV using the passed writer
-    floor, room, _ = routing_key.split('.')
-    fault_flags = fault_payload['fault_flags'] if fault_payload else 0
-    timestamp = int(time.time())
-    csv_writer.writerow([timestamp, floor, room, fault_flags])
+async def handle_reading(runtime, delivery, csv_writer, csv_file, temporal_filter, anomaly_detector, silence_monitor,
+                         threshold_table):
+    sensor_type = delivery.routing_key.rsplit('.', 1)[-1]
+    # A single reading or an envelope of one room's or many rooms' readings
+    readings = wire.decode_all(sensor_type, delivery.body, delivery.content_type, delivery.routing_key)
+    # One version of the rules for the whole message, even if a reload lands meanwhile
+    rules = rule_book().current
+    for routing_key, message in readings:
+        try:
+            await process_reading(runtime, routing_key, sensor_type, message, rules, csv_writer,
+                                  temporal_filter, anomaly_detector, silence_monitor, threshold_table)
+        except Exception as e:
+            if len(readings) == 1:
+                raise
+            # Do not lose the rest of the envelope to one bad reading
+            log.error("Skipping reading for %s: %s", routing_key, e)
     csv_file.flush()
 
+def evaluate_reading(routing_key, sensor_type, message, rules, temporal_filter, anomaly_detector, threshold_table):
+    """
+    Fixed thresholds, baseline anomalies and the temporal filter for one reading.
+    Returns (log message, raw flags, flags to publish, fault payload or None, fault routing key).
+    """
+    started = time.perf_counter()
+    log_message, fault_payload, fault_routing_key = detect_and_prepare_fault(
+        message, routing_key, rules, threshold_table.evaluators(rules, routing_key))
+    DETECTION_SECONDS.labels(sensor_type).observe(time.perf_counter() - started)
+
+    raw_flags = fault_payload['fault_flags'] if fault_payload else 0
+    # Compare the reading against this sensor's own baseline
+    anomaly_flags, anomaly_details = anomaly_detector.update(routing_key, message, raw_flags, rules)
+    if anomaly_flags:
+        floor, room, _ = routing_key.split('.')
+        log_message = f"ANOMALY at {floor}.{room}: {sensor_type} {', '.join(anomaly_details)}"
+        fault_payload = {'timestamp': reading_time(message), 'fault_flags': anomaly_flags}
+        fault_routing_key = f"{floor}.{room}.fault"
+        raw_flags = anomaly_flags
+
+    # N-of-M, sustain, hysteresis and dedup over this sensor's recent readings
+    fault_flags = temporal_filter.update(routing_key, raw_flags, reading_time(message))
+    if fault_flags and fault_payload:
+        fault_payload['fault_flags'] = fault_flags
+    elif fault_flags:
+        # A reminder for a fault held by hysteresis, due on a healthy reading
+        floor, room, _ = routing_key.split('.')
+        fault_payload = {'timestamp': reading_time(message), 'fault_flags': fault_flags}
+        fault_routing_key = f"{floor}.{room}.fault"
+    else:
+        fault_payload = None
+    return log_message, raw_flags, fault_flags, fault_payload, fault_routing_key
+
+async def process_reading(runtime, routing_key, sensor_type, message, rules, csv_writer,
+                          temporal_filter, anomaly_detector, silence_monitor, threshold_table):
+    if silence_monitor.seen(routing_key):
+        log.info("Sensor %s is sending again", routing_key)
+    log_message, raw_flags, fault_flags, fault_payload, fault_routing_key = evaluate_reading(
+        routing_key, sensor_type, message, rules, temporal_filter, anomaly_detector, threshold_table)
+    anomaly_detector.maybe_checkpoint()
+
+    if fault_flags:
+        # Faults are always logged; healthy readings only as a sample
+        log.fault(log_message)
+    elif raw_flags:
+        FAULTS_SUPPRESSED.labels(sensor_type).inc()
+        log.sampled('fault_suppressed', "Suppressed: %s", log_message)
+    else:
+        log.sampled('reading_ok', log_message)
     
+    # Write to CSV using the passed writer, on the reading's clock like the published fault
+    floor, room, _ = routing_key.split('.')
+    csv_writer.writerow([reading_time(message), floor, room, fault_flags])
+
     if fault_payload:
-        payload_str = json.dumps(fault_payload)
-        ch.basic_publish(
-            exchange='fault_notifications',
-            routing_key=fault_routing_key,
-            body=payload_str.encode()
-        )
-        print(f"{fault_payload['timestamp']} - Published fault to {fault_routing_key}: {payload_str}\n\n", flush=True)
-    
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+        body = wire.encode('fault', fault_payload, CONTENT_TYPE)
+        await runtime.publish('fault_notifications', fault_routing_key, body, CONTENT_TYPE)
+        log.sampled('fault_published', "Published fault to %s: %s", fault_routing_key, fault_payload, level=logging.DEBUG)
+
+async def report_silent_sensors(runtime, silence_monitor, csv_writer, csv_file):
+    rules = rule_book().current
+    for routing_key in silence_monitor.expired():
+        floor, room, sensor_type = routing_key.split('.')
+        # No reading to take the time from; a sensor clock behind this one only delays auto-resolution
+        timestamp = int(time.time())
+        fault_payload = {'timestamp': timestamp, 'fault_flags': rules.mask(f'{sensor_type}_silent')}
+        log.fault("SENSOR SILENT at %s.%s: no %s reading for %ss", floor, room, sensor_type,
+                  int(silence_monitor.timeouts[sensor_type]))
+        csv_writer.writerow([timestamp, floor, room, fault_payload['fault_flags']])
+        await runtime.publish('fault_notifications', f"{floor}.{room}.fault",
+                              wire.encode('fault', fault_payload, CONTENT_TYPE), CONTENT_TYPE)
+    csv_file.flush()
+    SILENT_SENSORS.set(len(silence_monitor.silent))
 
 def main():
+    logs.configure()
+    profiling.install('fault_detection_agent')
+
     # CSV setup - open once
     csv_file_path = os.getenv('CSV_PATH', '/app/data/faults.csv')  
     os.makedirs(os.path.dirname(csv_file_path), exist_ok=True)
@@ -145,35 +149,58 @@ def main():
     csv_file = open(csv_file_path, 'a', newline='')
     csv_writer = csv.writer(csv_file)
 
-    # RabbitMQ setup
-    connection = connect_to_rabbitmq()
-    channel = connection.channel()
+    # RabbitMQ setup - detection runs on the event loop, so CSV writes need no locking
+    runtime = AsyncConsumerRuntime()
+    runtime.declare_queue('fault_queue', 'fault_notifications', '*.#.fault')
+
+    # Thresholds, fault bits and labels; edits to the file are picked up without a restart
+    rules = rule_book()
+    temporal_filter = TemporalFilter(faults=rules.current)
+    rules.on_reload(temporal_filter.reload)
+    runtime.add_periodic(float(os.getenv('FAULT_RULES_RELOAD_INTERVAL', '5')), rules.reload_async)
+    shard = shard_name()
+    # Baselines survive restarts; each shard only sees (and checkpoints) its own rooms
+    default_checkpoint = os.path.join(os.path.dirname(csv_file_path), f"anomaly_state{f'_shard{shard}' if shard else ''}.pkl")
+    anomaly_detector = AnomalyDetector(checkpoint_path=os.getenv('ANOMALY_CHECKPOINT', default_checkpoint)).restore()
+
+    silence_monitor = SilenceMonitor(sharded=bool(shard))
+    runtime.on_reconnect(silence_monitor.reset)
+
+    # Per-floor and per-room thresholds from the database, refreshed off the event loop
+    threshold_table = ThresholdTable()
+    override_loader = OverrideLoader(threshold_table)
+    if override_loader.enabled:
+        try:
+            threshold_table.load(override_loader.fetch())
+        except Exception as e:
+            log.warning("Starting without threshold overrides: %s", e)
+        runtime.add_periodic(override_loader.interval, override_loader.refresh)
+
+    async def handler(delivery):
+        await handle_reading(runtime, delivery, csv_writer, csv_file, temporal_filter, anomaly_detector, silence_monitor,
+                             threshold_table)
+
+    async def check_silence():
+        await report_silent_sensors(runtime, silence_monitor, csv_writer, csv_file)
 
-    channel.exchange_declare(exchange='fault_notifications', exchange_type='topic')
-    channel.exchange_declare(exchange='hotel_sensors', exchange_type='topic')
-    channel.queue_declare(queue='test_queue', durable=True)
-    channel.queue_declare(queue='fault_queue', durable=True)
+    runtime.add_periodic(float(os.getenv('SILENCE_CHECK_INTERVAL', '5')), check_silence)
 
-    # Bind to all floor.room.sensor messages
-    channel.queue_bind(exchange='hotel_sensors', queue='test_queue', routing_key='*.#.*')
-    channel.queue_bind(exchange='fault_notifications', queue='fault_queue', routing_key='*.#.fault')
+    if shard:
+        # Only this shard's consistent-hash partition of the floor.room keys
+        add_sharded_handler(runtime, shard, handler)
+    else:
+        # Bind to all floor.room.sensor messages
+        runtime.add_handler('test_queue', handler, 'hotel_sensors', '*.#.*')
 
-    # Pass csv_writer and csv_file to callback
-    channel.basic_consume(
-        queue='test_queue',
-        on_message_callback=lambda ch, method, properties, body: callback(ch, method, properties, body, csv_writer, csv_file)
-    )
+    start_metrics_server(9101)
 
-    start_time = int(time.time())
-    print(f"{start_time} - Started fault detection agent, waiting for messages...\n\n", flush=True)
+    log.info("Started fault detection agent%s, waiting for messages...", f" shard {shard}" if shard else '')
     
     try:
-        channel.start_consuming()
-    except KeyboardInterrupt:
-        print("Shutting down...")
+        runtime.run_forever()
     finally:
+        anomaly_detector.checkpoint()
         csv_file.close()
-        connection.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,284 @@
+"""
+Replays the agents' CSV archives (iaq_data.csv, power_data.csv,
+presence_data.csv) merged in timestamp order.
+
+--mode offline runs every reading through the detector's own pipeline
+(fault_rules.json thresholds, baselines, temporal rules, silent sensors) in
+process, as fast as the CPU allows, writes the faults it raises and a diff
+against the faults.csv the live detector wrote. Rooms are split over
+--processes workers by a stable hash, so every sensor's history stays in one
+worker. Use --rules and --temporal-rules to try new settings on old data:
+
+    python replay.py --mode offline --rules candidate_rules.json --diff data/fault_diff.csv
+
+--mode publish republishes the readings to hotel_sensors (WIRE_FORMAT and
+ENVELOPE_MODE apply), --speed times faster than they were recorded (0 = as
+fast as the broker takes them); --rebase shifts the timestamps so the first
+reading is now:
+
+    python replay.py --mode publish --speed 60 --since 1760000000
+"""
+import argparse
+import csv
+import heapq
+import multiprocessing
+import os
+import time
+import zlib
+from collections import defaultdict
+from operator import itemgetter
+
+from hotel_common import log as logs
+from hotel_common import wire
+from hotel_common.fault_rules import RuleBook, rule_book
+from anomaly import AnomalyDetector
+from fault_detection_agent import evaluate_reading
+from silence import SilenceMonitor
+from temporal_rules import TemporalFilter, parse_rules
+from thresholds import OverrideLoader, ThresholdTable
+
+log = logs.get_logger('replay')
+
+# sensor type -> (archive file name, value columns, value type)
+ARCHIVES = {
+    'iaq': ('iaq_data.csv', ('temperature', 'humidity', 'co2'), float),
+    'power': ('power_data.csv', ('power_kw',), float),
+    'presence': ('presence_data.csv', ('presence',), int),
+}
+
+
+def room_partition(floor, room, workers):
+    # crc32 rather than hash(), which differs between processes
+    return zlib.crc32(f"{floor}.{room}".encode()) % workers
+
+
+def read_archive(path, sensor_type, since=None, until=None, worker=0, workers=1):
+    """Yields (timestamp, routing key, reading) for the rows of one archive."""
+    _, fields, convert = ARCHIVES[sensor_type]
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = [(field, header.index(field)) for field in fields]
+        skipped = 0
+        for row in reader:
+            try:
+                timestamp = int(row[0])
+                if (since and timestamp < since) or (until and timestamp >= until):
+                    continue
+                floor, room = row[1], row[2]
+                if workers > 1 and room_partition(floor, room, workers) != worker:
+                    continue
+                message = {'timestamp': timestamp}
+                for field, column in columns:
+                    message[field] = convert(row[column])
+            except (ValueError, IndexError):
+                skipped += 1
+                continue
+            yield timestamp, f"{floor}.{room}.{sensor_type}", message
+    if skipped:
+        log.warning("Skipped %d malformed rows in %s", skipped, path)
+
+
+def merged_readings(args, worker=0, workers=1):
+    """All archives merged by timestamp; each archive is in append (time) order already."""
+    streams = []
+    for sensor_type, (file_name, _, _) in ARCHIVES.items():
+        path = os.path.join(args.data_dir, file_name)
+        if os.path.exists(path):
+            streams.append(read_archive(path, sensor_type, args.since, args.until, worker, workers))
+        else:
+            log.warning("No %s archive at %s", sensor_type, path)
+    return heapq.merge(*streams, key=itemgetter(0))
+
+
+def load_rules(args):
+    return RuleBook(args.rules).current if args.rules else rule_book().current
+
+
+def replay_partition(args, worker, workers):
+    """Offline detection over one partition of the rooms; returns (readings, [(timestamp, floor, room, flags), ...])."""
+    rules = load_rules(args)
+    temporal_rules = parse_rules(args.temporal_rules, rules) if args.temporal_rules is not None else None
+    temporal_filter = TemporalFilter(rules=temporal_rules, faults=rules)
+    anomaly_detector = AnomalyDetector()
+    silence_monitor = SilenceMonitor()
+    threshold_table = ThresholdTable()
+    if args.overrides:
+        threshold_table.load(OverrideLoader(threshold_table).fetch())
+
+    faults = []
+    readings = 0
+    for timestamp, routing_key, message in merged_readings(args, worker, workers):
+        # The archive's clock drives the silence deadlines
+        for silent_key in silence_monitor.expired(now=timestamp):
+            floor, room, sensor_type = silent_key.split('.')
+            faults.append((timestamp, floor, room, rules.mask(f'{sensor_type}_silent')))
+        silence_monitor.seen(routing_key, now=timestamp)
+
+        sensor_type = routing_key.rsplit('.', 1)[-1]
+        fault_flags = evaluate_reading(routing_key, sensor_type, message, rules,
+                                       temporal_filter, anomaly_detector, threshold_table)[2]
+        if fault_flags:
+            floor, room, _ = routing_key.split('.')
+            faults.append((timestamp, floor, room, fault_flags))
+        readings += 1
+    return readings, faults
+
+
+def _replay_worker(job):
+    args, worker, workers = job
+    return replay_partition(args, worker, workers)
+
+
+def read_faults(path, rules, since=None, until=None):
+    """faults.csv -> {(floor, room, device type): [(timestamp, flags), ...]} for the non-zero rows."""
+    faults = defaultdict(list)
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            try:
+                timestamp, floor, room, flags = int(row[0]), row[1], row[2], int(row[3])
+            except (ValueError, IndexError):
+                continue
+            if not flags or (since and timestamp < since) or (until and timestamp >= until):
+                continue
+            for device_type, device_flags in rules.split(flags):
+                faults[(floor, room, device_type)].append((timestamp, device_flags))
+    return faults
+
+
+def by_device(faults, rules):
+    grouped = defaultdict(list)
+    for timestamp, floor, room, flags in faults:
+        for device_type, device_flags in rules.split(flags):
+            grouped[(floor, room, device_type)].append((timestamp, device_flags))
+    return grouped
+
+
+def diff_faults(recorded, replayed, tolerance):
+    """
+    Pairs recorded and replayed faults of the same room and device within
+    tolerance seconds. Yields (status, timestamp, floor, room, device type, recorded flags, replayed flags)
+    with status same, changed, removed (only recorded) or added (only replayed).
+    """
+    for key in sorted(set(recorded) | set(replayed)):
+        floor, room, device_type = key
+        old = sorted(recorded.get(key, ()))
+        new = sorted(replayed.get(key, ()))
+        i = j = 0
+        while i < len(old) or j < len(new):
+            if j == len(new) or (i < len(old) and old[i][0] < new[j][0] - tolerance):
+                yield 'removed', old[i][0], floor, room, device_type, old[i][1], 0
+                i += 1
+            elif i == len(old) or new[j][0] < old[i][0] - tolerance:
+                yield 'added', new[j][0], floor, room, device_type, 0, new[j][1]
+                j += 1
+            else:
+                status = 'same' if old[i][1] == new[j][1] else 'changed'
+                yield status, new[j][0], floor, room, device_type, old[i][1], new[j][1]
+                i += 1
+                j += 1
+
+
+def run_offline(args):
+    started = time.perf_counter()
+    if args.processes > 1:
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.map(_replay_worker, [(args, worker, args.processes) for worker in range(args.processes)])
+    else:
+        results = [replay_partition(args, 0, 1)]
+    readings = sum(count for count, _ in results)
+    faults = sorted(fault for _, partition in results for fault in partition)
+    elapsed = time.perf_counter() - started
+    log.info("Replayed %d readings in %.1fs (%.0f readings/s), %d faults",
+             readings, elapsed, readings / elapsed if elapsed else 0, len(faults))
+
+    if args.out:
+        with open(args.out, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['timestamp', 'floor', 'room', 'fault_flags'])
+            writer.writerows(faults)
+        log.info("Wrote replayed faults to %s", args.out)
+
+    if not os.path.exists(args.faults):
+        log.warning("No %s to compare against", args.faults)
+        return
+    rules = load_rules(args)
+    counts = dict.fromkeys(('same', 'changed', 'removed', 'added'), 0)
+    with open(args.diff, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['status', 'timestamp', 'floor', 'room', 'device_type', 'recorded_flags', 'replayed_flags'])
+        recorded = read_faults(args.faults, rules, args.since, args.until)
+        for row in diff_faults(recorded, by_device(faults, rules), args.tolerance):
+            counts[row[0]] += 1
+            if row[0] != 'same':
+                writer.writerow(row)
+    log.info("Fault diff against %s written to %s", args.faults, args.diff, **counts)
+
+
+def run_publish(args):
+    from hotel_common.publisher import BatchPublisher, EnvelopePublisher
+
+    publisher = BatchPublisher('hotel_sensors', quiet=True).start()
+    envelopes = EnvelopePublisher(publisher, wire.publish_content_type())
+    start = time.monotonic()
+    first = offset = None
+    sent = 0
+    last_report = start
+    try:
+        for timestamp, routing_key, message in merged_readings(args):
+            if first is None:
+                first = timestamp
+                offset = int(time.time()) - timestamp if args.rebase else 0
+            if args.speed > 0:
+                ahead = (timestamp - first) / args.speed - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+            if offset:
+                message['timestamp'] = timestamp + offset
+            envelopes.add(routing_key, message)
+            sent += 1
+
+            now = time.monotonic()
+            if now - last_report >= 10:
+                log.info("Republished %d readings, %.1f readings/s, archive time %d", sent, sent / (now - start), timestamp)
+                last_report = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        envelopes.close()
+        publisher.close()
+    log.info("Republished %d readings in %.1fs", sent, time.monotonic() - start)
+
+
+def main():
+    data_dir = os.path.dirname(os.getenv('CSV_PATH', '/app/data/faults.csv'))
+    parser = argparse.ArgumentParser(description='Replays the sensor CSV archives through fault detection or the broker')
+    parser.add_argument('--mode', choices=('offline', 'publish'), default='offline')
+    parser.add_argument('--data-dir', default=data_dir, help='Directory with iaq_data.csv, power_data.csv and presence_data.csv')
+    parser.add_argument('--since', type=int, help='First Unix timestamp to replay')
+    parser.add_argument('--until', type=int, help='Replay readings before this Unix timestamp')
+    parser.add_argument('--rules', help='fault_rules.json to evaluate with (default FAULT_RULES_PATH)')
+    parser.add_argument('--temporal-rules', help='TEMPORAL_RULES to evaluate with (default the environment)')
+    parser.add_argument('--overrides', action='store_true', help='Apply the threshold overrides from the database')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--faults', default=os.path.join(data_dir, 'faults.csv'), help='Recorded faults to diff against')
+    parser.add_argument('--out', help='Write the replayed faults to this CSV')
+    parser.add_argument('--diff', default=os.path.join(data_dir, 'fault_diff.csv'))
+    parser.add_argument('--tolerance', type=int, default=5, help='Seconds between a recorded and a replayed fault that still match')
+    parser.add_argument('--speed', type=float, default=0, help='Publish mode: speed-up over recorded time, 0 = unthrottled')
+    parser.add_argument('--rebase', action='store_true', help='Publish mode: shift timestamps so the first reading is now')
+    args = parser.parse_args()
+
+    logs.configure()
+    if args.mode == 'offline':
+        run_offline(args)
+    else:
+        run_publish(args)
+
+
+if __name__ == "__main__":
+    main()
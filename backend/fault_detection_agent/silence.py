@@ -0,0 +1,96 @@
+"""
+Detects sensors that stop sending.
+
+Each floor.room.sensor has a deadline of last reading + its timeout
+(SILENCE_TIMEOUTS, e.g. "iaq=600,power=600,presence=600"; 0 disables a type).
+A reading only moves the deadline in a dict; the heap holds at most one entry
+per sensor and is only touched when that entry comes due, so a check costs
+O(log n) per sensor that is actually due instead of a scan of all sensors.
+A silent sensor is reported once and re-armed by its next reading.
+
+A sharded detector only sees the rooms the consistent-hash ring gives it, and a
+room moves to another shard when the ring changes. So in sharded mode a sensor
+is reported only while its room still sends this shard other readings; when the
+whole room has gone quiet the room is taken to have moved and its sensors are
+forgotten until they send here again. The consumer runtime also calls reset()
+after a reconnect, when the queue may have been bound anew and deadlines that
+passed while the broker was away say nothing about the sensors.
+"""
+import heapq
+import os
+import time
+
+# Each raises the <sensor type>_silent fault of fault_rules.json
+SENSOR_TYPES = ('iaq', 'power', 'presence')
+
+# The agents pick one of 15 rooms every 5 seconds, so a room can go minutes without a reading
+DEFAULT_TIMEOUT = 600
+
+
+def parse_timeouts(text):
+    timeouts = dict.fromkeys(SENSOR_TYPES, float(DEFAULT_TIMEOUT))
+    for part in filter(None, (p.strip() for p in (text or '').split(','))):
+        sensor_type, _, seconds = part.partition('=')
+        if sensor_type.strip() not in SENSOR_TYPES:
+            raise ValueError(f"Unknown sensor type '{sensor_type}' in SILENCE_TIMEOUTS")
+        timeouts[sensor_type.strip()] = float(seconds)
+    return timeouts
+
+
+class SilenceMonitor:
+    def __init__(self, timeouts=None, sharded=False):
+        self.timeouts = timeouts or parse_timeouts(os.getenv('SILENCE_TIMEOUTS'))
+        self.sharded = sharded
+        # routing key -> monotonic deadline
+        self.due = {}
+        self.silent = set()
+        # floor.room -> monotonic time of its last reading of any type
+        self.room_seen = {}
+        self._heap = []
+
+    def reset(self):
+        """Forget every sensor; each is tracked again from its next reading."""
+        self.due.clear()
+        self.silent.clear()
+        self.room_seen.clear()
+        self._heap.clear()
+
+    def seen(self, routing_key, now=None):
+        """Record a reading; returns True if the sensor had been reported silent."""
+        room, _, sensor_type = routing_key.rpartition('.')
+        timeout = self.timeouts.get(sensor_type)
+        if not timeout:
+            return False
+        now = time.monotonic() if now is None else now
+        self.room_seen[room] = now
+        recovered = routing_key in self.silent
+        scheduled = routing_key in self.due and not recovered
+        self.due[routing_key] = now + timeout
+        if not scheduled:
+            heapq.heappush(self._heap, (now + timeout, routing_key))
+        if recovered:
+            self.silent.discard(routing_key)
+        return recovered
+
+    def expired(self, now=None):
+        """Routing keys whose deadline passed since the last call."""
+        now = time.monotonic() if now is None else now
+        heap = self._heap
+        silent = []
+        while heap and heap[0][0] <= now:
+            _, routing_key = heapq.heappop(heap)
+            due = self.due[routing_key]
+            if due > now:
+                # Readings arrived since this entry was pushed; wait for the new deadline
+                heapq.heappush(heap, (due, routing_key))
+            elif self.sharded and self._room_moved(routing_key, due):
+                del self.due[routing_key]
+            else:
+                self.silent.add(routing_key)
+                silent.append(routing_key)
+        return silent
+
+    def _room_moved(self, routing_key, due):
+        room, _, sensor_type = routing_key.rpartition('.')
+        # Nothing at all from the room since this sensor's last reading
+        return self.room_seen.get(room, 0) <= due - self.timeouts[sensor_type]
@@ -0,0 +1,140 @@
+"""
+Stateful filtering of the per-reading fault bits from detect_and_prepare_fault.
+
+For every floor.room.sensor the last M raw results of each fault bit are kept
+as a bit history in one int. A bit is raised when it was set in at least N of
+the last M readings and its current run (since the history was last empty) has
+lasted `sustain` seconds. Once raised it stays raised until `clear`
+consecutive healthy readings (hysteresis). A fault is published when a bit is
+raised; while it stays raised identical faults are suppressed, except for a
+reminder every FAULT_REPEAT_INTERVAL seconds (0 never repeats).
+
+Rules come from TEMPORAL_RULES, e.g.
+
+    TEMPORAL_RULES="co2_high:n=3,m=5,sustain=30,clear=3;power_spike:n=2,m=4"
+
+with `default:...` applying to every bit not listed; names are the faults of
+hotel_common/fault_rules.json. Unset, every bit uses n=1, m=1, sustain=0,
+clear=1: the first faulty reading raises it and the first healthy one clears
+it, so only repeats within an ongoing fault are dropped.
+"""
+import os
+from collections import namedtuple
+
+from hotel_common.fault_rules import rule_book
+from hotel_common.log import get_logger
+
+log = get_logger('temporal_rules')
+
+# History is kept in a Python int, but M is capped to keep the state small
+MAX_WINDOW = 64
+
+
+# The masks select the readings kept, the last m (window) and the last `clear` of a history
+Rule = namedtuple('Rule', ['n', 'm', 'sustain', 'clear', 'history_mask', 'window_mask', 'clear_mask'])
+
+
+def make_rule(n=1, m=1, sustain=0, clear=1):
+    n, m, clear = int(n), int(m), int(clear)
+    if not 1 <= n <= m <= MAX_WINDOW or not 1 <= clear <= MAX_WINDOW:
+        raise ValueError(f"Need 1 <= n <= m <= {MAX_WINDOW} and 1 <= clear <= {MAX_WINDOW}, got n={n} m={m} clear={clear}")
+    return Rule(n, m, float(sustain), clear, (1 << max(m, clear)) - 1, (1 << m) - 1, (1 << clear) - 1)
+
+
+DEFAULT_RULE = make_rule()
+
+
+def parse_rules(text, faults=None):
+    """'co2_high:n=3,m=5;default:clear=2' -> {bit position: Rule} for every fault in fault_rules.json."""
+    faults = (faults or rule_book().current).faults
+    specs = {}
+    for part in filter(None, (p.strip() for p in (text or '').split(';'))):
+        name, _, params = part.partition(':')
+        name = name.strip()
+        if name != 'default' and name not in faults:
+            raise ValueError(f"Unknown fault '{name}' in TEMPORAL_RULES")
+        specs[name] = make_rule(**dict(p.strip().split('=', 1) for p in params.split(',') if p.strip()))
+    default = specs.get('default', DEFAULT_RULE)
+    return {fault.bit: specs.get(name, default) for name, fault in faults.items()}
+
+
+class SensorState:
+    """Rolling state of one floor.room.sensor."""
+
+    __slots__ = ('history', 'onset', 'active', 'published_at')
+
+    def __init__(self, bits):
+        self.history = [0] * len(bits)
+        self.onset = [None] * len(bits)
+        self.active = 0
+        self.published_at = None
+
+
+class TemporalFilter:
+    def __init__(self, rules=None, repeat_interval=None, faults=None):
+        faults = faults or rule_book().current
+        self.rules = rules or parse_rules(os.getenv('TEMPORAL_RULES'), faults)
+        self.sensor_bits = faults.sensor_bits
+        self.repeat_interval = (float(os.getenv('FAULT_REPEAT_INTERVAL', '300'))
+                                if repeat_interval is None else repeat_interval)
+        self.states = {}
+
+    def reload(self, old_faults, faults):
+        """RuleBook.on_reload callback: follow renumbered or added fault bits."""
+        try:
+            self.rules = parse_rules(os.getenv('TEMPORAL_RULES'), faults)
+        except ValueError as e:
+            log.error("TEMPORAL_RULES no longer match the fault rules, using the defaults: %s", e)
+            self.rules = parse_rules(None, faults)
+        self.sensor_bits = faults.sensor_bits
+        changed = {sensor_type for sensor_type in set(old_faults.sensor_bits) | set(faults.sensor_bits)
+                   if old_faults.sensor_bits.get(sensor_type) != faults.sensor_bits.get(sensor_type)}
+        if changed:
+            # Histories are indexed by bit position, so those sensors start over
+            for routing_key in [k for k in self.states if k.rsplit('.', 1)[-1] in changed]:
+                del self.states[routing_key]
+
+    def update(self, routing_key, raw_flags, timestamp):
+        """
+        Feed one reading's raw fault bits; returns the flags to publish (0 for nothing).
+        Readings of one sensor must arrive in order, which the per-room ordering of the runtime guarantees.
+        """
+        sensor_type = routing_key.rsplit('.', 1)[-1]
+        bits = self.sensor_bits.get(sensor_type)
+        if bits is None:
+            return raw_flags
+        state = self.states.get(routing_key)
+        if state is None:
+            if not raw_flags:
+                # Healthy sensors without history need no state
+                return 0
+            state = self.states[routing_key] = SensorState(bits)
+
+        raised = 0
+        for i, bit in enumerate(bits):
+            rule = self.rules[bit]
+            mask = 1 << bit
+            faulty = raw_flags & mask
+            history = ((state.history[i] << 1) | (1 if faulty else 0)) & rule.history_mask
+            state.history[i] = history
+
+            if not history:
+                state.onset[i] = None
+            elif faulty and state.onset[i] is None:
+                state.onset[i] = timestamp
+
+            if state.active & mask:
+                if not history & rule.clear_mask:
+                    state.active &= ~mask
+            elif (faulty and bin(history & rule.window_mask).count('1') >= rule.n
+                    and timestamp - state.onset[i] >= rule.sustain):
+                state.active |= mask
+                raised |= mask
+
+        if raised or (state.active and self.repeat_interval
+                      and timestamp - state.published_at >= self.repeat_interval):
+            state.published_at = timestamp
+            return state.active
+        if not state.active and not any(state.history):
+            del self.states[routing_key]
+        return 0
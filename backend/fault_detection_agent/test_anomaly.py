@@ -0,0 +1,75 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from anomaly import AnomalyDetector
+from hotel_common.fault_rules import rule_book
+
+RULES = rule_book().current
+KEY = 'floor1.room1.power'
+
+
+def steady(detector, count, seed=1):
+    rng = random.Random(seed)
+    for _ in range(count):
+        detector.update(KEY, {'power_kw': 10 + rng.uniform(-0.5, 0.5)}, 0, RULES)
+
+
+class AnomalyDetectorTests(unittest.TestCase):
+    def detector(self, **kwargs):
+        return AnomalyDetector(alpha=0.1, z_threshold=4, warmup=20, **kwargs)
+
+    def test_outlier_after_warmup(self):
+        detector = self.detector()
+        steady(detector, 100)
+        flags, details = detector.update(KEY, {'power_kw': 30}, 0, RULES)
+        self.assertEqual(flags, RULES.mask('power_anomaly'))
+        self.assertTrue(details[0].startswith('power_kw=30'))
+
+    def test_quiet_during_warmup(self):
+        detector = self.detector()
+        steady(detector, 5)
+        self.assertEqual(detector.update(KEY, {'power_kw': 30}, 0, RULES), (0, None))
+
+    def test_faulty_reading_stays_out_of_the_baseline(self):
+        detector = self.detector()
+        steady(detector, 100)
+        mean = list(detector.mean)
+        self.assertEqual(detector.update(KEY, {'power_kw': 80}, RULES.mask('power_spike'), RULES), (0, None))
+        self.assertEqual(list(detector.mean), mean)
+
+    def test_baseline_follows_a_lasting_shift(self):
+        detector = self.detector()
+        steady(detector, 100)
+        flagged = [detector.update(KEY, {'power_kw': 20}, 0, RULES)[0] for _ in range(200)]
+        self.assertTrue(flagged[0])
+        self.assertFalse(flagged[-1])
+
+    def test_presence_has_no_baseline(self):
+        self.assertEqual(self.detector().update('floor1.room1.presence', {'presence': 1}, 0, RULES), (0, None))
+
+    def test_checkpoint_round_trip(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'anomaly_state.pkl')
+        detector = self.detector(checkpoint_path=path)
+        steady(detector, 100)
+        detector.checkpoint()
+        restored = self.detector(checkpoint_path=path).restore()
+        self.assertEqual(restored.slots, detector.slots)
+        self.assertEqual(list(restored.mean), list(detector.mean))
+        self.assertEqual(restored.update(KEY, {'power_kw': 30}, 0, RULES)[0], RULES.mask('power_anomaly'))
+
+    def test_unreadable_checkpoint_is_ignored(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'anomaly_state.pkl')
+        with open(path, 'wb') as f:
+            f.write(b'not a pickle')
+        self.assertEqual(self.detector(checkpoint_path=path).restore().slots, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
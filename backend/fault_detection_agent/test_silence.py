@@ -0,0 +1,76 @@
+import unittest
+
+from silence import SilenceMonitor, parse_timeouts
+
+KEY = 'floor1.room1.iaq'
+
+
+class SilenceMonitorTests(unittest.TestCase):
+    def monitor(self):
+        return SilenceMonitor(parse_timeouts('iaq=60,power=0'))
+
+    def test_reported_once_after_timeout(self):
+        monitor = self.monitor()
+        monitor.seen(KEY, now=0)
+        self.assertEqual(monitor.expired(now=59), [])
+        self.assertEqual(monitor.expired(now=60), [KEY])
+        self.assertEqual(monitor.expired(now=1000), [])
+        self.assertEqual(monitor.silent, {KEY})
+
+    def test_readings_move_the_deadline(self):
+        monitor = self.monitor()
+        monitor.seen(KEY, now=0)
+        monitor.seen(KEY, now=50)
+        self.assertEqual(monitor.expired(now=60), [])
+        # The heap holds one entry per sensor however many readings arrive
+        self.assertEqual(len(monitor._heap), 1)
+        self.assertEqual(monitor.expired(now=110), [KEY])
+
+    def test_next_reading_rearms(self):
+        monitor = self.monitor()
+        monitor.seen(KEY, now=0)
+        monitor.expired(now=60)
+        self.assertTrue(monitor.seen(KEY, now=100))
+        self.assertEqual(monitor.silent, set())
+        self.assertEqual(monitor.expired(now=160), [KEY])
+
+    def test_disabled_type(self):
+        monitor = self.monitor()
+        self.assertFalse(monitor.seen('floor1.room1.power', now=0))
+        self.assertEqual(monitor.expired(now=10 ** 6), [])
+
+    def test_reset_forgets_sensors(self):
+        monitor = self.monitor()
+        monitor.seen(KEY, now=0)
+        monitor.expired(now=60)
+        monitor.seen('floor1.room2.iaq', now=0)
+        monitor.reset()
+        self.assertEqual(monitor.expired(now=1000), [])
+        self.assertEqual(monitor.silent, set())
+        # Tracked again from the next reading, as a new sensor
+        self.assertFalse(monitor.seen(KEY, now=1000))
+        self.assertEqual(monitor.expired(now=1060), [KEY])
+
+    def test_sharded_room_that_moved_away_is_forgotten(self):
+        monitor = SilenceMonitor(parse_timeouts('iaq=60,power=60'), sharded=True)
+        monitor.seen(KEY, now=0)
+        monitor.seen('floor1.room1.power', now=10)
+        monitor.seen('floor1.room2.iaq', now=0)
+        # Room 1 still sends power readings here, so its IAQ sensor is silent
+        monitor.seen('floor1.room1.power', now=50)
+        self.assertEqual(monitor.expired(now=60), [KEY])
+        # Room 2 sent nothing at all since: it hashes to another shard now
+        self.assertEqual(monitor.due.get('floor1.room2.iaq'), None)
+        self.assertEqual(monitor.expired(now=1000), [])
+        self.assertEqual(monitor.silent, {KEY})
+        self.assertFalse(monitor.seen('floor1.room2.iaq', now=1000))
+
+    def test_parse_timeouts(self):
+        timeouts = parse_timeouts('iaq=30, presence=0')
+        self.assertEqual((timeouts['iaq'], timeouts['power'], timeouts['presence']), (30.0, 600.0, 0.0))
+        with self.assertRaises(ValueError):
+            parse_timeouts('door=10')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+
+from anomaly import AnomalyDetector
+from fault_detection_agent import evaluate_reading
+from hotel_common.fault_rules import rule_book
+from temporal_rules import TemporalFilter, make_rule, parse_rules
+from thresholds import ThresholdTable
+
+KEY = 'floor1.room1.power'
+SPIKE = 1 << 7
+
+
+class TemporalFilterTests(unittest.TestCase):
+    def make_filter(self, text=None, repeat_interval=300):
+        return TemporalFilter(parse_rules(text), repeat_interval)
+
+    def test_defaults_publish_once_per_fault(self):
+        temporal_filter = self.make_filter()
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 0), SPIKE)
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 10), 0)
+        self.assertEqual(temporal_filter.update(KEY, 0, 20), 0)
+        self.assertNotIn(KEY, temporal_filter.states)
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 30), SPIKE)
+
+    def test_n_of_m(self):
+        temporal_filter = self.make_filter('power_spike:n=2,m=3')
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 0), 0)
+        self.assertEqual(temporal_filter.update(KEY, 0, 1), 0)
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 2), SPIKE)
+
+    def test_sustain(self):
+        temporal_filter = self.make_filter('power_spike:sustain=30')
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 0), 0)
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 29), 0)
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 30), SPIKE)
+
+    def test_clear_needs_consecutive_healthy_readings(self):
+        temporal_filter = self.make_filter('default:clear=2')
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 0), SPIKE)
+        temporal_filter.update(KEY, 0, 1)
+        self.assertEqual(temporal_filter.states[KEY].active, SPIKE)
+        temporal_filter.update(KEY, 0, 2)
+        self.assertNotIn(KEY, temporal_filter.states)
+
+    def test_reminder_while_raised(self):
+        temporal_filter = self.make_filter(repeat_interval=60)
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 0), SPIKE)
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 59), 0)
+        self.assertEqual(temporal_filter.update(KEY, SPIKE, 60), SPIKE)
+
+    def test_invalid_rules(self):
+        with self.assertRaises(ValueError):
+            make_rule(n=3, m=2)
+        with self.assertRaises(ValueError):
+            parse_rules('no_such_fault:n=1')
+
+
+class EvaluateReadingTests(unittest.TestCase):
+    def evaluate(self, temporal_filter, message):
+        return evaluate_reading(KEY, 'power', message, rule_book().current, temporal_filter,
+                                AnomalyDetector(), ThresholdTable())
+
+    def test_reminder_on_healthy_reading(self):
+        # The bit is held by clear=3, so the reminder is due on a healthy reading
+        temporal_filter = TemporalFilter(parse_rules('default:clear=3'), 300)
+        self.evaluate(temporal_filter, {'timestamp': 0, 'power_kw': 50})
+        _, raw_flags, fault_flags, fault_payload, fault_routing_key = self.evaluate(
+            temporal_filter, {'timestamp': 400, 'power_kw': 10})
+        self.assertEqual(raw_flags, 0)
+        self.assertEqual(fault_flags, SPIKE)
+        self.assertEqual(fault_payload['fault_flags'], SPIKE)
+        # Stamped with the reading's clock, like the healthy readings auto-resolution counts
+        self.assertEqual(fault_payload['timestamp'], 400)
+        self.assertEqual(fault_routing_key, 'floor1.room1.fault')
+
+    def test_healthy_reading(self):
+        temporal_filter = TemporalFilter(parse_rules(None), 300)
+        _, _, fault_flags, fault_payload, _ = self.evaluate(temporal_filter, {'timestamp': 0, 'power_kw': 10})
+        self.assertEqual(fault_flags, 0)
+        self.assertIsNone(fault_payload)
+
+    def test_fault_takes_the_reading_timestamp(self):
+        temporal_filter = TemporalFilter(parse_rules(None), 300)
+        _, _, _, fault_payload, _ = self.evaluate(temporal_filter, {'timestamp': 1700000000, 'power_kw': 50})
+        self.assertEqual(fault_payload['timestamp'], 1700000000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import asyncio
+import unittest
+
+from hotel_common.fault_rules import RuleBook
+from thresholds import OverrideLoader, ThresholdTable, routing_key_scopes
+
+RULES = RuleBook().current
+KEY = 'floor1.room2.power'
+
+
+def spike(rules, evaluators, power_kw):
+    flags, _ = rules.evaluate('power', {'power_kw': power_kw}, evaluators)
+    return bool(flags & rules.mask('power_spike'))
+
+
+class ThresholdTableTests(unittest.TestCase):
+    def test_room_beats_floor_beats_building(self):
+        table = ThresholdTable()
+        table.load([(None, None, 'power_spike', 30), (1, None, 'power_spike', 20), (1, 2, 'power_spike', 10)])
+        self.assertTrue(spike(RULES, table.evaluators(RULES, KEY), 15))
+        self.assertFalse(spike(RULES, table.evaluators(RULES, 'floor1.room3.power'), 15))
+        self.assertTrue(spike(RULES, table.evaluators(RULES, 'floor1.room3.power'), 25))
+        self.assertFalse(spike(RULES, table.evaluators(RULES, 'floor2.room2.power'), 25))
+        self.assertTrue(spike(RULES, table.evaluators(RULES, 'floor2.room2.power'), 35))
+
+    def test_rooms_without_overrides_share_the_rules_evaluators(self):
+        table = ThresholdTable()
+        table.load([(1, 2, 'co2_high', 700)])
+        self.assertIs(table.evaluators(RULES, 'floor3.room1.power'), RULES.evaluators['power'])
+        # An override for another device type leaves the sensor alone too
+        self.assertIs(table.evaluators(RULES, KEY), RULES.evaluators['power'])
+        self.assertIsNot(table.evaluators(RULES, 'floor1.room2.iaq'), RULES.evaluators['iaq'])
+
+    def test_evaluators_are_cached_per_routing_key(self):
+        table = ThresholdTable()
+        table.load([(1, 2, 'power_spike', 10)])
+        evaluators = table.evaluators(RULES, KEY)
+        self.assertIs(table.evaluators(RULES, KEY), evaluators)
+        # New overrides and reloaded rules both start the cache over
+        table.load([(1, 2, 'power_spike', 40)])
+        self.assertIsNot(table.evaluators(RULES, KEY), evaluators)
+        self.assertFalse(spike(RULES, table.evaluators(RULES, KEY), 15))
+        reloaded = RuleBook().current
+        self.assertIsNot(table.evaluators(reloaded, KEY), table.evaluators(RULES, KEY))
+
+    def test_odd_routing_keys_use_the_rules(self):
+        table = ThresholdTable()
+        table.load([(None, None, 'power_spike', 10)])
+        self.assertIs(table.evaluators(RULES, 'lobby.meter.power'), RULES.evaluators['power'])
+        self.assertEqual(routing_key_scopes('floor2.room13.iaq'), (2, 13, 'iaq'))
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql):
+        if self.database.fail:
+            raise ConnectionError('database is down')
+        self.database.queries += 1
+        self.result = self.database.version if sql.startswith('SELECT count') else self.database.rows
+
+    def fetchone(self):
+        return self.result
+
+    def fetchall(self):
+        return self.result
+
+
+class FakeDatabase:
+    def __init__(self, rows):
+        self.rows = rows
+        self.version = (len(rows), 1)
+        self.fail = False
+        self.queries = 0
+        self.connections = 0
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class OverrideLoaderTests(unittest.TestCase):
+    def loader(self, database):
+        table = ThresholdTable()
+        loader = OverrideLoader(table)
+        loader.enabled = True
+
+        def connect():
+            database.connections += 1
+            database.closed = False
+            return database
+
+        loader._connect = connect
+        return table, loader
+
+    def test_reads_the_table_only_when_it_changed(self):
+        database = FakeDatabase([(1, 2, 'power_spike', 10)])
+        table, loader = self.loader(database)
+        asyncio.run(loader.refresh())
+        self.assertEqual(table.overrides, {(1, 2): {'power_spike': 10}})
+        self.assertIsNone(loader.fetch())
+        database.rows, database.version = [], (0, 2)
+        asyncio.run(loader.refresh())
+        self.assertEqual(table.overrides, {})
+
+    def test_failed_refresh_keeps_overrides_and_reconnects(self):
+        database = FakeDatabase([(1, 2, 'power_spike', 10)])
+        table, loader = self.loader(database)
+        asyncio.run(loader.refresh())
+        database.fail = True
+        database.version = (1, 2)
+        asyncio.run(loader.refresh())
+        self.assertEqual(table.overrides, {(1, 2): {'power_spike': 10}})
+        self.assertTrue(database.closed)
+        database.fail = False
+        asyncio.run(loader.refresh())
+        self.assertEqual(database.connections, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
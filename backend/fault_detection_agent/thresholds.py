@@ -0,0 +1,125 @@
+"""
+Per-floor and per-room threshold overrides from the fault_threshold_overrides table.
+
+Every THRESHOLD_REFRESH_INTERVAL seconds (default 60) a worker thread checks the
+table's row count and newest updated_at and, only when they changed, reads the
+whole table; the event loop then swaps in the new overrides between messages, so
+consumption never waits on the database. Overrides resolve room, then floor,
+then building-wide, then fault_rules.json.
+
+On the hot path a reading costs one dict lookup by routing key: the first
+reading of a floor.room.sensor compiles its evaluators once, every following
+one reuses them until the overrides or the rules file change. Rooms without
+overrides share the rules' own evaluators.
+
+The database comes from the same DATABASE_* variables as the Django backend;
+without DATABASE_HOST the overrides stay empty.
+"""
+import asyncio
+import os
+
+from hotel_common.log import get_logger
+
+log = get_logger('thresholds')
+
+VERSION_SQL = "SELECT count(*), max(updated_at) FROM fault_threshold_overrides"
+OVERRIDES_SQL = "SELECT floor, room, fault, threshold FROM fault_threshold_overrides"
+
+
+def routing_key_scopes(routing_key):
+    """floor2.room3.iaq -> (2, 3, 'iaq')"""
+    floor, room, sensor_type = routing_key.split('.')
+    return int(floor[5:]), int(room[4:]), sensor_type
+
+
+class ThresholdTable:
+    def __init__(self):
+        # (floor, room) -> {fault name: threshold}; None stands for "any"
+        self.overrides = {}
+        # routing key -> compiled evaluators, built on first use
+        self._evaluators = {}
+        self._rules = None
+
+    def load(self, rows):
+        """rows of (floor, room, fault, threshold); replaces all overrides."""
+        overrides = {}
+        for floor, room, fault, threshold in rows:
+            overrides.setdefault((floor, room), {})[fault] = threshold
+        self.overrides = overrides
+        self._evaluators = {}
+
+    def evaluators(self, rules, routing_key):
+        """The evaluators for one floor.room.sensor under rules (a FaultRules)."""
+        if rules is not self._rules:
+            # fault_rules.json was reloaded
+            self._rules = rules
+            self._evaluators = {}
+        evaluators = self._evaluators.get(routing_key)
+        if evaluators is None:
+            evaluators = self._evaluators[routing_key] = self._compile(rules, routing_key)
+        return evaluators
+
+    def _compile(self, rules, routing_key):
+        try:
+            floor, room, sensor_type = routing_key_scopes(routing_key)
+        except ValueError:
+            return rules.evaluators.get(routing_key.rsplit('.', 1)[-1], ())
+        thresholds = rules.resolve_thresholds(self.overrides, floor, room, sensor_type)
+        if not thresholds:
+            return rules.evaluators.get(sensor_type, ())
+        return rules.compile(sensor_type, thresholds)
+
+
+class OverrideLoader:
+    """Reads fault_threshold_overrides on a worker thread and refreshes a ThresholdTable."""
+
+    def __init__(self, table):
+        self.table = table
+        self.interval = float(os.getenv('THRESHOLD_REFRESH_INTERVAL', '60'))
+        self.enabled = bool(os.getenv('DATABASE_HOST'))
+        self._connection = None
+        self._version = None
+
+    def _connect(self):
+        import psycopg
+        return psycopg.connect(
+            host=os.getenv('DATABASE_HOST'),
+            port=os.getenv('DATABASE_PORT') or 5432,
+            dbname=os.getenv('DATABASE_NAME'),
+            user=os.getenv('DATABASE_USER'),
+            password=os.getenv('DATABASE_PASSWORD'),
+            autocommit=True,
+            connect_timeout=10,
+        )
+
+    def fetch(self):
+        """Blocking; returns the override rows, or None when the table has not changed."""
+        if self._connection is None or self._connection.closed:
+            self._connection = self._connect()
+        try:
+            with self._connection.cursor() as cursor:
+                cursor.execute(VERSION_SQL)
+                version = cursor.fetchone()
+                if version == self._version:
+                    return None
+                cursor.execute(OVERRIDES_SQL)
+                rows = cursor.fetchall()
+        except Exception:
+            # Reconnect on the next refresh
+            self._connection.close()
+            raise
+        self._version = version
+        return rows
+
+    async def refresh(self):
+        """For AsyncConsumerRuntime.add_periodic."""
+        if not self.enabled:
+            return
+        try:
+            rows = await asyncio.get_running_loop().run_in_executor(None, self.fetch)
+        except Exception as e:
+            log.warning("Could not refresh threshold overrides, keeping the current ones: %s", e)
+            return
+        if rows is not None:
+            self.table.load(rows)
+            log.info("Loaded %d threshold overrides", len(rows))
@@ -0,0 +1,272 @@
+import asyncio
+import functools
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import aio_pika
+
+from hotel_common import wire
+from hotel_common.connection import ConnectionManager
+from hotel_common.dedup import DedupCache
+from hotel_common.log import get_logger
+from hotel_common.metrics import (HANDLER_SECONDS, MESSAGES_CONSUMED, MESSAGES_DEDUPLICATED, MESSAGES_PUBLISHED,
+                                  PUBLISHED_AT_HEADER, QUEUE_LAG_SECONDS, queue_lag, routing_key_label)
+
+log = get_logger('consumer')
+
+# What a queue handler receives for every message
+Delivery = namedtuple('Delivery', ['body', 'routing_key', 'content_type', 'headers', 'redelivered'])
+
+# Messages whose handler kept failing are routed through this exchange into <queue>.dead
+DEAD_LETTER_EXCHANGE = 'dead_letters'
+
+
+def queue_arguments(queue):
+    """Arguments every queue is declared with, so the messages it rejects are dead-lettered."""
+    return {'x-dead-letter-exchange': DEAD_LETTER_EXCHANGE, 'x-dead-letter-routing-key': queue}
+
+
+def dead_letter_queue(queue):
+    return f"{queue}.dead"
+
+
+def ordering_key(routing_key):
+    """
+    Messages sharing this key are handled strictly in arrival order.
+    floor1.room2.iaq and floor1.room2.fault both map to floor1.room2.
+    """
+    return '.'.join(routing_key.split('.')[:2])
+
+
+class AsyncConsumerRuntime:
+    """
+    Runs several queue handlers on one asyncio AMQP connection.
+
+    Up to max_in_flight messages are processed concurrently across all queues,
+    while messages for the same floor/room are processed one after another. An
+    envelope of many rooms' readings (see hotel_common.wire) is split into one
+    delivery per room first, so each room only waits for its own messages; the
+    envelope is acked once all of them are handled.
+    Handlers are either coroutine functions (run on the event loop) or plain
+    functions (run in a worker thread, for blocking DB/HTTP I/O). Both get a
+    Delivery. A message is acked once its handler returns. If the handler
+    raises, it is called again up to retries times (CONSUMER_RETRIES, default 3)
+    after a delay that starts at retry_delay seconds (CONSUMER_RETRY_DELAY,
+    default 1) and doubles, still ahead of the room's later messages; after the
+    last failure the message is rejected and the broker moves it to the queue's
+    dead-letter queue <queue>.dead, from where it can be shovelled back. A
+    message identical to one handled recently (see hotel_common.dedup) is acked
+    without calling the handler.
+    """
+
+    def __init__(self, url=None, max_in_flight=None, prefetch_count=None, dedup=None, retries=None,
+                 retry_delay=None):
+        self.connections = ConnectionManager(url)
+        self.max_in_flight = max_in_flight or int(os.getenv('CONSUMER_MAX_IN_FLIGHT', '32'))
+        # Prefetch more than we run so a busy room does not starve the others
+        self.prefetch_count = prefetch_count or self.max_in_flight * 2
+        self.retries = int(os.getenv('CONSUMER_RETRIES', '3')) if retries is None else retries
+        self.retry_delay = float(os.getenv('CONSUMER_RETRY_DELAY', '1')) if retry_delay is None else retry_delay
+        self.channel = None
+        self._exchange_types = {}
+        self._exchange_bindings = []
+        self._exchanges = {}
+        self._handlers = []
+        self._periodic = []
+        self._reconnect_callbacks = []
+        self._tasks = []
+        self._tails = {}
+        self._semaphore = None
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        # Only touched on the event loop; duplicates share a routing key, so they run one after another
+        self.dedup = dedup if dedup is not None else DedupCache()
+
+    def declare_exchange(self, name, exchange_type='topic', arguments=None):
+        self._exchange_types.setdefault(name, (exchange_type, arguments))
+
+    def bind_exchange(self, destination, source, routing_key):
+        self.declare_exchange(source)
+        self._exchange_bindings.append((destination, source, routing_key))
+
+    def declare_queue(self, queue, exchange, routing_keys, handler=None, exclusive=False):
+        """
+        Declare and bind a durable queue; it is consumed only if a handler is given.
+        An exclusive queue, and its dead letter queue, is deleted by the broker when
+        this process's connection closes, for queues named after a single run.
+        """
+        self.declare_exchange(exchange)
+        if isinstance(routing_keys, str):
+            routing_keys = [routing_keys]
+        self._handlers.append((queue, handler, exchange, list(routing_keys), exclusive))
+
+    def add_handler(self, queue, handler, exchange, routing_keys, exclusive=False):
+        self.declare_queue(queue, exchange, routing_keys, handler, exclusive)
+
+    def add_periodic(self, interval, callback):
+        """Run the coroutine function callback() on the event loop every interval seconds once consuming."""
+        self._periodic.append((interval, callback))
+
+    def on_reconnect(self, callback):
+        """Call callback() on the event loop whenever the connection is restored after a loss."""
+        self._reconnect_callbacks.append(callback)
+
+    def _reconnected(self, connection):
+        for callback in self._reconnect_callbacks:
+            callback()
+
+    async def _every(self, interval, callback):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await callback()
+            except Exception as e:
+                log.error("Error in periodic %s: %s", getattr(callback, '__name__', callback), e)
+
+    async def publish(self, exchange, routing_key, body, content_type=None):
+        await self._exchanges[exchange].publish(
+            aio_pika.Message(body=body, content_type=content_type,
+                             headers={PUBLISHED_AT_HEADER: time.time()}),
+            routing_key=routing_key
+        )
+        MESSAGES_PUBLISHED.labels(exchange, routing_key_label(routing_key)).inc()
+
+    async def _call(self, handler, delivery):
+        if asyncio.iscoroutinefunction(handler):
+            await handler(delivery)
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, handler, delivery)
+
+    async def _settle(self, ack_or_reject):
+        try:
+            await ack_or_reject
+        except Exception as e:
+            # The channel died with the connection; the broker redelivers after the reconnect
+            log.warning("Could not settle message: %s", e)
+
+    async def _handle(self, handler, delivery):
+        """Calls the handler, retrying failures; raises the last error once the retries are used up."""
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._call(handler, delivery)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                log.warning("Error handling message from %s, retrying in %.0fs: %s", delivery.routing_key, delay, e,
+                            attempt=attempt + 1)
+                await asyncio.sleep(delay)
+
+    def _deliveries(self, message):
+        """The message as Deliveries: an envelope of many rooms becomes one per room, so rooms do not wait for each other."""
+        headers = message.headers or {}
+        if message.routing_key.startswith(f"{wire.ENVELOPE_ROOMS}."):
+            try:
+                parts = wire.split_rooms(message.routing_key.rsplit('.', 1)[-1], message.body, message.content_type,
+                                         message.routing_key)
+            except ValueError:
+                # Left whole for the handler to report
+                parts = None
+            if parts:
+                return [Delivery(body, routing_key, content_type, headers, message.redelivered)
+                        for routing_key, body, content_type in parts]
+        return [Delivery(message.body, message.routing_key, message.content_type, headers, message.redelivered)]
+
+    async def _dispatch(self, queue, handler, message):
+        deliveries = self._deliveries(message)
+        # Chain every part onto the previous message for its room before the first await,
+        # so the chains follow delivery order
+        links = []
+        for delivery in deliveries:
+            key = ordering_key(delivery.routing_key)
+            done = asyncio.get_running_loop().create_future()
+            links.append((key, self._tails.get(key), done))
+            self._tails[key] = done
+
+        outcomes = await asyncio.gather(*(
+            self._process(queue, handler, delivery, index == 0, *link)
+            for index, (delivery, link) in enumerate(zip(deliveries, links))
+        ))
+        # Settled once all parts are done; a redelivery skips the parts that succeeded as duplicates
+        if 'error' in outcomes:
+            outcome = 'error'
+            log.error("Moving message from %s to %s", message.routing_key, dead_letter_queue(queue))
+            await self._settle(message.reject(requeue=False))
+        else:
+            outcome = 'duplicate' if all(o == 'duplicate' for o in outcomes) else 'ok'
+            await self._settle(message.ack())
+        MESSAGES_CONSUMED.labels(queue, routing_key_label(message.routing_key), outcome).inc()
+
+    async def _process(self, queue, handler, delivery, observe_lag, key, previous, done):
+        """Runs the handler on one delivery after the room's previous one; returns the outcome."""
+        try:
+            if previous is not None:
+                await previous
+            dedup_key = DedupCache.key(delivery.routing_key, delivery.body) if self.dedup.enabled else None
+            if dedup_key is not None and self.dedup.seen(dedup_key):
+                MESSAGES_DEDUPLICATED.labels(queue).inc()
+                log.sampled('message_duplicate', "Dropped duplicate message from %s", delivery.routing_key,
+                            redelivered=delivery.redelivered)
+                return 'duplicate'
+            async with self._semaphore:
+                lag = queue_lag(delivery.headers) if observe_lag else None
+                if lag is not None:
+                    QUEUE_LAG_SECONDS.labels(queue).observe(lag)
+                started = time.perf_counter()
+                try:
+                    await self._handle(handler, delivery)
+                except Exception as e:
+                    log.error("Error handling message from %s: %s", delivery.routing_key, e)
+                    return 'error'
+                finally:
+                    HANDLER_SECONDS.labels(queue).observe(time.perf_counter() - started)
+                if dedup_key is not None:
+                    self.dedup.add(dedup_key)
+                return 'ok'
+        finally:
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+    async def run(self):
+        self.channel = await self.connections.channel('consume', prefetch_count=self.prefetch_count)
+        self.connections.connection.reconnect_callbacks.add(self._reconnected)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        for name, (exchange_type, arguments) in self._exchange_types.items():
+            self._exchanges[name] = await self.channel.declare_exchange(name, exchange_type, arguments=arguments)
+        for destination, source, routing_key in self._exchange_bindings:
+            await self._exchanges[destination].bind(self._exchanges[source], routing_key=routing_key)
+
+        dead_letters = await self.channel.declare_exchange(DEAD_LETTER_EXCHANGE, 'direct', durable=True)
+        for queue_name, handler, exchange, routing_keys, exclusive in self._handlers:
+            dead = await self.channel.declare_queue(dead_letter_queue(queue_name), durable=not exclusive,
+                                                    exclusive=exclusive)
+            await dead.bind(dead_letters, routing_key=queue_name)
+            queue = await self.channel.declare_queue(queue_name, durable=not exclusive, exclusive=exclusive,
+                                                     arguments=queue_arguments(queue_name))
+            for routing_key in routing_keys:
+                await queue.bind(self._exchanges[exchange], routing_key=routing_key)
+            if handler is not None:
+                await queue.consume(functools.partial(self._dispatch, queue_name, handler))
+
+        self._tasks = [asyncio.create_task(self._every(interval, callback)) for interval, callback in self._periodic]
+
+        consumed = [h[0] for h in self._handlers if h[1] is not None]
+        log.info("Consuming %s", ', '.join(consumed),
+                 max_in_flight=self.max_in_flight, prefetch=self.prefetch_count)
+        try:
+            await asyncio.Future()
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await self.connections.close()
+            self._executor.shutdown(wait=True)
+
+    def run_forever(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            log.info("Shutting down...")
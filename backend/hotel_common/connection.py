@@ -0,0 +1,114 @@
+import asyncio
+import os
+import random
+import time
+
+import aio_pika
+
+from hotel_common.log import get_logger
+
+MAX_RECONNECT_DELAY = 30
+
+log = get_logger('connection')
+
+
+def amqp_url():
+    rabbitmq_user = os.getenv('RABBITMQ_USER', 'guest')
+    rabbitmq_pass = os.getenv('RABBITMQ_PASS', 'guest')
+    rabbitmq_host = os.getenv('RABBITMQ_HOST', 'rabbitmq')
+    rabbitmq_port = int(os.getenv('RABBITMQ_PORT', '5672'))
+    # A missed heartbeat closes a dead TCP connection instead of hanging on it
+    heartbeat = int(os.getenv('RABBITMQ_HEARTBEAT', '30'))
+    return (f"amqp://{rabbitmq_user}:{rabbitmq_pass}@{rabbitmq_host}:{rabbitmq_port}/"
+            f"?heartbeat={heartbeat}&reconnect_interval=1")
+
+
+class ResilientConnection(aio_pika.RobustConnection):
+    """
+    RobustConnection that backs off exponentially while the broker is down.
+
+    aio-pika re-reads reconnect_interval before every attempt; waiting as long
+    as we have already been disconnected doubles the delay each time, up to
+    MAX_RECONNECT_DELAY. Channels, QoS, exchanges, queues, bindings and
+    consumers are re-declared by aio-pika once the connection is back.
+    """
+
+    _disconnected_at = None
+
+    @property
+    def reconnect_interval(self):
+        if self._disconnected_at is None:
+            return self._min_reconnect_delay
+        down_for = time.monotonic() - self._disconnected_at
+        return min(max(down_for, self._min_reconnect_delay), MAX_RECONNECT_DELAY)
+
+    @reconnect_interval.setter
+    def reconnect_interval(self, value):
+        self._min_reconnect_delay = value
+
+    async def _on_connection_close(self, closing):
+        if self._disconnected_at is None and self.connection_attempt and not self._close_called:
+            self._disconnected_at = time.monotonic()
+            log.warning("Lost connection to RabbitMQ, reconnecting...")
+        await super()._on_connection_close(closing)
+
+    async def _on_connected(self):
+        await super()._on_connected()
+        if self._disconnected_at is not None:
+            down_for = time.monotonic() - self._disconnected_at
+            log.info("Reconnected to RabbitMQ after %.1fs, topology restored", down_for)
+            self._disconnected_at = None
+
+
+async def connect(url=None):
+    """Connect to RabbitMQ, retrying with exponential backoff and jitter until it is up."""
+    url = url or amqp_url()
+    delay = 1
+    attempt = 1
+    while True:
+        try:
+            return await aio_pika.connect_robust(url, connection_class=ResilientConnection)
+        except Exception as e:
+            log.warning("Connection failed (%s), retrying in %ss (attempt %d)...", e, delay, attempt)
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            attempt += 1
+
+
+class ConnectionManager:
+    """
+    One robust connection per process (per event loop), with channels reused by name.
+
+    Topology declared through these channels survives broker restarts and
+    heartbeat timeouts, so consumers resume without a process restart.
+    """
+
+    def __init__(self, url=None):
+        self.url = url or amqp_url()
+        self.connection = None
+        self._channels = {}
+        self._lock = None
+
+    async def connect(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.connection is None:
+                self.connection = await connect(self.url)
+        return self.connection
+
+    async def channel(self, name='default', prefetch_count=None, publisher_confirms=True):
+        channel = self._channels.get(name)
+        if channel is None:
+            connection = await self.connect()
+            channel = await connection.channel(publisher_confirms=publisher_confirms)
+            if prefetch_count:
+                await channel.set_qos(prefetch_count=prefetch_count)
+            self._channels[name] = channel
+        return channel
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.close()
+        self.connection = None
+        self._channels = {}
@@ -0,0 +1,64 @@
+"""
+Bounded cache of recently handled messages, so a message the broker delivers
+again (its ack was lost with a connection, or a publisher replayed it after a
+missing confirm) is acked and dropped before it reaches the database.
+
+A message is identified by a 16-byte BLAKE2b digest of its routing key and
+body; bodies carry the readings' timestamps, so this is the (routing key,
+timestamp, payload) of every reading in it. Entries are kept in insertion
+order and evicted when older than DEDUP_TTL seconds (default 600) or beyond
+DEDUP_CACHE_SIZE entries (default 100000, 0 disables), about 100 bytes each.
+
+Only messages whose handler returned are added, so handlers must raise on
+failures worth a retry (database or HTTP errors) and return only for messages
+they will never be able to handle. The cache lives in the consumer process and
+starts empty after a restart: the redeliveries that follow one reach the
+handlers. Readings are upserts on the unique (time, sensor_id), so those add no
+rows. Faults are looked up on (time, floor, room, device_type) before they are
+inserted, which catches a redelivery handled after the first copy committed;
+equipment_faults has no unique constraint on those columns, so two consumers
+handling copies of one message at the same moment can still both insert.
+"""
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+
+class DedupCache:
+    def __init__(self, size=None, ttl=None):
+        self.size = int(os.getenv('DEDUP_CACHE_SIZE', '100000')) if size is None else size
+        self.ttl = float(os.getenv('DEDUP_TTL', '600')) if ttl is None else ttl
+        self._seen = OrderedDict()  # digest -> monotonic time it was added
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    @staticmethod
+    def key(routing_key, body):
+        digest = hashlib.blake2b(routing_key.encode(), digest_size=16)
+        digest.update(b'\0')
+        digest.update(body)
+        return digest.digest()
+
+    def seen(self, key, now=None):
+        added = self._seen.get(key)
+        if added is None:
+            return False
+        return (now or time.monotonic()) - added <= self.ttl
+
+    def add(self, key, now=None):
+        now = now or time.monotonic()
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        # Oldest first, so expired entries and the overflow are all at the front
+        expired = now - self.ttl
+        while self._seen:
+            oldest_key, added = next(iter(self._seen.items()))
+            if added >= expired and len(self._seen) <= self.size:
+                break
+            del self._seen[oldest_key]
+
+    def __len__(self):
+        return len(self._seen)
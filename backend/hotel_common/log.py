@@ -0,0 +1,149 @@
+"""
+Logging for the agents and consumers.
+
+    LOG_LEVEL             DEBUG, INFO (default), WARNING or ERROR
+    LOG_FORMAT            text (default, "<unix time> - message key=value") or json
+    LOG_SAMPLE_EVERY      per-message events log one in this many occurrences (default 100, 1 logs all)
+    LOG_SUMMARY_INTERVAL  seconds between "summary" lines with event counts (default 60, 0 disables)
+
+Per-message events go through sampled(), which counts every occurrence for the
+summary but only formats and writes a sample of them. Faults are logged with
+fault() at their own FAULT level, which LOG_LEVEL never filters out.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+FAULT = 35
+logging.addLevelName(FAULT, 'FAULT')
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{int(record.created)} - {record.getMessage()}"
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class EventCounts:
+    """Occurrences per event: running totals for sampling, per-interval counts for the summary."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = Counter()
+        self._interval = Counter()
+
+    def add(self, event):
+        with self._lock:
+            self._totals[event] += 1
+            self._interval[event] += 1
+            return self._totals[event]
+
+    def take(self):
+        with self._lock:
+            counts, self._interval = self._interval, Counter()
+        return counts
+
+
+_counts = EventCounts()
+_sample_every = max(int(os.getenv('LOG_SAMPLE_EVERY', '100')), 1)
+_summary_thread = None
+
+
+class EventLog:
+    """Thin wrapper over a stdlib logger that passes key=value fields through to the formatter."""
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def _log(self, level, msg, args, fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, *args, extra={'fields': fields} if fields else None)
+
+    def debug(self, msg, *args, **fields):
+        self._log(logging.DEBUG, msg, args, fields)
+
+    def info(self, msg, *args, **fields):
+        self._log(logging.INFO, msg, args, fields)
+
+    def warning(self, msg, *args, **fields):
+        self._log(logging.WARNING, msg, args, fields)
+
+    def error(self, msg, *args, **fields):
+        _counts.add('error')
+        self._log(logging.ERROR, msg, args, fields)
+
+    def fault(self, msg, *args, **fields):
+        """Always written, whatever LOG_LEVEL and sampling are set to."""
+        _counts.add('fault')
+        self._log(FAULT, msg, args, fields)
+
+    def sampled(self, event, msg, *args, level=logging.INFO, **fields):
+        """
+        A high-volume per-message event: counted every time, written one in
+        LOG_SAMPLE_EVERY times. Pass %-style args so skipped lines are never formatted.
+        """
+        if _counts.add(event) % _sample_every == 1 or _sample_every == 1:
+            if _sample_every > 1:
+                fields['sample_every'] = _sample_every
+            self._log(level, msg, args, fields)
+
+    def count(self, event):
+        """Only count the event for the periodic summary."""
+        _counts.add(event)
+
+
+def get_logger(name):
+    return EventLog(name)
+
+
+def _summarize(interval):
+    log = get_logger('summary')
+    while True:
+        time.sleep(interval)
+        counts = _counts.take()
+        if counts:
+            log.info("summary", interval_s=interval, **counts)
+
+
+def configure():
+    """Install the stdout handler on the root logger and start the summary thread (idempotent)."""
+    global _summary_thread
+    root = logging.getLogger()
+    if not any(getattr(handler, 'hotel_common', False) for handler in root.handlers):
+        handler = logging.StreamHandler(sys.stdout)
+        handler.hotel_common = True
+        handler.setFormatter(JsonFormatter() if os.getenv('LOG_FORMAT') == 'json' else TextFormatter())
+        root.addHandler(handler)
+        level = logging.getLevelName(os.getenv('LOG_LEVEL', 'INFO').upper())
+        if not isinstance(level, int):
+            level = logging.INFO
+        # Faults pass even with LOG_LEVEL=ERROR
+        root.setLevel(min(level, FAULT))
+
+    interval = float(os.getenv('LOG_SUMMARY_INTERVAL', '60'))
+    if interval > 0 and _summary_thread is None:
+        _summary_thread = threading.Thread(target=_summarize, args=(interval,), name='log-summary', daemon=True)
+        _summary_thread.start()
@@ -0,0 +1,93 @@
+import os
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from hotel_common.log import get_logger
+
+# Sub-millisecond work (detection, parsing) up to slow DB/HTTP round trips
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Header the publishers stamp on every message, read back by the consumers for queue lag
+PUBLISHED_AT_HEADER = 'published_at'
+
+MESSAGES_CONSUMED = Counter(
+    'hotel_messages_consumed_total', 'Messages handled by a queue consumer',
+    ['queue', 'routing_key', 'outcome'])
+MESSAGES_PUBLISHED = Counter(
+    'hotel_messages_published_total', 'Messages confirmed by the broker',
+    ['exchange', 'routing_key'])
+MESSAGES_DEDUPLICATED = Counter(
+    'hotel_messages_deduplicated_total', 'Messages dropped as already handled', ['queue'])
+PUBLISH_REPLAYED = Counter(
+    'hotel_publish_replayed_total', 'Unconfirmed messages put back for replay', ['exchange'])
+PUBLISH_OUTBOX = Gauge(
+    'hotel_publish_outbox_messages', 'Messages waiting in the publisher outbox', ['exchange'])
+PUBLISH_SPOOL = Gauge(
+    'hotel_publish_spool_messages', 'Messages waiting in the disk spool', ['exchange'])
+PUBLISH_SPOOL_DROPPED = Counter(
+    'hotel_publish_spool_dropped_total', 'Unsent messages dropped because the disk spool was full', ['exchange'])
+HANDLER_SECONDS = Histogram(
+    'hotel_handler_seconds', 'Time spent in a queue handler per message',
+    ['queue'], buckets=LATENCY_BUCKETS)
+QUEUE_LAG_SECONDS = Histogram(
+    'hotel_queue_lag_seconds', 'Time from publish until a consumer starts handling the message',
+    ['queue'], buckets=LAG_BUCKETS)
+DETECTION_SECONDS = Histogram(
+    'hotel_detection_seconds', 'Time spent in fault detection per reading',
+    ['sensor_type'], buckets=LATENCY_BUCKETS)
+FAULTS_SUPPRESSED = Counter(
+    'hotel_faults_suppressed_total', 'Faulty readings not published by the temporal rules', ['sensor_type'])
+FAULTS_CORRELATED = Counter(
+    'hotel_faults_correlated_total', 'Faults that are part of an incident', ['device_type'])
+SILENT_SENSORS = Gauge(
+    'hotel_silent_sensors', 'Sensors currently past their expected reading interval')
+DB_WRITE_SECONDS = Histogram(
+    'hotel_db_write_seconds', 'Time spent writing one batch of rows to TimescaleDB',
+    ['table'], buckets=LATENCY_BUCKETS)
+SUPABASE_SYNC_SECONDS = Histogram(
+    'hotel_supabase_sync_seconds', 'Time spent syncing rows to Supabase',
+    ['table'], buckets=LATENCY_BUCKETS)
+SUPABASE_SYNC_FAILURES = Counter(
+    'hotel_supabase_sync_failures_total', 'Failed Supabase syncs', ['table'])
+SUPABASE_SYNC_PENDING = Gauge(
+    'hotel_supabase_sync_pending', 'Rows stored in TimescaleDB and waiting for Supabase', ['table'])
+SUPABASE_SYNC_DROPPED = Counter(
+    'hotel_supabase_sync_dropped_total', 'Rows dropped from a full Supabase sync queue', ['table'])
+API_REQUEST_SECONDS = Histogram(
+    'hotel_api_request_seconds', 'API request latency',
+    ['view', 'method', 'status'], buckets=LATENCY_BUCKETS)
+
+
+def routing_key_label(routing_key):
+    """
+    floor1.room2.iaq -> *.*.iaq
+
+    Keeps one series per message kind; one per room would grow with the building.
+    """
+    return '*.*.' + routing_key.rsplit('.', 1)[-1]
+
+
+def queue_lag(headers):
+    """Seconds since the message was published, or None if it carries no publish time."""
+    published_at = headers.get(PUBLISHED_AT_HEADER)
+    if published_at is None:
+        return None
+    return max(time.time() - float(published_at), 0.0)
+
+
+def start_metrics_server(default_port, port=None):
+    """Serve /metrics over HTTP on port, else METRICS_PORT, else default_port (0 disables)."""
+    if port is None:
+        port = int(os.getenv('METRICS_PORT', default_port))
+    if not port:
+        return None
+    try:
+        start_http_server(port)
+    except OSError as e:
+        get_logger('metrics').warning("Could not serve metrics on port %d: %s", port, e)
+        return None
+    get_logger('metrics').info("Serving metrics on :%d/metrics", port)
+    return port
@@ -0,0 +1,165 @@
+"""
+Opt-in sampling profiler for the agents and consumers.
+
+While enabled, a background thread samples the Python stack of every thread
+that is on the CPU (state R in /proc; all threads where /proc is missing)
+every PROFILE_SAMPLE_INTERVAL seconds and, once per PROFILE_WINDOW seconds,
+writes to PROFILE_DIR (default /app/data/profiles):
+
+    <service>-<pid>-<time>.cpu.collapsed     stack samples, one "frame;frame;frame count" per line
+    <service>-<pid>-<time>.alloc.collapsed   live allocations by traceback, weighted by bytes
+    <service>-<pid>-<time>.tracemalloc       raw tracemalloc snapshot (tracemalloc.Snapshot.load)
+
+The .collapsed files are the folded format read by flamegraph.pl, speedscope
+and inferno. Profiling starts with PROFILE=1, and can be switched on and off
+without a restart by sending SIGUSR1 or by creating/removing PROFILE_TRIGGER_FILE
+(default /app/data/profile.on). PROFILE_TRACEMALLOC=0 skips the allocation snapshots.
+"""
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from hotel_common.log import get_logger
+
+log = get_logger('profiling')
+
+PROC_TASKS = '/proc/self/task'
+
+
+def thread_running(native_id):
+    """True if the thread is on the CPU, i.e. not blocked on I/O, a lock, a sleep or the GIL."""
+    try:
+        with open(f"{PROC_TASKS}/{native_id}/stat", 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return False
+    # The state follows the parenthesised thread name, which may itself contain spaces
+    return stat[stat.rindex(b')') + 2:stat.rindex(b')') + 3] == b'R'
+
+
+class Profiler:
+    def __init__(self, service, output_dir=None, interval=None, window=None,
+                 trigger_file=None, trace_allocations=None):
+        self.service = service
+        self.output_dir = output_dir or os.getenv('PROFILE_DIR', '/app/data/profiles')
+        self.interval = interval or float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.01'))
+        self.window = window or float(os.getenv('PROFILE_WINDOW', '60'))
+        self.trigger_file = trigger_file or os.getenv('PROFILE_TRIGGER_FILE', '/app/data/profile.on')
+        if trace_allocations is None:
+            trace_allocations = os.getenv('PROFILE_TRACEMALLOC', '1') == '1'
+        self.trace_allocations = trace_allocations
+
+        self._requested = os.getenv('PROFILE') == '1'
+        self._active = False
+        self._samples = Counter()
+        self._labels = {}
+        self._window_start = None
+        self._per_thread_state = os.path.isdir(PROC_TASKS)
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def install(self):
+        """Start the control thread and, from the main thread, the SIGUSR1 toggle."""
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self._toggle)
+        self._thread.start()
+        return self
+
+    def _toggle(self, signum, frame):
+        self._requested = not self._requested
+
+    def _enabled(self):
+        return self._requested or os.path.exists(self.trigger_file)
+
+    def _run(self):
+        last_check = 0
+        enabled = False
+        while True:
+            now = time.monotonic()
+            # Checking the trigger file costs a syscall, so only once a second
+            if now - last_check >= 1:
+                enabled = self._enabled()
+                last_check = now
+            if enabled and not self._active:
+                self._start()
+            elif not enabled and self._active:
+                self._stop()
+
+            if self._active:
+                self._sample()
+                if now - self._window_start >= self.window:
+                    self._flush()
+                time.sleep(self.interval)
+            else:
+                time.sleep(1)
+
+    def _start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start(int(os.getenv('PROFILE_TRACEMALLOC_FRAMES', '16')))
+        self._active = True
+        self._window_start = time.monotonic()
+        log.info("Profiling %s every %ss into %s", self.service, self.interval, self.output_dir)
+
+    def _stop(self):
+        self._flush()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._active = False
+        log.info("Profiling %s stopped", self.service)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+            self._labels[code] = label
+        return label
+
+    def _sample(self):
+        own = threading.get_ident()
+        threads = {thread.ident: thread for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            thread = threads.get(thread_id)
+            if thread_id == own or thread is None:
+                continue
+            if self._per_thread_state and not thread_running(thread.native_id):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(thread.name)
+            stack.reverse()
+            self._samples[';'.join(stack)] += 1
+
+    def _flush(self):
+        prefix = os.path.join(self.output_dir, f"{self.service}-{os.getpid()}-{int(time.time())}")
+        samples, self._samples = self._samples, Counter()
+        self._window_start = time.monotonic()
+        try:
+            with open(prefix + '.cpu.collapsed', 'w') as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot().filter_traces((
+                    tracemalloc.Filter(False, tracemalloc.__file__, all_frames=True),
+                    tracemalloc.Filter(False, __file__, all_frames=True),
+                ))
+                snapshot.dump(prefix + '.tracemalloc')
+                with open(prefix + '.alloc.collapsed', 'w') as f:
+                    for stat in snapshot.statistics('traceback'):
+                        # Frames run from the oldest call to the allocation site
+                        stack = ';'.join(f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in stat.traceback)
+                        f.write(f"{stack} {stat.size}\n")
+        except OSError as e:
+            log.error("Could not write profile %s: %s", prefix, e)
+            return
+        log.info("Wrote profile %s (%d samples)", prefix, sum(samples.values()))
+
+
+def install(service):
+    """Install the profiler for this process; it stays idle until switched on."""
+    return Profiler(service).install()
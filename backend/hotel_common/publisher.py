@@ -0,0 +1,343 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+import aio_pika
+
+from hotel_common import wire
+from hotel_common.aio_consumer import ordering_key
+from hotel_common.connection import ConnectionManager
+from hotel_common.log import get_logger
+from hotel_common.metrics import (MESSAGES_PUBLISHED, PUBLISH_OUTBOX, PUBLISH_REPLAYED, PUBLISH_SPOOL,
+                                  PUBLISH_SPOOL_DROPPED, PUBLISHED_AT_HEADER, routing_key_label)
+from hotel_common.sharding import room_headers
+from hotel_common.spool import Spool
+
+log = get_logger('publisher')
+
+
+class BatchPublisher:
+    """
+    Publishes to one exchange with publisher confirms, in batches, from a background thread.
+
+    publish() only appends to a bounded in-memory outbox, so the caller's loop
+    never waits on the broker round trip. The background thread takes up to
+    batch_size messages at once and sends the rooms side by side, each room's
+    messages one after another. A message leaves the outbox once the broker
+    confirmed it. A room stops at its first message nacked or lost in a dropped
+    connection; that message and the rest of the room's stay at the front of
+    the outbox in order and are replayed after the reconnect, so no message
+    overtakes an earlier one of its room and none is sent twice. When the
+    outbox is full, publish() blocks until there is room.
+
+    With a spool directory (spool_dir or SPOOL_DIR) publish() never blocks: it
+    appends to a disk spool (see hotel_common.spool) that the background thread
+    reads into the outbox, and a message leaves the spool once confirmed. So
+    nothing is lost while the broker is unreachable, also before the first
+    connect, or when the agent stops meanwhile; the next start sends it. After a
+    failed send, and on a start with messages left over, the spool is replayed
+    at up to SPOOL_DRAIN_RATE messages/s (default 500) until it has caught up.
+
+    In quiet mode callers skip per-message output and only the aggregated
+    rates printed every stats_interval seconds remain.
+    """
+
+    def __init__(self, exchange, url=None, batch_size=None, max_outbox=None,
+                 flush_interval=None, quiet=None, stats_interval=10, spool_dir=None):
+        self.exchange = exchange
+        self.url = url
+        self.batch_size = batch_size or int(os.getenv('PUBLISH_BATCH_SIZE', '100'))
+        self.max_outbox = max_outbox or int(os.getenv('PUBLISH_MAX_OUTBOX', '10000'))
+        self.flush_interval = flush_interval or float(os.getenv('PUBLISH_FLUSH_INTERVAL', '0.5'))
+        self.quiet = os.getenv('PUBLISH_QUIET') == '1' if quiet is None else quiet
+        self.stats_interval = stats_interval
+
+        self.published = 0
+        self.confirmed = 0
+        self.replayed = 0
+
+        spool_dir = spool_dir or os.getenv('SPOOL_DIR')
+        self.spool = Spool(spool_dir) if spool_dir else None
+        self.drain_rate = float(os.getenv('SPOOL_DRAIN_RATE', '500'))
+        self._last_drain = time.monotonic()
+        self._replaying = self.spool is not None and self.spool.pending() > 0
+        self._dropped = 0
+
+        # (routing key, body, headers, content type, spool position or None)
+        self._outbox = deque()
+        self._not_full = threading.Condition()
+        self._closing = False
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._thread = threading.Thread(target=self._run, name=f"publisher-{exchange}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def publish(self, routing_key, body, headers=None, content_type=None):
+        # Stamped here so the consumers' queue lag includes time spent in the outbox
+        headers = {**(headers or {}), PUBLISHED_AT_HEADER: time.time()}
+        if self.spool is not None:
+            self.spool.append(routing_key, body, headers, content_type)
+            self.published += 1
+            if self.spool.unread() >= self.batch_size:
+                self._wake()
+            return
+        with self._not_full:
+            while len(self._outbox) >= self.max_outbox:
+                self._not_full.wait()
+            self._outbox.append((routing_key, body, headers, content_type, None))
+            self.published += 1
+            full_batch = len(self._outbox) >= self.batch_size
+        if full_batch:
+            self._wake()
+
+    def close(self, timeout=30):
+        """Stop accepting work, flush what is left of the outbox and disconnect."""
+        self._closing = True
+        self._wake()
+        self._thread.join(timeout)
+        if self._thread.is_alive() and self._loop is not None:
+            # Broker still away: stop sending; whatever is unconfirmed stays in the spool
+            self._loop.call_soon_threadsafe(self._task.cancel)
+            self._thread.join(timeout)
+        if self.spool is not None and not self._thread.is_alive():
+            self.spool.close()
+
+    def pending(self):
+        return len(self._outbox) + (self.spool.unread() if self.spool is not None else 0)
+
+    def _wake(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _run(self):
+        try:
+            asyncio.run(self._main())
+        except asyncio.CancelledError:
+            pass
+
+    async def _connect(self):
+        connections = ConnectionManager(self.url)
+        channel = await connections.channel('publish', publisher_confirms=True)
+        exchange = await channel.declare_exchange(self.exchange, aio_pika.ExchangeType.TOPIC)
+        return connections, exchange
+
+    async def _send_batch(self, exchange):
+        with self._not_full:
+            batch = [self._outbox[i] for i in range(min(self.batch_size, len(self._outbox)))]
+        if not batch:
+            return True
+
+        rooms = {}
+        for i, message in enumerate(batch):
+            rooms.setdefault(ordering_key(message[0]), []).append(i)
+        sent = [False] * len(batch)
+
+        async def send_room(indexes):
+            for i in indexes:
+                routing_key, body, headers, content_type, _ = batch[i]
+                try:
+                    await exchange.publish(
+                        aio_pika.Message(body=body, headers=headers, content_type=content_type,
+                                         delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                        routing_key=routing_key
+                    )
+                except Exception:
+                    # The rest of the room waits for the replay, behind this message
+                    return
+                sent[i] = True
+
+        await asyncio.gather(*(send_room(indexes) for indexes in rooms.values()))
+
+        unsent = [message for message, ok in zip(batch, sent) if not ok]
+        confirmed = len(batch) - len(unsent)
+        # Only this thread removes from the left, so the batch is still at the front
+        with self._not_full:
+            for _ in batch:
+                self._outbox.popleft()
+            self._outbox.extendleft(reversed(unsent))
+            self._not_full.notify_all()
+            PUBLISH_OUTBOX.labels(self.exchange).set(len(self._outbox))
+        if self.spool is not None:
+            # The spool only commits a prefix: up to the first message still unsent
+            prefix = next((i for i, ok in enumerate(sent) if not ok), len(batch))
+            positions = [message[4] for message in batch[:prefix] if message[4] is not None]
+            if positions:
+                self.spool.commit(positions[-1])
+        self.confirmed += confirmed
+        self.replayed += len(unsent)
+        for message, ok in zip(batch, sent):
+            if ok:
+                MESSAGES_PUBLISHED.labels(self.exchange, routing_key_label(message[0])).inc()
+        if unsent:
+            PUBLISH_REPLAYED.labels(self.exchange).inc(len(unsent))
+            log.warning("%d of %d messages unconfirmed, will replay them", len(unsent), len(batch))
+        # Progress as long as the broker confirmed anything
+        return confirmed > 0
+
+    def _drain_spool(self):
+        """Moves spooled messages into the outbox, at up to drain_rate per second while replaying."""
+        now = time.monotonic()
+        room = self.max_outbox - len(self._outbox)
+        if self._replaying:
+            room = min(room, int((now - self._last_drain) * self.drain_rate), int(self.drain_rate))
+        if room < 1:
+            return
+        self._last_drain = now
+        records = self.spool.read(room)
+        with self._not_full:
+            for position, record in records:
+                self._outbox.append((*record, position))
+            PUBLISH_OUTBOX.labels(self.exchange).set(len(self._outbox))
+        if self._replaying and not self.spool.unread():
+            log.info("%s: spool replayed", self.exchange)
+            self._replaying = False
+
+    def _report(self, elapsed):
+        spool = f", spool {self.spool.pending()}" if self.spool is not None else ''
+        log.info("%s: published %.1f msg/s, confirmed %.1f msg/s, replayed %d, outbox %d/%d%s",
+                 self.exchange, self.published / elapsed, self.confirmed / elapsed, self.replayed,
+                 len(self._outbox), self.max_outbox, spool)
+        if self.spool is not None:
+            self.spool.flush()
+            PUBLISH_SPOOL.labels(self.exchange).set(self.spool.pending())
+            PUBLISH_SPOOL_DROPPED.labels(self.exchange).inc(self.spool.dropped - self._dropped)
+            self._dropped = self.spool.dropped
+        self.published = self.confirmed = self.replayed = 0
+
+    async def _main(self):
+        self._task = asyncio.current_task()
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        connections, exchange = await self._connect()
+
+        last_report = time.monotonic()
+        retry_delay = 1
+        while True:
+            if self.spool is not None:
+                self._drain_spool()
+            if await self._send_batch(exchange):
+                retry_delay = 1
+            else:
+                if self.spool is not None:
+                    self._replaying = True
+                # The robust connection reconnects on its own; give it time before replaying
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 30)
+
+            now = time.monotonic()
+            if now - last_report >= self.stats_interval:
+                self._report(now - last_report)
+                last_report = now
+
+            if self._closing and not self.pending():
+                break
+            if len(self._outbox) < self.batch_size and not self._closing:
+                timeout = self.flush_interval
+                if self.spool is not None and self.spool.unread():
+                    # Back for the next batch from the spool at the drain rate
+                    timeout = min(timeout, self.batch_size / self.drain_rate)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+        await connections.close()
+
+
+class EnvelopePublisher:
+    """
+    Packs readings into multi-reading envelopes (see hotel_common.wire) before
+    handing them to a BatchPublisher.
+
+    ENVELOPE_MODE picks the grouping:
+    - off (default): one message per reading, as before
+    - room: one message per floor.room.sensor per window; keeps per-room routing
+      and the detector sharding
+    - rooms: one message per sensor type per window for all rooms, on
+      envelope.rooms.<type>; for unsharded detectors only, as the sharded
+      exchange hashes a whole message to one shard
+
+    An envelope is sent once ENVELOPE_WINDOW seconds (default 1) passed since
+    its first reading, by a timer thread so readings never wait longer than that
+    for the next one, or once it holds ENVELOPE_MAX_READINGS (default 500), and
+    on close(). The consumers split many-room envelopes by room again before
+    ordering, so rooms are still handled side by side.
+    """
+
+    def __init__(self, publisher, content_type, mode=None, window=None, max_readings=None):
+        self.publisher = publisher
+        self.content_type = content_type
+        self.mode = mode or os.getenv('ENVELOPE_MODE', 'off')
+        if self.mode not in ('off', 'room', 'rooms'):
+            raise ValueError(f"ENVELOPE_MODE must be off, room or rooms, got '{self.mode}'")
+        self.window = window or float(os.getenv('ENVELOPE_WINDOW', '1'))
+        self.max_readings = max_readings or int(os.getenv('ENVELOPE_MAX_READINGS', '500'))
+        # envelope routing key -> [(routing key, reading), ...]
+        self._pending = {}
+        self._opened = {}
+        self._closed = False
+        self._changed = threading.Condition()
+        self._timer = None
+        if self.mode != 'off':
+            self._timer = threading.Thread(target=self._run_timer, name='envelope-timer', daemon=True)
+            self._timer.start()
+
+    def add(self, routing_key, message):
+        kind = routing_key.rsplit('.', 1)[-1]
+        if self.mode == 'off':
+            self.publisher.publish(routing_key, wire.encode(kind, message, self.content_type),
+                                   headers=room_headers(routing_key), content_type=self.content_type)
+            return
+        key = routing_key if self.mode == 'room' else f"{wire.ENVELOPE_ROOMS}.{kind}"
+        with self._changed:
+            readings = self._pending.get(key)
+            if readings is None:
+                readings = self._pending[key] = []
+                self._opened[key] = time.monotonic()
+                if len(self._opened) == 1:
+                    # The timer sleeps without a deadline while nothing is pending
+                    self._changed.notify()
+            readings.append((routing_key, message))
+            if len(readings) >= self.max_readings:
+                self._send(key)
+
+    def _run_timer(self):
+        with self._changed:
+            while not self._closed:
+                now = time.monotonic()
+                for key in [key for key, opened in self._opened.items() if now - opened >= self.window]:
+                    self._send(key)
+                first = min(self._opened.values(), default=None)
+                self._changed.wait(None if first is None else first + self.window - now)
+
+    def _send(self, key):
+        readings = self._pending.pop(key)
+        del self._opened[key]
+        kind = key.rsplit('.', 1)[-1]
+        if self.mode == 'room':
+            body = wire.encode_many(kind, [message for _, message in readings], self.content_type)
+            content_type = self.content_type
+        else:
+            body, content_type = wire.encode_rooms(
+                kind, [(ordering_key(routing_key), message) for routing_key, message in readings], self.content_type)
+        self.publisher.publish(key, body, headers=room_headers(key), content_type=content_type)
+
+    def flush(self):
+        with self._changed:
+            for key in list(self._pending):
+                self._send(key)
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            self._changed.notify()
+        if self._timer is not None:
+            self._timer.join()
+        self.flush()
@@ -0,0 +1,57 @@
+import os
+import socket
+
+from hotel_common.aio_consumer import ordering_key
+
+# Readings are re-routed from hotel_sensors into a consistent-hash exchange
+# (rabbitmq_consistent_hash_exchange plugin) that hashes the 'room' header,
+# so every reading of a room lands in the same detector shard queue.
+SHARD_EXCHANGE = 'hotel_sensors_sharded'
+ROOM_HEADER = 'room'
+
+
+def room_headers(routing_key):
+    """Headers agents attach to each reading so the sharded exchange can hash on the room."""
+    return {ROOM_HEADER: ordering_key(routing_key)}
+
+
+def shard_name():
+    """
+    Name of this detector shard from DETECTOR_SHARD, or None when sharding is off.
+    DETECTOR_SHARD=auto uses the hostname, which changes whenever the container is
+    recreated, so such shards get a queue that lives only as long as the process.
+    """
+    shard = os.getenv('DETECTOR_SHARD')
+    if not shard:
+        return None
+    if shard == 'auto':
+        return socket.gethostname()
+    return shard
+
+
+def shard_queue(shard):
+    return f"fault_detection_shard.{shard}"
+
+
+def shard_is_transient():
+    """True for DETECTOR_SHARD=auto, whose queue name does not survive the container."""
+    return os.getenv('DETECTOR_SHARD') == 'auto'
+
+
+def add_sharded_handler(runtime, shard, handler, weight=None):
+    """
+    Consume this shard's partition of the floor.room key space.
+
+    Each shard queue is bound to the consistent-hash exchange with a weight
+    (the binding key); a shard with weight 2 gets about twice the rooms of a
+    shard with weight 1. Adding or removing a shard only moves the rooms that
+    hash to it, and a room only ever lives in one queue, so per-room order holds.
+
+    Named shards keep a durable queue across restarts; an auto-named shard's queue
+    is exclusive, so it and its binding go away with the process and its rooms move
+    to the remaining shards instead of piling up in an orphaned queue.
+    """
+    weight = weight or os.getenv('DETECTOR_SHARD_WEIGHT', '1')
+    runtime.declare_exchange(SHARD_EXCHANGE, 'x-consistent-hash', arguments={'hash-header': ROOM_HEADER})
+    runtime.bind_exchange(SHARD_EXCHANGE, 'hotel_sensors', '*.#.*')
+    runtime.add_handler(shard_queue(shard), handler, SHARD_EXCHANGE, str(weight), exclusive=shard_is_transient())
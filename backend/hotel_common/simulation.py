@@ -0,0 +1,72 @@
+import random
+
+SENSOR_TYPES = ('iaq', 'power', 'presence')
+
+
+class FaultySlotClock:
+    """
+    Marks one randomly chosen send per minute as faulty.
+
+    The agents send every 5 seconds, so a minute has 12 slots; the load
+    generator sizes slots_per_minute from the configured sensor rate.
+    """
+
+    __slots__ = ('slots_per_minute', 'minute', 'faulty_slot', 'send_count')
+
+    def __init__(self, slots_per_minute=12):
+        self.slots_per_minute = slots_per_minute
+        self.minute = None
+        self.faulty_slot = None
+        self.send_count = 0
+
+    def start_minute(self, minute, rng=random):
+        self.minute = minute
+        self.faulty_slot = rng.randint(0, self.slots_per_minute - 1)
+        self.send_count = 0
+
+    def next_is_faulty(self):
+        is_faulty = self.send_count == self.faulty_slot
+        self.send_count += 1
+        return is_faulty
+
+
+def iaq_reading(timestamp, is_faulty, rng=random):
+    if not is_faulty:
+        return {
+            'timestamp': timestamp,
+            'temperature': round(rng.uniform(24.5, 33.0), 1),
+            'humidity': round(rng.uniform(41.1, 51.5), 1),
+            'co2': round(rng.uniform(464.0, 689.5), 1)
+        }
+    if rng.choice([True, False]):
+        # All zeros
+        return {'timestamp': timestamp, 'temperature': 0.0, 'humidity': 0.0, 'co2': 0.0}
+    # Out-of-range or partial zeros
+    temp = 0.0 if rng.random() < 0.3 else round(rng.uniform(40.0, 60.0), 1)
+    hum = 0.0 if rng.random() < 0.3 else round(rng.uniform(80.0, 100.0), 1)
+    co2 = 0.0 if rng.random() < 0.3 else round(rng.uniform(0.0, 1000.0), 1)
+    return {'timestamp': timestamp, 'temperature': temp, 'humidity': hum, 'co2': co2}
+
+
+def power_reading(timestamp, is_faulty, rng=random):
+    if is_faulty:
+        # Faulty data: not working
+        power_kw = 0.0
+    elif rng.random() < 0.1875:
+        power_kw = round(rng.uniform(45.0, 100.0), 1)  # Spike
+    else:
+        power_kw = round(rng.uniform(0.7, 5.0), 1)  # Normal
+    return {'timestamp': timestamp, 'power_kw': power_kw}
+
+
+def presence_reading(timestamp, is_faulty, rng=random):
+    # Faulty data: not reading
+    presence = 3 if is_faulty else rng.choice([0, 1])
+    return {'timestamp': timestamp, 'presence': presence}
+
+
+READING_GENERATORS = {
+    'iaq': iaq_reading,
+    'power': power_reading,
+    'presence': presence_reading,
+}
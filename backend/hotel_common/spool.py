@@ -0,0 +1,224 @@
+"""
+Append-only disk spool a BatchPublisher writes every message to before sending
+it, so the sampling loop never blocks on the broker and nothing is lost while
+it is down or slower than the agent, or when the agent stops meanwhile; the
+publisher sends it in order once the broker takes messages again.
+
+The spool is a directory (SPOOL_DIR) of fixed-size, memory-mapped segment files
+(SPOOL_SEGMENT_BYTES, default 8 MiB) named by sequence number, plus a 16-byte
+memory-mapped cursor (segment, offset) of the first record the broker has not
+confirmed. Every record is
+
+    uint32 body length, uint32 crc32, uint16 routing key, content type and
+    headers (JSON) lengths, then those four byte strings
+
+and a zero header marks the end of a segment's records. Segments behind the
+cursor are deleted. The segments never take more than SPOOL_MAX_BYTES (default
+1 GiB): when a new one would exceed it, the oldest are deleted with their
+records, which are counted in dropped. On start the spool is scanned from the cursor; a record
+cut short by a crash fails its crc and ends the spool there. Records between a
+confirm and the next cursor update may be sent twice after a crash, which the
+consumers' dedup cache absorbs.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from hotel_common.log import get_logger
+
+log = get_logger('spool')
+
+RECORD = struct.Struct('<IIHHH')
+CURSOR = struct.Struct('<QQ')
+SUFFIX = '.seg'
+
+
+class Segment:
+    def __init__(self, path, size=None):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if size is not None:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.path = path
+
+    def record_at(self, offset):
+        """(record, next offset) at offset, or None at the end of the records."""
+        if offset + RECORD.size > self.size:
+            return None
+        body_length, crc, key_length, type_length, headers_length = RECORD.unpack_from(self.map, offset)
+        if not key_length:
+            return None
+        start = offset + RECORD.size
+        end = start + key_length + type_length + headers_length + body_length
+        if end > self.size or zlib.crc32(self.map[start:end]) != crc:
+            return None
+        routing_key = self.map[start:start + key_length].decode()
+        start += key_length
+        content_type = self.map[start:start + type_length].decode() or None
+        start += type_length
+        headers = json.loads(self.map[start:start + headers_length])
+        body = bytes(self.map[start + headers_length:end])
+        return (routing_key, body, headers, content_type), end
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+
+class Spool:
+    def __init__(self, directory, segment_bytes=None, max_bytes=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes or int(os.getenv('SPOOL_SEGMENT_BYTES', str(8 << 20)))
+        self.max_bytes = max_bytes or int(os.getenv('SPOOL_MAX_BYTES', str(1 << 30)))
+        self.dropped = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        cursor_path = os.path.join(directory, 'cursor')
+        fd = os.open(cursor_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, CURSOR.size)
+            self._cursor = mmap.mmap(fd, CURSOR.size)
+        finally:
+            os.close(fd)
+
+        sequences = sorted(int(name[:-len(SUFFIX)]) for name in os.listdir(directory) if name.endswith(SUFFIX))
+        committed_sequence, committed_offset = CURSOR.unpack_from(self._cursor)
+        if committed_sequence not in sequences:
+            committed_sequence, committed_offset = (sequences[0], 0) if sequences else (0, 0)
+        for sequence in sequences:
+            if sequence < committed_sequence:
+                os.remove(self._path(sequence))
+        self._segments = {sequence: Segment(self._path(sequence))
+                          for sequence in sequences if sequence >= committed_sequence}
+        if not self._segments:
+            self._segments[committed_sequence] = Segment(self._path(committed_sequence), self.segment_bytes)
+
+        # Scan from the cursor: how many records are waiting and where the last one ends
+        self._write_sequence = max(self._segments)
+        self._write_offset = 0
+        pending = 0
+        # sequence -> number of the last record before the segment
+        self._first = {}
+        for sequence in sorted(self._segments):
+            self._first[sequence] = pending
+            offset = committed_offset if sequence == committed_sequence else 0
+            while True:
+                found = self._segments[sequence].record_at(offset)
+                if found is None:
+                    break
+                offset = found[1]
+                pending += 1
+            if sequence == self._write_sequence:
+                self._write_offset = offset
+        # Records are numbered from the cursor; positions carry (sequence, offset, number)
+        self._committed = (committed_sequence, committed_offset, 0)
+        self._read = self._committed
+        self._appended = pending
+        self._write_cursor(committed_sequence, committed_offset)
+        if pending:
+            log.info("Spool %s holds %d messages from a previous run", directory, pending)
+
+    def _path(self, sequence):
+        return os.path.join(self.directory, f"{sequence:012d}{SUFFIX}")
+
+    def _write_cursor(self, sequence, offset):
+        CURSOR.pack_into(self._cursor, 0, sequence, offset)
+
+    def append(self, routing_key, body, headers=None, content_type=None):
+        key = routing_key.encode()
+        ctype = (content_type or '').encode()
+        header_bytes = json.dumps(headers or {}).encode()
+        data = key + ctype + header_bytes + body
+        length = RECORD.size + len(data)
+        with self.lock:
+            segment = self._segments[self._write_sequence]
+            if self._write_offset + length > segment.size:
+                segment.map.flush()
+                size = max(self.segment_bytes, length + RECORD.size)
+                self._make_room(size)
+                self._write_sequence += 1
+                self._first[self._write_sequence] = self._appended
+                segment = self._segments[self._write_sequence] = Segment(self._path(self._write_sequence), size)
+                self._write_offset = 0
+            # Data first, then the header that makes it visible to a scan
+            segment.map[self._write_offset + RECORD.size:self._write_offset + length] = data
+            RECORD.pack_into(segment.map, self._write_offset, len(body), zlib.crc32(data),
+                             len(key), len(ctype), len(header_bytes))
+            self._write_offset += length
+            self._appended += 1
+
+    def _make_room(self, size):
+        """Deletes the oldest segments, unconfirmed or not, until one of size bytes fits under max_bytes."""
+        while self._segments and sum(s.size for s in self._segments.values()) + size > self.max_bytes:
+            oldest = min(self._segments)
+            self._segments.pop(oldest).close()
+            os.remove(self._path(oldest))
+            self._first.pop(oldest)
+            # The next segment, or the one about to be created, starts where the dropped one ended
+            following = min(self._segments) if self._segments else self._write_sequence + 1
+            end = self._first.get(following, self._appended)
+            dropped = end - self._committed[2]
+            self.dropped += dropped
+            log.error("Spool %s is full, dropped %d unsent messages", self.directory, dropped)
+            self._committed = (following, 0, end)
+            self._write_cursor(following, 0)
+            if self._read[2] < end:
+                self._read = self._committed
+
+    def unread(self):
+        """Records not yet handed out by read()."""
+        return self._appended - self._read[2]
+
+    def pending(self):
+        """Records the broker has not confirmed yet."""
+        return self._appended - self._committed[2]
+
+    def read(self, limit):
+        """Up to limit records after the last read, as [(position, (routing_key, body, headers, content_type))]."""
+        records = []
+        with self.lock:
+            sequence, offset, number = self._read
+            while len(records) < limit and number < self._appended:
+                found = self._segments[sequence].record_at(offset)
+                if found is None:
+                    # End of a full segment; the next one starts at 0
+                    sequence, offset = sequence + 1, 0
+                    continue
+                record, offset = found
+                number += 1
+                records.append(((sequence, offset, number), record))
+            self._read = (sequence, offset, number)
+        return records
+
+    def commit(self, position):
+        """The broker confirmed every record up to position; frees the segments before it."""
+        with self.lock:
+            if position[2] <= self._committed[2]:
+                return
+            sequence, offset, _ = self._committed = position
+            self._write_cursor(sequence, offset)
+            for old in [old for old in self._segments if old < sequence]:
+                self._segments.pop(old).close()
+                self._first.pop(old, None)
+                os.remove(self._path(old))
+
+    def flush(self):
+        with self.lock:
+            self._segments[self._write_sequence].map.flush()
+            self._cursor.flush()
+
+    def close(self):
+        with self.lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = {}
+            self._cursor.flush()
+            self._cursor.close()
@@ -0,0 +1,108 @@
+import asyncio
+import unittest
+
+from hotel_common.aio_consumer import AsyncConsumerRuntime, ordering_key, queue_arguments
+from hotel_common.dedup import DedupCache
+
+
+class FakeMessage:
+    def __init__(self, routing_key, body=b'{}'):
+        self.routing_key = routing_key
+        self.body = body
+        self.content_type = None
+        self.headers = {}
+        self.redelivered = False
+        self.settled = None
+
+    async def ack(self):
+        self.settled = 'ack'
+
+    async def reject(self, requeue=False):
+        self.settled = 'requeue' if requeue else 'reject'
+
+
+class DispatchTests(unittest.TestCase):
+    def dispatch(self, handler, *messages, retries=2, dedup=None):
+        runtime = AsyncConsumerRuntime(url='amqp://test', max_in_flight=4, retries=retries, retry_delay=0.001,
+                                       dedup=dedup if dedup is not None else DedupCache(size=0))
+
+        async def run():
+            runtime._semaphore = asyncio.Semaphore(runtime.max_in_flight)
+            await asyncio.gather(*(runtime._dispatch('test', handler, message) for message in messages))
+
+        asyncio.run(run())
+        return [message.settled for message in messages]
+
+    def test_ack_after_handler(self):
+        handled = []
+        self.assertEqual(self.dispatch(handled.append, FakeMessage('floor1.room1.iaq')), ['ack'])
+        self.assertEqual(len(handled), 1)
+
+    def test_transient_failure_is_retried(self):
+        calls = []
+
+        def handler(delivery):
+            calls.append(delivery)
+            if len(calls) < 3:
+                raise ConnectionError('database down')
+
+        self.assertEqual(self.dispatch(handler, FakeMessage('floor1.room1.iaq')), ['ack'])
+        self.assertEqual(len(calls), 3)
+
+    def test_dead_lettered_after_retries(self):
+        calls = []
+
+        def handler(delivery):
+            calls.append(delivery)
+            raise ConnectionError('database down')
+
+        self.assertEqual(self.dispatch(handler, FakeMessage('floor1.room1.iaq'), retries=2), ['reject'])
+        self.assertEqual(len(calls), 3)
+
+    def test_room_order_holds_through_retries(self):
+        order = []
+        failed = set()
+
+        async def handler(delivery):
+            if delivery.body == b'1' and not failed:
+                failed.add(delivery.body)
+                raise ConnectionError('database down')
+            order.append(delivery.body)
+
+        messages = [FakeMessage('floor1.room1.iaq', str(i).encode()) for i in range(1, 4)]
+        self.assertEqual(self.dispatch(handler, *messages), ['ack'] * 3)
+        self.assertEqual(order, [b'1', b'2', b'3'])
+
+    def test_duplicate_skips_handler(self):
+        handled = []
+        messages = [FakeMessage('floor1.room1.iaq', b'same'), FakeMessage('floor1.room1.iaq', b'same')]
+        self.assertEqual(self.dispatch(handled.append, *messages, dedup=DedupCache(size=10)), ['ack', 'ack'])
+        self.assertEqual(len(handled), 1)
+
+    def test_failed_message_is_not_remembered(self):
+        dedup = DedupCache(size=10)
+
+        def handler(delivery):
+            raise ValueError('bad')
+
+        self.dispatch(handler, FakeMessage('floor1.room1.iaq', b'x'), retries=0, dedup=dedup)
+        self.assertEqual(len(dedup), 0)
+
+
+class ConfigurationTests(unittest.TestCase):
+    def test_zero_retry_delay_is_kept(self):
+        runtime = AsyncConsumerRuntime(url='amqp://test', retries=1, retry_delay=0)
+        self.assertEqual(runtime.retry_delay, 0)
+
+
+class HelperTests(unittest.TestCase):
+    def test_ordering_key(self):
+        self.assertEqual(ordering_key('floor1.room2.iaq'), 'floor1.room2')
+        self.assertEqual(ordering_key('floor1.room2.fault'), 'floor1.room2')
+
+    def test_queue_arguments(self):
+        self.assertEqual(queue_arguments('sensor_queue')['x-dead-letter-routing-key'], 'sensor_queue')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from hotel_common.dedup import DedupCache
+
+
+class DedupCacheTests(unittest.TestCase):
+    def test_key_covers_routing_key_and_body(self):
+        key = DedupCache.key('floor1.room1.iaq', b'{"timestamp": 1}')
+        self.assertEqual(key, DedupCache.key('floor1.room1.iaq', b'{"timestamp": 1}'))
+        self.assertNotEqual(key, DedupCache.key('floor1.room2.iaq', b'{"timestamp": 1}'))
+        self.assertNotEqual(key, DedupCache.key('floor1.room1.iaq', b'{"timestamp": 2}'))
+        # The separator keeps routing key and body apart
+        self.assertNotEqual(DedupCache.key('a', b'bc'), DedupCache.key('ab', b'c'))
+
+    def test_seen_after_add(self):
+        cache = DedupCache(size=10, ttl=60)
+        self.assertFalse(cache.seen(b'a', now=0))
+        cache.add(b'a', now=1)
+        self.assertTrue(cache.seen(b'a', now=2))
+
+    def test_entries_expire(self):
+        cache = DedupCache(size=10, ttl=60)
+        cache.add(b'a', now=1)
+        self.assertFalse(cache.seen(b'a', now=62))
+        cache.add(b'b', now=62)
+        self.assertEqual(len(cache), 1)
+
+    def test_oldest_evicted_beyond_size(self):
+        cache = DedupCache(size=2, ttl=60)
+        for now, key in enumerate([b'a', b'b', b'c'], 1):
+            cache.add(key, now=now)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(cache.seen(b'a', now=4))
+        self.assertTrue(cache.seen(b'c', now=4))
+
+    def test_re_add_moves_to_end(self):
+        cache = DedupCache(size=2, ttl=60)
+        cache.add(b'a', now=1)
+        cache.add(b'b', now=2)
+        cache.add(b'a', now=3)
+        cache.add(b'c', now=4)
+        self.assertTrue(cache.seen(b'a', now=5))
+        self.assertFalse(cache.seen(b'b', now=5))
+
+    def test_size_zero_disables(self):
+        self.assertFalse(DedupCache(size=0).enabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
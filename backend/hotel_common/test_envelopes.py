@@ -0,0 +1,106 @@
+import asyncio
+import time
+import unittest
+
+from hotel_common import wire
+from hotel_common.aio_consumer import AsyncConsumerRuntime
+from hotel_common.dedup import DedupCache
+from hotel_common.publisher import EnvelopePublisher
+
+READINGS = [
+    ('floor1.room1.power', {'timestamp': 1, 'power_kw': 1.5}),
+    ('floor1.room2.power', {'timestamp': 1, 'power_kw': 2.5}),
+    ('floor1.room1.power', {'timestamp': 2, 'power_kw': 3.5}),
+]
+
+
+class RecordingPublisher:
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, routing_key, body, headers=None, content_type=None):
+        self.messages.append((routing_key, body, content_type, time.monotonic()))
+
+
+class EnvelopePublisherTests(unittest.TestCase):
+    def test_window_expires_without_further_readings(self):
+        publisher = RecordingPublisher()
+        envelopes = EnvelopePublisher(publisher, wire.JSON, mode='room', window=0.05)
+        self.addCleanup(envelopes.close)
+        added = time.monotonic()
+        envelopes.add(*READINGS[0])
+        deadline = added + 2
+        while not publisher.messages and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(publisher.messages), 1)
+        self.assertLess(publisher.messages[0][3] - added, 1)
+
+    def test_max_readings(self):
+        publisher = RecordingPublisher()
+        envelopes = EnvelopePublisher(publisher, wire.JSON, mode='rooms', window=60, max_readings=3)
+        self.addCleanup(envelopes.close)
+        for routing_key, message in READINGS:
+            envelopes.add(routing_key, message)
+        self.assertEqual([m[0] for m in publisher.messages], ['envelope.rooms.power'])
+
+    def test_close_flushes(self):
+        publisher = RecordingPublisher()
+        envelopes = EnvelopePublisher(publisher, wire.BINARY, mode='room', window=60)
+        for routing_key, message in READINGS:
+            envelopes.add(routing_key, message)
+        envelopes.close()
+        self.assertEqual(sorted(m[0] for m in publisher.messages), ['floor1.room1.power', 'floor1.room2.power'])
+
+
+class SplitRoomsTests(unittest.TestCase):
+    def test_split_json_and_binary(self):
+        for content_type in (wire.JSON, wire.BINARY):
+            body, rooms_type = wire.encode_rooms('power', [(key[:-6], message) for key, message in READINGS],
+                                                 content_type)
+            parts = wire.split_rooms('power', body, rooms_type, 'envelope.rooms.power')
+            self.assertEqual([key for key, _, _ in parts], ['floor1.room1.power', 'floor1.room2.power'])
+            routing_key, room_body, room_type = parts[0]
+            self.assertEqual(wire.decode_all('power', room_body, room_type, routing_key),
+                             [READINGS[0], READINGS[2]])
+
+
+class Message:
+    def __init__(self, routing_key, body, content_type):
+        self.routing_key = routing_key
+        self.body = body
+        self.content_type = content_type
+        self.headers = {}
+        self.redelivered = False
+        self.settled = []
+
+    async def ack(self):
+        self.settled.append('ack')
+
+    async def reject(self, requeue=False):
+        self.settled.append('reject')
+
+
+class FanOutTests(unittest.TestCase):
+    def test_rooms_envelope_is_handled_per_room(self):
+        runtime = AsyncConsumerRuntime(url='amqp://test', max_in_flight=4, dedup=DedupCache(size=0))
+        body, content_type = wire.encode_rooms('power', [(key[:-6], message) for key, message in READINGS])
+        message = Message('envelope.rooms.power', body, content_type)
+        started = []
+
+        async def handler(delivery):
+            started.append(delivery.routing_key)
+            # Both rooms are in the handler at once
+            while len(started) < 2:
+                await asyncio.sleep(0.001)
+
+        async def run():
+            runtime._semaphore = asyncio.Semaphore(runtime.max_in_flight)
+            await asyncio.wait_for(runtime._dispatch('test', handler, message), 2)
+
+        asyncio.run(run())
+        self.assertEqual(sorted(started), ['floor1.room1.power', 'floor1.room2.power'])
+        self.assertEqual(message.settled, ['ack'])
+
+
+if __name__ == '__main__':
+    unittest.main()
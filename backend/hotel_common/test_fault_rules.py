@@ -0,0 +1,141 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from hotel_common.fault_rules import DEFAULT_PATH, FaultRules, RuleBook
+from hotel_common.simulation import READING_GENERATORS
+
+RULES = RuleBook().current
+
+
+def readings(sensor_type, count, seed=1):
+    rng = random.Random(seed)
+    generated = [READING_GENERATORS[sensor_type](i, i % 3 == 0, rng) for i in range(count)]
+    # The edge cases of the exclusive and multi-field rules
+    if sensor_type == 'iaq':
+        generated += [{'timestamp': 0, 'temperature': 0, 'humidity': 0, 'co2': 0},
+                      {'timestamp': 0, 'temperature': 40, 'humidity': 0, 'co2': 900},
+                      {'timestamp': 0, 'temperature': 40, 'humidity': 70, 'co2': 100}]
+    return generated
+
+
+def columns(sensor_type, messages):
+    fields = {field for spec in RULES.rule_specs[sensor_type] for field in spec[1]}
+    return {field: [message[field] for message in messages] for field in fields}
+
+
+class EvaluateBatchTests(unittest.TestCase):
+    def test_matches_evaluate(self):
+        for sensor_type in RULES.rule_specs:
+            messages = readings(sensor_type, 300)
+            expected = [RULES.evaluate(sensor_type, message)[0] for message in messages]
+            self.assertEqual(RULES.evaluate_batch(sensor_type, columns(sensor_type, messages)), expected,
+                             sensor_type)
+
+    def test_matches_evaluate_with_thresholds(self):
+        thresholds = {'co2_high': 500, 'temp_high': 30}
+        evaluators = RULES.compile('iaq', thresholds)
+        messages = readings('iaq', 300)
+        expected = [RULES.evaluate('iaq', message, evaluators)[0] for message in messages]
+        self.assertEqual(RULES.evaluate_batch('iaq', columns('iaq', messages), thresholds), expected)
+
+    def test_exclusive_rule_stops_later_rules(self):
+        flags = RULES.evaluate_batch('iaq', {'temperature': [0, 40], 'humidity': [0, 0], 'co2': [0, 900]})
+        self.assertEqual(flags[0], RULES.mask('sensor_not_working'))
+        self.assertEqual(flags[1], RULES.mask('calibration_error'))
+
+
+class ResolveThresholdsTests(unittest.TestCase):
+    def test_most_specific_scope_wins(self):
+        overrides = {
+            (None, None): {'co2_high': 1000, 'power_spike': 50},
+            (1, None): {'co2_high': 900},
+            (1, 2): {'co2_high': 700},
+        }
+        self.assertEqual(RULES.resolve_thresholds(overrides, 1, 2, 'iaq'), {'co2_high': 700})
+        self.assertEqual(RULES.resolve_thresholds(overrides, 1, 3, 'iaq'), {'co2_high': 900})
+        self.assertEqual(RULES.resolve_thresholds(overrides, 2, 1, 'iaq'), {'co2_high': 1000})
+        self.assertEqual(RULES.resolve_thresholds(overrides, 2, 1, 'power'), {'power_spike': 50})
+
+    def test_scopes_merge_per_fault(self):
+        overrides = {
+            (None, None): {'co2_high': 1000, 'temp_high': 30},
+            (1, None): {'hum_high': 60},
+            (1, 2): {'co2_high': 700, 'no_such_fault': 1},
+        }
+        # Each fault takes its most specific threshold; unknown faults are ignored
+        self.assertEqual(RULES.resolve_thresholds(overrides, 1, 2, 'iaq'),
+                         {'co2_high': 700, 'temp_high': 30, 'hum_high': 60})
+        self.assertEqual(RULES.resolve_thresholds(overrides, 1, 2, 'presence'), {})
+
+
+class FaultRulesTests(unittest.TestCase):
+    def spec(self):
+        with open(DEFAULT_PATH) as f:
+            return json.load(f)
+
+    def test_split_and_severity(self):
+        flags = RULES.mask('co2_high') | RULES.mask('power_spike')
+        self.assertEqual(RULES.split(flags), [('iaq', RULES.mask('co2_high')), ('power', RULES.mask('power_spike'))])
+        self.assertEqual(RULES.severity(flags), 3)
+        self.assertEqual(RULES.severity(0), 1)
+
+    def test_evaluate_reports_hits(self):
+        flags, hits = RULES.evaluate('power', {'timestamp': 0, 'power_kw': 50})
+        self.assertEqual(flags, RULES.mask('power_spike'))
+        self.assertEqual(hits, [('Power Spike', 'power_kw=50')])
+        self.assertEqual(RULES.evaluate('power', {'timestamp': 0, 'power_kw': 10}), (0, None))
+
+    def test_invalid_files(self):
+        spec = self.spec()
+        spec['faults']['power_spike']['bit'] = spec['faults']['co2_high']['bit']
+        with self.assertRaises(ValueError):
+            FaultRules(spec)
+        spec = self.spec()
+        spec['rules'][0]['op'] = '=~'
+        with self.assertRaises(ValueError):
+            FaultRules(spec)
+        spec = self.spec()
+        spec['rules'][0]['fault'] = 'no_such_fault'
+        with self.assertRaises(ValueError):
+            FaultRules(spec)
+
+
+class RuleBookTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'fault_rules.json')
+        shutil.copy(DEFAULT_PATH, self.path)
+        self.book = RuleBook(self.path)
+
+    def write(self, spec, mtime):
+        with open(self.path, 'w') as f:
+            f.write(spec if isinstance(spec, str) else json.dumps(spec))
+        os.utime(self.path, (mtime, mtime))
+
+    def test_reload_swaps_rules_and_notifies(self):
+        reloaded = []
+        self.book.on_reload(lambda old, new: reloaded.append((old, new)))
+        old = self.book.current
+        self.assertFalse(self.book.reload_if_changed())
+        with open(self.path) as f:
+            spec = json.load(f)
+        spec['faults']['power_spike']['severity'] = 1
+        self.write(spec, 1)
+        self.assertTrue(self.book.reload_if_changed())
+        self.assertEqual(self.book.current.faults['power_spike'].severity, 1)
+        self.assertEqual(reloaded, [(old, self.book.current)])
+
+    def test_broken_file_keeps_the_rules(self):
+        old = self.book.current
+        self.write('{"faults": ', 1)
+        self.assertFalse(self.book.reload_if_changed())
+        self.assertIs(self.book.current, old)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import time
+import unittest
+
+from hotel_common.publisher import BatchPublisher
+
+
+class FlakyExchange:
+    """Nacks the given bodies the first time they are published."""
+
+    def __init__(self, fail):
+        self.fail = set(fail)
+        self.received = []
+
+    async def publish(self, message, routing_key):
+        if message.body in self.fail:
+            self.fail.discard(message.body)
+            raise ConnectionError('nacked')
+        self.received.append(message.body)
+
+
+class Connections:
+    async def close(self):
+        pass
+
+
+class BatchPublisherTests(unittest.TestCase):
+    def publish(self, exchange, count, routing_keys=('floor1.room1.iaq',)):
+        publisher = BatchPublisher('test', batch_size=10, max_outbox=100, flush_interval=0.01)
+
+        async def connect():
+            return Connections(), exchange
+
+        publisher._connect = connect
+        publisher.start()
+        for i in range(count):
+            publisher.publish(routing_keys[i % len(routing_keys)], str(i).encode())
+        publisher.close(timeout=10)
+        return publisher
+
+    def test_all_confirmed(self):
+        exchange = FlakyExchange([])
+        publisher = self.publish(exchange, 25)
+        self.assertEqual(exchange.received, [str(i).encode() for i in range(25)])
+        self.assertEqual(publisher.pending(), 0)
+
+    def test_replay_keeps_order(self):
+        exchange = FlakyExchange([b'3'])
+        started = time.monotonic()
+        self.publish(exchange, 10)
+        self.assertLess(time.monotonic() - started, 10)
+        # The room stops at the failed message and goes on from it, each message sent once
+        self.assertEqual(exchange.received, [str(i).encode() for i in range(10)])
+
+    def test_other_rooms_go_on(self):
+        exchange = FlakyExchange([b'2'])
+        self.publish(exchange, 10, routing_keys=('floor1.room1.iaq', 'floor1.room2.iaq'))
+        self.assertEqual(sorted(exchange.received, key=int), [str(i).encode() for i in range(10)])
+        room1 = [body for body in exchange.received if int(body) % 2 == 0]
+        self.assertEqual(room1, [b'0', b'2', b'4', b'6', b'8'])
+        # Room 2 was not held back by room 1's failure
+        self.assertLess(exchange.received.index(b'9'), exchange.received.index(b'2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
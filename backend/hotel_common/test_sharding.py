@@ -0,0 +1,30 @@
+import os
+import unittest
+from unittest import mock
+
+from hotel_common.aio_consumer import AsyncConsumerRuntime
+from hotel_common.sharding import SHARD_EXCHANGE, add_sharded_handler, shard_name
+
+
+class ShardingTests(unittest.TestCase):
+    def handlers(self, shard_setting):
+        runtime = AsyncConsumerRuntime(url='amqp://test')
+        with mock.patch.dict(os.environ, {'DETECTOR_SHARD': shard_setting}):
+            add_sharded_handler(runtime, shard_name(), print, weight=2)
+        return runtime._handlers
+
+    def test_named_shard_is_durable(self):
+        self.assertEqual(self.handlers('1'), [('fault_detection_shard.1', print, SHARD_EXCHANGE, ['2'], False)])
+
+    def test_auto_shard_is_exclusive(self):
+        [(queue, _, _, _, exclusive)] = self.handlers('auto')
+        self.assertTrue(queue.startswith('fault_detection_shard.'))
+        self.assertTrue(exclusive)
+
+    def test_sharding_off(self):
+        with mock.patch.dict(os.environ, {'DETECTOR_SHARD': ''}):
+            self.assertIsNone(shard_name())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from hotel_common.publisher import BatchPublisher
+from hotel_common.spool import Spool
+
+SEGMENT = 4096
+
+
+def fill(spool, count, start=0):
+    for i in range(start, start + count):
+        spool.append('floor1.room1.iaq', b'x' * 50 + str(i).encode(), {'n': i}, 'application/json')
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith('.seg'))
+
+
+class SpoolTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def open(self, **kwargs):
+        spool = Spool(self.directory, segment_bytes=SEGMENT, **kwargs)
+        self.addCleanup(lambda: spool._segments and spool.close())
+        return spool
+
+    def test_read_in_order_across_segments(self):
+        spool = self.open()
+        fill(spool, 200)
+        self.assertGreater(len(segments(self.directory)), 1)
+        records = spool.read(1000)
+        self.assertEqual([record[2]['n'] for _, record in records], list(range(200)))
+        self.assertEqual(records[0][1], ('floor1.room1.iaq', b'x' * 50 + b'0', {'n': 0}, 'application/json'))
+        self.assertEqual(spool.unread(), 0)
+        self.assertEqual(spool.pending(), 200)
+
+    def test_commit_deletes_confirmed_segments(self):
+        spool = self.open()
+        fill(spool, 200)
+        records = spool.read(150)
+        spool.commit(records[-1][0])
+        self.assertEqual(spool.pending(), 50)
+        self.assertEqual(segments(self.directory)[0], f"{records[-1][0][0]:012d}.seg")
+
+    def test_restart_resumes_after_last_commit(self):
+        spool = self.open()
+        fill(spool, 100)
+        records = spool.read(60)
+        spool.commit(records[39][0])
+        spool.close()
+        spool = self.open()
+        self.assertEqual(spool.pending(), 60)
+        self.assertEqual([record[2]['n'] for _, record in spool.read(1000)], list(range(40, 100)))
+
+    def test_torn_record_ends_the_spool(self):
+        spool = self.open()
+        fill(spool, 5)
+        end = spool._write_offset
+        spool._segments[spool._write_sequence].map[end - 2:end] = b'\0\0'
+        spool.close()
+        spool = self.open()
+        self.assertEqual(spool.pending(), 4)
+        fill(spool, 1, start=5)
+        self.assertEqual([record[2]['n'] for _, record in spool.read(10)], [0, 1, 2, 3, 5])
+
+    def test_full_spool_drops_oldest_segments(self):
+        spool = self.open(max_bytes=3 * SEGMENT)
+        fill(spool, 400)
+        self.assertLessEqual(len(segments(self.directory)), 3)
+        self.assertGreater(spool.dropped, 0)
+        self.assertEqual(spool.pending(), 400 - spool.dropped)
+        numbers = [record[2]['n'] for _, record in spool.read(1000)]
+        self.assertEqual(numbers, list(range(spool.dropped, 400)))
+
+
+class FakeExchange:
+    def __init__(self):
+        self.down = True
+        self.received = []
+
+    async def publish(self, message, routing_key):
+        if self.down:
+            raise ConnectionError('broker down')
+        self.received.append(message.body)
+
+
+class Connections:
+    async def close(self):
+        pass
+
+
+class SpooledPublisherTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.exchange = FakeExchange()
+
+    def publisher(self):
+        publisher = BatchPublisher('test', batch_size=10, max_outbox=20, flush_interval=0.01,
+                                   spool_dir=self.directory)
+        publisher.drain_rate = 10000
+        exchange = self.exchange
+
+        async def connect():
+            return Connections(), exchange
+
+        publisher._connect = connect
+        return publisher
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_nothing_lost_across_an_outage_and_a_restart(self):
+        publisher = self.publisher().start()
+        for i in range(100):
+            publisher.publish('floor1.room1.iaq', str(i).encode())
+        publisher.close(timeout=0.2)
+        self.assertFalse(publisher._thread.is_alive())
+
+        self.exchange.down = False
+        publisher = self.publisher().start()
+        for i in range(100, 120):
+            publisher.publish('floor1.room1.iaq', str(i).encode())
+        self.wait_for(lambda: len(self.exchange.received) >= 120)
+        publisher.close()
+        self.assertEqual(self.exchange.received, [str(i).encode() for i in range(120)])
+        self.assertEqual(Spool(self.directory).pending(), 0)
+
+    def test_close_while_connecting(self):
+        publisher = self.publisher()
+
+        async def never():
+            await asyncio.sleep(60)
+
+        publisher._connect = never
+        publisher.start()
+        publisher.publish('floor1.room1.iaq', b'1')
+        publisher.close(timeout=0.2)
+        self.assertFalse(publisher._thread.is_alive())
+        self.assertEqual(Spool(self.directory).pending(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
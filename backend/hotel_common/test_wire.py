@@ -0,0 +1,62 @@
+import os
+import unittest
+from unittest import mock
+
+from hotel_common import wire
+
+MESSAGES = {
+    'iaq': {'timestamp': 1700000000, 'temperature': 24.5, 'humidity': 55.25, 'co2': 640.0},
+    'power': {'timestamp': 1700000000, 'power_kw': 3.75},
+    'presence': {'timestamp': 1700000000, 'presence': 1},
+    'fault': {'timestamp': 1700000000, 'fault_flags': 1 << 7},
+}
+
+
+class WireTests(unittest.TestCase):
+    def test_round_trip(self):
+        for content_type in (wire.JSON, wire.BINARY):
+            for kind, message in MESSAGES.items():
+                body = wire.encode(kind, message, content_type)
+                self.assertEqual(wire.decode(kind, body, content_type), message, (kind, content_type))
+
+    def test_binary_sizes(self):
+        sizes = {kind: len(wire.encode(kind, message, wire.BINARY)) for kind, message in MESSAGES.items()}
+        self.assertEqual(sizes, {'iaq': 28, 'power': 12, 'presence': 5, 'fault': 8})
+
+    def test_untyped_body_is_json(self):
+        body = wire.encode('power', MESSAGES['power'])
+        self.assertEqual(wire.decode_all('power', body, None, 'floor1.room1.power'),
+                         [('floor1.room1.power', MESSAGES['power'])])
+
+    def test_one_room_envelope(self):
+        messages = [MESSAGES['iaq'], {**MESSAGES['iaq'], 'timestamp': 1700000005}]
+        for content_type in (wire.JSON, wire.BINARY):
+            body = wire.encode_many('iaq', messages, content_type)
+            self.assertEqual(wire.decode_all('iaq', body, content_type, 'floor2.room3.iaq'),
+                             [('floor2.room3.iaq', message) for message in messages])
+
+    def test_many_room_envelope(self):
+        items = [('floor1.room2', MESSAGES['power']), ('floor3.room4', MESSAGES['power'])]
+        for content_type in (wire.JSON, wire.BINARY):
+            body, rooms_type = wire.encode_rooms('power', items, content_type)
+            self.assertEqual(wire.decode_all('power', body, rooms_type, 'envelope.rooms.power'),
+                             [('floor1.room2.power', MESSAGES['power']), ('floor3.room4.power', MESSAGES['power'])])
+
+    def test_malformed_binary(self):
+        with self.assertRaises(ValueError):
+            wire.decode('power', b'\0' * 5, wire.BINARY)
+        with self.assertRaises(ValueError):
+            wire.decode_all('power', b'\0' * 13, wire.BINARY, 'floor1.room1.power')
+        with self.assertRaises(ValueError):
+            wire.encode('door', {}, wire.BINARY)
+
+    def test_publish_content_type(self):
+        with mock.patch.dict(os.environ, {'WIRE_FORMAT': 'binary'}):
+            self.assertEqual(wire.publish_content_type(), wire.BINARY)
+        with mock.patch.dict(os.environ, {'WIRE_FORMAT': 'xml'}):
+            with self.assertRaises(ValueError):
+                wire.publish_content_type()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""
+Message bodies on hotel_sensors and fault_notifications.
+
+Two encodings, told apart by the AMQP content_type:
+
+- application/json (or no content_type, as sent by older agents): a JSON object
+- application/vnd.hotel.v1: a fixed little-endian struct per routing key suffix,
+  with the fields in the order below
+
+    iaq       uint32 timestamp, float64 temperature, humidity, co2   28 bytes
+    power     uint32 timestamp, float64 power_kw                     12 bytes
+    presence  uint32 timestamp, uint8 presence                        5 bytes
+    fault     uint32 timestamp, uint32 fault_flags                    8 bytes
+
+Publishers pick the encoding with WIRE_FORMAT=json|binary (default json);
+consumers decode both, so agents can be switched one at a time.
+
+A message may also be an envelope of several readings:
+
+- one room's readings, on the room's own routing key: a JSON array of
+  readings, or the binary records back to back
+- many rooms' readings, on envelope.rooms.<kind>: a JSON array of readings
+  that each carry "room": "floor1.room2", or with content_type
+  application/vnd.hotel.v1+rooms, records each prefixed by uint16 floor, room
+
+decode_all() returns the readings of any of these with their own routing keys;
+split_rooms() turns a many-room envelope into one envelope per room.
+"""
+import json
+import os
+import struct
+
+JSON = 'application/json'
+BINARY = 'application/vnd.hotel.v1'
+ROOMS_BINARY = 'application/vnd.hotel.v1+rooms'
+
+# floor.room part of the routing key of many-room envelopes
+ENVELOPE_ROOMS = 'envelope.rooms'
+ROOM_PREFIX = struct.Struct('<HH')
+
+CONTENT_TYPES = {'json': JSON, 'binary': BINARY}
+
+# routing key suffix -> (layout, field names)
+LAYOUTS = {
+    'iaq': (struct.Struct('<Iddd'), ('timestamp', 'temperature', 'humidity', 'co2')),
+    'power': (struct.Struct('<Id'), ('timestamp', 'power_kw')),
+    'presence': (struct.Struct('<IB'), ('timestamp', 'presence')),
+    'fault': (struct.Struct('<II'), ('timestamp', 'fault_flags')),
+}
+
+
+def publish_content_type():
+    """The content_type publishers should use, from WIRE_FORMAT."""
+    wire_format = os.getenv('WIRE_FORMAT', 'json')
+    if wire_format not in CONTENT_TYPES:
+        raise ValueError(f"WIRE_FORMAT must be one of {', '.join(CONTENT_TYPES)}, got '{wire_format}'")
+    return CONTENT_TYPES[wire_format]
+
+
+def _room_numbers(room_key):
+    """floor1.room2 -> (1, 2)"""
+    floor, room = room_key.split('.')
+    return int(floor[5:]), int(room[4:])
+
+
+def _layout(kind):
+    try:
+        return LAYOUTS[kind]
+    except KeyError:
+        raise ValueError(f"No binary layout for '{kind}' messages")
+
+
+def encode(kind, message, content_type=JSON):
+    """kind is the routing key suffix (iaq, power, presence or fault)."""
+    if content_type == BINARY:
+        layout, fields = _layout(kind)
+        return layout.pack(*[message[field] for field in fields])
+    return json.dumps(message).encode()
+
+
+def decode(kind, body, content_type=None):
+    if content_type == BINARY:
+        layout, fields = _layout(kind)
+        try:
+            return dict(zip(fields, layout.unpack(body)))
+        except struct.error as e:
+            raise ValueError(f"Malformed {kind} message: {e}")
+    return json.loads(body)
+
+
+def encode_many(kind, messages, content_type=JSON):
+    """One room's readings as one envelope body."""
+    if content_type == BINARY:
+        layout, fields = _layout(kind)
+        return b''.join([layout.pack(*[message[field] for field in fields]) for message in messages])
+    return json.dumps(messages).encode()
+
+
+def encode_rooms(kind, items, content_type=JSON):
+    """
+    [(floor.room, reading), ...] of many rooms as one envelope for envelope.rooms.<kind>;
+    returns (body, content_type).
+    """
+    if content_type == BINARY:
+        layout, fields = _layout(kind)
+        record = struct.Struct(ROOM_PREFIX.format + layout.format[1:])
+        body = b''.join([record.pack(*_room_numbers(room_key), *[message[field] for field in fields])
+                         for room_key, message in items])
+        return body, ROOMS_BINARY
+    return json.dumps([{**message, 'room': room_key} for room_key, message in items]).encode(), JSON
+
+
+def decode_all(kind, body, content_type, routing_key):
+    """Every reading of a single message or envelope as [(routing_key, reading), ...]."""
+    if content_type == BINARY or content_type == ROOMS_BINARY:
+        layout, fields = _layout(kind)
+        rooms = content_type == ROOMS_BINARY
+        if rooms:
+            layout = struct.Struct(ROOM_PREFIX.format + layout.format[1:])
+        if not body or len(body) % layout.size:
+            raise ValueError(f"Malformed {kind} message: {len(body)} bytes is not a multiple of {layout.size}")
+        if rooms:
+            return [(f"floor{values[0]}.room{values[1]}.{kind}", dict(zip(fields, values[2:])))
+                    for values in layout.iter_unpack(body)]
+        return [(routing_key, dict(zip(fields, values))) for values in layout.iter_unpack(body)]
+    data = json.loads(body)
+    if isinstance(data, dict):
+        return [(routing_key, data)]
+    items = []
+    for message in data:
+        room_key = message.pop('room', None)
+        items.append((f"{room_key}.{kind}" if room_key else routing_key, message))
+    return items
+
+
+def split_rooms(kind, body, content_type, routing_key):
+    """
+    A many-room envelope as one single-room envelope per room, in order of each
+    room's first reading: [(routing_key, body, content_type), ...].
+    """
+    rooms = {}
+    for room_routing_key, message in decode_all(kind, body, content_type, routing_key):
+        rooms.setdefault(room_routing_key, []).append(message)
+    content_type = BINARY if content_type == ROOMS_BINARY else content_type
+    return [(room_routing_key, encode_many(kind, messages, content_type), content_type)
+            for room_routing_key, messages in rooms.items()]
@@ -1,28 +1,21 @@
-import pika
 import time
 import random
-import json
 import csv
 import os
 
-def connect_to_rabbitmq():
-    rabbitmq_user = os.getenv('RABBITMQ_USER')
-    rabbitmq_pass = os.getenv('RABBITMQ_PASS')
-    rabbitmq_host = os.getenv('RABBITMQ_HOST')
-    rabbitmq_port = int(os.getenv('RABBITMQ_PORT'))
-    
-    credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
-    parameters = pika.ConnectionParameters(rabbitmq_host, rabbitmq_port, '/', credentials)
-    for attempt in range(5):
-        try:
-            return pika.BlockingConnection(parameters)
-        except pika.exceptions.AMQPConnectionError:
-            now = int(time.time())
-            print(f"{now} - Connection failed, retrying ({attempt + 1}/5)...", flush=True)
-            time.sleep(2)
-    raise Exception("Failed to connect to RabbitMQ after 5 attempts")
+from hotel_common import log as logs
+from hotel_common import profiling
+from hotel_common import wire
+from hotel_common.metrics import start_metrics_server
+from hotel_common.publisher import BatchPublisher, EnvelopePublisher
+from hotel_common.simulation import FaultySlotClock, iaq_reading
+
+log = logs.get_logger('iaq_agent')
 
 def main():
+    logs.configure()
+    profiling.install('iaq_agent')
+
     # CSV setup - use environment variable with fallback
     csv_file_path = os.getenv('CSV_PATH', '/app/data/iaq_data.csv')  
     os.makedirs(os.path.dirname(csv_file_path), exist_ok=True)  
@@ -36,82 +29,50 @@ def main():
     # Open CSV file in append mode
     csv_file = open(csv_file_path, 'a', newline='')
     csv_writer = csv.writer(csv_file)
-    print(f"CSV_PATH from environment: {os.getenv('CSV_PATH')}")
-    print(f"Using csv_file_path: {csv_file_path}")
+    log.info("CSV_PATH from environment: %s", os.getenv('CSV_PATH'))
+    log.info("Using csv_file_path: %s", csv_file_path)
 
-    # RabbitMQ setup
-    connection = connect_to_rabbitmq()
-    channel = connection.channel()
-    channel.exchange_declare(exchange='hotel_sensors', exchange_type='topic')
+    # RabbitMQ setup - confirmed, batched publishing from a background thread
+    publisher = BatchPublisher('hotel_sensors').start()
+    # JSON or the compact binary layout (WIRE_FORMAT), optionally several readings per message (ENVELOPE_MODE)
+    envelopes = EnvelopePublisher(publisher, wire.publish_content_type())
+    start_metrics_server(9100)
 
-    current_minute = None
-    faulty_slot = None
-    send_count = 0
+    faulty_clock = FaultySlotClock()
 
     try:
         while True:
             timestamp = int(time.time())
             minute = timestamp // 60  
 
-            if minute != current_minute:
-                current_minute = minute
-                faulty_slot = random.randint(0, 11)
-                send_count = 0
-                print(f"New minute {current_minute}, faulty slot is {faulty_slot}")
+            if minute != faulty_clock.minute:
+                faulty_clock.start_minute(minute)
+                log.info("New minute %d, faulty slot is %d", minute, faulty_clock.faulty_slot)
 
             floor = random.choice([f"floor{i}" for i in range(1, 4)])
             room = random.choice([f"room{i}" for i in range(1, 6)])
             routing_key = f"{floor}.{room}.iaq"
 
-            is_faulty = (send_count == faulty_slot)
-
-            if not is_faulty:
-                data = {
-                    'timestamp': timestamp,
-                    'temperature': round(random.uniform(24.5, 33.0), 1),
-                    'humidity': round(random.uniform(41.1, 51.5), 1),
-                    'co2': round(random.uniform(464.0, 689.5), 1)
-                }
-            else:
-                # Faulty data
-                if random.choice([True, False]):
-                    # All zeros
-                    data = {
-                        'timestamp': timestamp,
-                        'temperature': 0.0,
-                        'humidity': 0.0,
-                        'co2': 0.0
-                    }
-                else:
-                    # Out-of-range or partial zeros
-                    temp = 0.0 if random.random() < 0.3 else round(random.uniform(40.0, 60.0), 1)
-                    hum = 0.0 if random.random() < 0.3 else round(random.uniform(80.0, 100.0), 1)
-                    co2 = 0.0 if random.random() < 0.3 else round(random.uniform(0.0, 1000.0), 1)
-                    data = {
-                        'timestamp': timestamp,
-                        'temperature': temp,
-                        'humidity': hum,
-                        'co2': co2
-                    }
+            is_faulty = faulty_clock.next_is_faulty()
+            data = iaq_reading(timestamp, is_faulty)
             
             # Write to CSV
             csv_writer.writerow([timestamp, floor, room, data['temperature'], data['humidity'], data['co2']])
             csv_file.flush()
 
             # Publish to RabbitMQ
-            payload = json.dumps(data)
-            channel.basic_publish(exchange='hotel_sensors', routing_key=routing_key, body=payload.encode())
-            print(f"{timestamp} - Sent to {routing_key}: {payload} {'(faulty)' if is_faulty else ''}", flush=True)
-
-            send_count += 1
+            envelopes.add(routing_key, data)
+            if not publisher.quiet:
+                log.sampled('reading_sent', "Sent to %s: %s %s", routing_key, data, '(faulty)' if is_faulty else '')
 
             time.sleep(5)
     
     except KeyboardInterrupt:
-        print("Shutting down...")
+        log.info("Shutting down...")
     finally:
         csv_file.close()
-        connection.close()
+        envelopes.close()
+        publisher.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,142 @@
+import argparse
+import heapq
+import multiprocessing
+import os
+import random
+import time
+
+from hotel_common import wire
+from hotel_common.publisher import BatchPublisher, EnvelopePublisher
+from hotel_common.simulation import FaultySlotClock, READING_GENERATORS, SENSOR_TYPES
+
+
+def parse_rates(text):
+    """'iaq=1,power=0.5,presence=0.2' -> {'iaq': 1.0, 'power': 0.5, 'presence': 0.2} (messages/s per sensor)"""
+    rates = {}
+    for part in text.split(','):
+        sensor_type, rate = part.split('=')
+        if sensor_type not in SENSOR_TYPES:
+            raise ValueError(f"Invalid sensor_type: {sensor_type}")
+        rates[sensor_type] = float(rate)
+    return rates
+
+
+def build_streams(floors, rooms, rates, worker, workers):
+    """
+    Every (floor, room, sensor_type) is one sensor stream. Rooms are split across
+    workers whole, so all readings of a room come from one process, in order.
+    """
+    streams = []
+    for floor in range(1, floors + 1):
+        for room in range(1, rooms + 1):
+            if ((floor - 1) * rooms + room - 1) % workers != worker:
+                continue
+            for sensor_type, rate in rates.items():
+                if rate > 0:
+                    streams.append((f"floor{floor}.room{room}.{sensor_type}", sensor_type, 1.0 / rate))
+    return streams
+
+
+def run_worker(worker, args):
+    # Same seed and worker count -> same readings in the same order
+    rng = random.Random(args.seed * 1000003 + worker)
+    rates = parse_rates(args.rates)
+    streams = build_streams(args.floors, args.rooms, rates, worker, args.processes)
+    clocks = [FaultySlotClock(max(1, round(60 / interval))) for _, _, interval in streams]
+
+    # Stagger the first reading of every stream over its interval
+    schedule = [(rng.uniform(0, interval), index) for index, (_, _, interval) in enumerate(streams)]
+    heapq.heapify(schedule)
+
+    publisher = None if args.dry_run else BatchPublisher('hotel_sensors', quiet=True).start()
+    content_type = wire.CONTENT_TYPES[args.wire_format]
+    envelopes = None if publisher is None else EnvelopePublisher(publisher, content_type, mode=args.envelope_mode)
+    start_wall = time.time()
+    start = time.monotonic()
+    sent = faulty = 0
+    last_report = start
+
+    try:
+        while schedule:
+            due, index = schedule[0]
+            if args.duration and due >= args.duration:
+                break
+            elapsed = time.monotonic() - start
+            if due > elapsed:
+                time.sleep(min(due - elapsed, 0.1))
+                continue
+
+            heapq.heapreplace(schedule, (due + streams[index][2], index))
+            routing_key, sensor_type, _ = streams[index]
+            clock = clocks[index]
+            minute = int(due // 60)
+            if minute != clock.minute:
+                clock.start_minute(minute, rng)
+            is_faulty = clock.next_is_faulty()
+            data = READING_GENERATORS[sensor_type](int(start_wall + due), is_faulty, rng)
+
+            if envelopes is not None:
+                envelopes.add(routing_key, data)
+            else:
+                wire.encode(sensor_type, data, content_type)
+            sent += 1
+            faulty += is_faulty
+
+            now = time.monotonic()
+            if now - last_report >= args.report_interval:
+                lag = now - start - due
+                print(f"{int(time.time())} - worker {worker}: {sent / (now - start):.1f} msg/s, "
+                      f"{sent} sent ({faulty} faulty), lag {lag:.2f}s", flush=True)
+                last_report = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if publisher is not None:
+            envelopes.close()
+            publisher.close()
+
+    elapsed = time.monotonic() - start
+    print(f"{int(time.time())} - worker {worker} done: {sent} readings ({faulty} faulty) "
+          f"from {len(streams)} sensors in {elapsed:.1f}s, {sent / elapsed:.1f} msg/s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates a building of IAQ, power and presence sensors at configurable rates')
+    parser.add_argument('--floors', type=int, default=int(os.getenv('LOAD_FLOORS', '10')))
+    parser.add_argument('--rooms', type=int, default=int(os.getenv('LOAD_ROOMS', '100')), help='Rooms per floor')
+    parser.add_argument('--rates', default=os.getenv('LOAD_RATES', 'iaq=0.2,power=0.2,presence=0.2'),
+                        help='Messages per second per sensor, e.g. iaq=1,power=0.5,presence=0.2')
+    parser.add_argument('--duration', type=float, default=float(os.getenv('LOAD_DURATION', '0')), help='Seconds to run, 0 = forever')
+    parser.add_argument('--processes', type=int, default=int(os.getenv('LOAD_PROCESSES', '1')))
+    parser.add_argument('--seed', type=int, default=int(os.getenv('LOAD_SEED', '42')))
+    parser.add_argument('--report-interval', type=float, default=10)
+    parser.add_argument('--wire-format', choices=sorted(wire.CONTENT_TYPES), default=os.getenv('WIRE_FORMAT', 'json'),
+                        help='Message encoding on hotel_sensors')
+    parser.add_argument('--envelope-mode', choices=('off', 'room', 'rooms'), default=os.getenv('ENVELOPE_MODE', 'off'),
+                        help='Readings per message: one, per room per window, or all rooms per window')
+    parser.add_argument('--dry-run', action='store_true', help='Generate readings without publishing them')
+    args = parser.parse_args()
+
+    rates = parse_rates(args.rates)
+    total_rate = args.floors * args.rooms * sum(rates.values())
+    print(f"Simulating {args.floors} floors x {args.rooms} rooms, {total_rate:.1f} msg/s target, "
+          f"{args.processes} process(es), seed {args.seed}", flush=True)
+
+    if args.processes == 1:
+        run_worker(0, args)
+        return
+
+    workers = [multiprocessing.Process(target=run_worker, args=(worker, args)) for worker in range(args.processes)]
+    for process in workers:
+        process.start()
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        print("Shutting down...")
+        for process in workers:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
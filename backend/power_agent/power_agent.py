@@ -1,28 +1,21 @@
-import pika
 import time
 import random
-import json
 import csv
 import os
 
-def connect_to_rabbitmq():
-    rabbitmq_user = os.getenv('RABBITMQ_USER')
-    rabbitmq_pass = os.getenv('RABBITMQ_PASS')
-    rabbitmq_host = os.getenv('RABBITMQ_HOST')
-    rabbitmq_port = int(os.getenv('RABBITMQ_PORT'))
-    
-    credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_pass)
-    parameters = pika.ConnectionParameters(rabbitmq_host, rabbitmq_port, '/', credentials)
-    for attempt in range(5):
-        try:
-            return pika.BlockingConnection(parameters)
-        except pika.exceptions.AMQPConnectionError:
-            now = int(time.time())
-            print(f"{now} - Connection failed, retrying ({attempt + 1}/5)...", flush=True)
-            time.sleep(2)
-    raise Exception("Failed to connect to RabbitMQ after 5 attempts")
+from hotel_common import log as logs
+from hotel_common import profiling
+from hotel_common import wire
+from hotel_common.metrics import start_metrics_server
+from hotel_common.publisher import BatchPublisher, EnvelopePublisher
+from hotel_common.simulation import FaultySlotClock, power_reading
+
+log = logs.get_logger('power_agent')
 
 def main():
+    logs.configure()
+    profiling.install('power_agent')
+
     # CSV setup - open once
     csv_file_path = os.getenv('CSV_PATH', '/app/data/power_data.csv')  # Default to current dir
     os.makedirs(os.path.dirname(csv_file_path), exist_ok=True)
@@ -34,66 +27,48 @@ def main():
     csv_file = open(csv_file_path, 'a', newline='')
     csv_writer = csv.writer(csv_file)
 
-    # RabbitMQ setup
-    connection = connect_to_rabbitmq()
-    channel = connection.channel()
-    channel.exchange_declare(exchange='hotel_sensors', exchange_type='topic')
+    # RabbitMQ setup - confirmed, batched publishing from a background thread
+    publisher = BatchPublisher('hotel_sensors').start()
+    # JSON or the compact binary layout (WIRE_FORMAT), optionally several readings per message (ENVELOPE_MODE)
+    envelopes = EnvelopePublisher(publisher, wire.publish_content_type())
+    start_metrics_server(9100)
 
     floors = [f"floor{i}" for i in range(1, 4)]
     rooms = [f"room{i}" for i in range(1, 6)]
 
-    current_minute = None
-    faulty_slot = None
-    send_count = 0
+    faulty_clock = FaultySlotClock()
 
     try:
         while True:
             timestamp = int(time.time())
             minute = timestamp // 60  
 
-            if minute != current_minute:
-                current_minute = minute
-                faulty_slot = random.randint(0, 11)
-                send_count = 0
-                print(f"New minute {current_minute}, faulty slot is {faulty_slot}")
+            if minute != faulty_clock.minute:
+                faulty_clock.start_minute(minute)
+                log.info("New minute %d, faulty slot is %d", minute, faulty_clock.faulty_slot)
 
             floor = random.choice(floors)
             room = random.choice(rooms)
             routing_key = f"{floor}.{room}.power"
 
-
-            is_faulty = (send_count == faulty_slot)
-
-            if is_faulty:
-                # Faulty data: not working
-                power_kw = 0.0
-            else:
-                # Normal or spike data
-                rand = random.random()
-                if rand < 0.1875: 
-                    power_kw = round(random.uniform(45.0, 100.0), 1)  # Spike
-                else:
-                    power_kw = round(random.uniform(0.7, 5.0), 1)  # Normal
-            
-            data = {'timestamp': timestamp, 'power_kw': power_kw}
+            is_faulty = faulty_clock.next_is_faulty()
+            data = power_reading(timestamp, is_faulty)
             
             csv_writer.writerow([timestamp, floor, room, data['power_kw']])
             csv_file.flush()
             
-            payload = json.dumps(data)
-            channel.basic_publish(exchange='hotel_sensors', routing_key=routing_key, body=payload.encode())
-            print(f"{timestamp} - Sent to {routing_key}: {payload} {'(faulty)' if is_faulty else ''}", flush=True)
-
-            # Increment send count
-            send_count += 1
+            envelopes.add(routing_key, data)
+            if not publisher.quiet:
+                log.sampled('reading_sent', "Sent to %s: %s %s", routing_key, data, '(faulty)' if is_faulty else '')
 
             time.sleep(5)
     
     except KeyboardInterrupt:
-        print("Shutting down...")
+        log.info("Shutting down...")
     finally:
         csv_file.close()
-        connection.close()
+        envelopes.close()
+        publisher.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
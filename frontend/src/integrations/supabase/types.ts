@@ -15,6 +15,7 @@ export type Database = {
           fault_flags: number
           floor: number
           id: string
+          incident_id: string | null
           resolved: boolean | null
           resolved_at: string | null
           room: number
@@ -26,6 +27,7 @@ export type Database = {
           fault_flags: number
           floor: number
           id: string
+          incident_id?: string | null
           resolved?: boolean | null
           resolved_at?: string | null
           room: number
@@ -37,6 +39,7 @@ export type Database = {
           fault_flags?: number
           floor?: number
           id?: string
+          incident_id?: string | null
           resolved?: boolean | null
           resolved_at?: string | null
           room?: number
@@ -45,6 +48,48 @@ export type Database = {
         }
         Relationships: []
       }
+      fault_incidents: {
+        Row: {
+          active: boolean
+          device_type: string
+          fault_count: number
+          fault_flags: number
+          floor: number
+          id: string
+          last_seen: string
+          resolved: boolean
+          rooms: number[]
+          severity: number
+          started_at: string
+        }
+        Insert: {
+          active?: boolean
+          device_type: string
+          fault_count: number
+          fault_flags: number
+          floor: number
+          id: string
+          last_seen: string
+          resolved?: boolean
+          rooms: number[]
+          severity: number
+          started_at: string
+        }
+        Update: {
+          active?: boolean
+          device_type?: string
+          fault_count?: number
+          fault_flags?: number
+          floor?: number
+          id?: string
+          last_seen?: string
+          resolved?: boolean
+          rooms?: number[]
+          severity?: number
+          started_at?: string
+        }
+        Relationships: []
+      }
       sensors_data: {
         Row: {
           co2: number | null
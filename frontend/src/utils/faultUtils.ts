@@ -8,7 +8,12 @@ export const FAULT_TYPES = {
   CO2_HIGH: 32,             // Bit 5
   POWER_NOT_WORKING: 64,     // Bit 6 (Power: 0.0 kW)
   POWER_SPIKE: 128,         // Bit 7 (Power: >45.0 kW)
-  PRESENCE_NOT_READING: 256  // Bit 8 (Presence: 3)
+  PRESENCE_NOT_READING: 256, // Bit 8 (Presence: 3)
+  IAQ_ANOMALY: 512,         // Bit 9 (IAQ: far from the room's baseline)
+  POWER_ANOMALY: 1024,      // Bit 10 (Power: far from the room's baseline)
+  IAQ_SILENT: 2048,         // Bit 11 (IAQ: stopped sending)
+  POWER_SILENT: 4096,       // Bit 12 (Power: stopped sending)
+  PRESENCE_SILENT: 8192     // Bit 13 (Presence: stopped sending)
 } as const;
 
 export const getFaultDescription = (faultFlag: number): string[] => {
@@ -23,6 +28,11 @@ export const getFaultDescription = (faultFlag: number): string[] => {
   if (faultFlag & FAULT_TYPES.POWER_NOT_WORKING) faults.push('Power not working');
   if (faultFlag & FAULT_TYPES.POWER_SPIKE) faults.push('Power spike detected');
   if (faultFlag & FAULT_TYPES.PRESENCE_NOT_READING) faults.push('Presence sensor error');
+  if (faultFlag & FAULT_TYPES.IAQ_ANOMALY) faults.push('Unusual air quality reading');
+  if (faultFlag & FAULT_TYPES.POWER_ANOMALY) faults.push('Unusual power reading');
+  if (faultFlag & FAULT_TYPES.IAQ_SILENT) faults.push('IAQ sensor silent');
+  if (faultFlag & FAULT_TYPES.POWER_SILENT) faults.push('Power meter silent');
+  if (faultFlag & FAULT_TYPES.PRESENCE_SILENT) faults.push('Presence sensor silent');
   
   return faults;
 };
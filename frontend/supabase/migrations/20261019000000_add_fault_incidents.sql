@@ -0,0 +1,18 @@
+ALTER TABLE equipment_faults
+ADD COLUMN incident_id TEXT;
+
+CREATE INDEX idx_equipment_faults_incident ON equipment_faults (incident_id) WHERE incident_id IS NOT NULL;
+
+CREATE TABLE fault_incidents (
+    id TEXT PRIMARY KEY,
+    floor SMALLINT NOT NULL,
+    device_type TEXT NOT NULL,
+    fault_flags INTEGER NOT NULL,
+    severity SMALLINT NOT NULL,
+    started_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    last_seen TIMESTAMP WITH TIME ZONE NOT NULL,
+    rooms SMALLINT[] NOT NULL,
+    fault_count INTEGER NOT NULL,
+    active BOOLEAN NOT NULL DEFAULT TRUE,
+    resolved BOOLEAN NOT NULL DEFAULT FALSE
+);